@@ -8,20 +8,55 @@ See https://github.com/AlexLadd/Appdaemon-Spotify-Player/blob/master/spotify_cli
 
 import appdaemon.plugins.hass.hassapi as hass
 import spotipy
+import asyncio
+import sys
+import importlib.util
 import random
 import datetime
 import time
+import os
+import uuid
+import functools
+import contextlib
+import contextvars
+import logging
+import logging.handlers
+import sqlite3
+import threading
+import concurrent.futures
+import re
+import unicodedata
+import math
+import array
+import collections
+import collections.abc
+import hashlib
+import gc
+import tracemalloc
 import voluptuous as vol
 import requests
-from bs4 import BeautifulSoup
 import json
-from pychromecast.controllers.spotify import SpotifyController
-import pychromecast
-from pychromecast.socket_client import (
-    CONNECTION_STATUS_CONNECTED,
-    CONNECTION_STATUS_DISCONNECTED,
-    CONNECTION_STATUS_CONNECTING,
-)
+
+
+def _lazy_import(name):
+  """ 
+  Returns a module that is only loaded when one of its attributes is first used
+
+  pychromecast pulls in zeroconf and is not needed at all by users of Spotify Connect speakers only
+  """
+  if name in sys.modules:
+    return sys.modules[name]
+  spec = importlib.util.find_spec(name)
+  if spec is None:
+    raise ImportError('No module named {!r}'.format(name), name=name)
+  loader = importlib.util.LazyLoader(spec.loader)
+  spec.loader = loader
+  module = importlib.util.module_from_spec(spec)
+  sys.modules[name] = module
+  loader.exec_module(module)
+  return module
+
+pychromecast = _lazy_import('pychromecast')
 
 CONF_USERNAME = 'username'
 CONF_PASSWORD = 'password'
@@ -31,6 +66,35 @@ CONF_LANGUAGE = 'language'
 CONF_USER_ALIASES = 'user_aliases'
 CONF_DEVICE_ALIASES = 'device_aliases'
 CONF_EVENT_DOMAIN_NAME = 'event_domain_name'
+CONF_TRACING = 'tracing'
+CONF_TRACE_FILE = 'trace_file'
+CONF_TRACE_SLOW_THRESHOLD = 'trace_slow_threshold'
+CONF_LIBRARY_INDEX = 'library_index'
+CONF_LIBRARY_INDEX_FILE = 'library_index_file'
+CONF_LIBRARY_SYNC_INTERVAL = 'library_sync_interval'
+CONF_FUZZY_INDEX = 'fuzzy_index'
+CONF_FUZZY_MATCH_THRESHOLD = 'fuzzy_match_threshold'
+CONF_FUZZY_INDEX_INTERVAL = 'fuzzy_index_interval'
+CONF_SNAPSHOT_FILE = 'snapshot_file'
+CONF_WARM_CASTS = 'warm_casts'
+CONF_CAST_HEALTH_MONITOR = 'cast_health_monitor'
+CONF_DEVICE_REGISTRY_FILE = 'device_registry_file'
+CONF_PLAY_CHUNK_SIZE = 'play_chunk_size'
+CONF_CAST_DISCOVERY = 'cast_discovery'
+CONF_TOKEN_FILE = 'token_file'
+CONF_RECOMMENDATION_CACHE_TTL = 'recommendation_cache_ttl'
+CONF_PLAYBACK_SENSOR = 'playback_sensor'
+CONF_CIRCUIT_BREAKER_THRESHOLD = 'circuit_breaker_threshold'
+CONF_CIRCUIT_BREAKER_TIMEOUT = 'circuit_breaker_timeout'
+CONF_PLAY_DEADLINE = 'play_deadline'
+CONF_SPECULATIVE_RECOMMENDATION = 'speculative_recommendation'
+CONF_HTTP_CACHE = 'http_cache'
+CONF_HTTP_CACHE_SIZE = 'http_cache_size'
+CONF_HTTP_CACHE_DIR = 'http_cache_dir'
+CONF_ACCOUNTS = 'accounts'
+CONF_ACCOUNT_DEVICES = 'devices'
+CONF_SHARED_CACHE_FILE = 'shared_cache_file'
+CONF_PROFILE_DIR = 'profile_dir'
 
 DEFAULT_EVENT_DOMAIN_NAME = 'spotify'
 DEFAULT_EVENT_PLAY = '.play'
@@ -44,6 +108,120 @@ MAX_PLAY_ATTEMPTS = 2
 # Max number of times to retry transfering a song
 MAX_TRANSFER_ATTEMPTS = 2
 
+DEFAULT_TRACE_FILE = 'spotify_client_traces.jsonl'
+# Traces taking longer than this many seconds are logged
+DEFAULT_TRACE_SLOW_THRESHOLD = 5.0
+# Size of a trace file before it is rotated and the number of rotated files to keep
+TRACE_FILE_MAX_BYTES = 1024 * 1024
+TRACE_FILE_BACKUP_COUNT = 3
+
+DEFAULT_LIBRARY_INDEX_FILE = 'spotify_client_library.db'
+DEFAULT_LIBRARY_SYNC_INTERVAL = 3600
+# Number of saved tracks returned when the library is used as a fallback
+SAVED_TRACKS_LIMIT = 20
+
+# Minimum confidence (0 - 1) for a fuzzy name match to be used instead of a Spotify search
+DEFAULT_FUZZY_MATCH_THRESHOLD = 0.75
+DEFAULT_FUZZY_INDEX_INTERVAL = 3600
+
+DEFAULT_SNAPSHOT_FILE = 'spotify_client_snapshots.json'
+# Snapshot slot used when the controls event does not name one
+DEFAULT_SNAPSHOT_NAME = 'default'
+
+DEFAULT_PROFILE_DIR = 'spotify_client_profiles'
+DEFAULT_DEVICE_REGISTRY_FILE = 'spotify_client_devices.json'
+DEFAULT_PLAY_CHUNK_SIZE = 100
+DEFAULT_TOKEN_FILE = 'spotify_client_token.json'
+DEFAULT_RECOMMENDATION_CACHE_TTL = 3600
+
+# Event parameters that decide the recommendation candidates (the cache key), flags only matter when set
+RECOMMENDATION_PARAMS = ('track', 'playlist', 'album', 'artist', 'username', 'genre', 'category')
+RECOMMENDATION_FLAGS = ('featured', 'new_releases', 'similar', 'single', 'multiple', 'random_search')
+RECOMMENDATION_CACHE_SIZE = 256
+
+# Playback poller intervals (seconds), polling stops while nothing is active
+PLAYBACK_POLL_PLAYING = 15
+PLAYBACK_POLL_PAUSED = 60
+PLAYBACK_POLL_MIN = 1
+# Seconds to wait after a play/control action before polling, so Spotify reports the new state
+PLAYBACK_POLL_AFTER_ACTION = 2
+# Seconds the last playback info is reused while the poller is stopped
+PLAYBACK_CACHE_AGE = 10
+
+DEFAULT_CIRCUIT_BREAKER_THRESHOLD = 5
+DEFAULT_CIRCUIT_BREAKER_TIMEOUT = 30
+# Longest time (seconds) a circuit breaker stays open, the open time doubles after each failed probe
+CIRCUIT_BREAKER_MAX_TIMEOUT = 300
+# Spotify Web API endpoint groups with their own circuit breaker, all other endpoints are in the 'catalog' group
+PLAYER_API_METHODS = frozenset(['current_playback', 'current_user_playing_track', 'devices', 'start_playback', 'transfer_playback',
+                                'pause_playback', 'next_track', 'previous_track', 'volume', 'seek_track', 'shuffle', 'repeat', 'add_to_queue'])
+SEARCH_API_METHODS = frozenset(['search'])
+
+# Threads running the recommendation branches of an event at the same time
+SPECULATIVE_WORKERS = 5
+
+# Megabytes of Web API responses kept in memory by the HTTP cache
+DEFAULT_HTTP_CACHE_SIZE = 8
+# Responses spilled to the HTTP cache folder before the oldest are removed
+HTTP_CACHE_DISK_ENTRIES = 2000
+# Catalog and playlist endpoints whose responses are cached and revalidated with If-None-Match, not users/me/ which
+# depends on the account of the token
+HTTP_CACHE_URLS = re.compile(r'^https://api\.spotify\.com/v1/(playlists|albums|artists|tracks|browse|users/(?!me/)[^/?]+/playlists|recommendations/available-genre-seeds)([/?]|$)')
+
+# Seconds a shared cache operation waits for another instance writing to the file
+SHARED_CACHE_BUSY_TIMEOUT = 2
+# Seconds a token renewal waits for another instance that is logging in to Spotify
+SHARED_CACHE_LOGIN_TIMEOUT = 60
+# Seconds Web API responses are kept in the shared cache, they are revalidated with their ETag meanwhile
+SHARED_CACHE_HTTP_TTL = 86400
+# Seconds between removals of the expired shared cache entries
+SHARED_CACHE_PURGE_INTERVAL = 3600
+
+# Seconds between refreshes of the playlists played when a play event runs out of time
+FALLBACK_REFRESH_INTERVAL = 3600
+
+# The token is renewed this many seconds before it expires, a saved token with less time left is not reused
+TOKEN_RENEW_MARGIN = 300
+# Seconds before trying again when getting a token failed
+TOKEN_RETRY_DELAY = 60
+
+# Web API 'fields' filters so playlist lookups only download what the caller uses
+PLAYLIST_INFO_FIELDS = 'name,uri,description,owner(display_name,id),tracks(total,items(track(uri)))'
+PLAYLIST_NAME_FIELDS = 'name'
+PLAYLIST_TOTAL_FIELDS = 'tracks.total'
+PLAYLIST_URIS_FIELDS = 'tracks.items(track(uri))'
+
+# Long lists of tracks play one chunk after the other, the playback is checked CHUNK_CHECK_DELAY seconds after a
+# chunk starts, when each track ends and every CHUNK_PAUSED_INTERVAL seconds while paused (seconds)
+CHUNK_CHECK_DELAY = 5
+CHUNK_PAUSED_INTERVAL = 30
+# The next chunk starts this many seconds before the last track of the chunk playing ends
+CHUNK_SWITCH_LEAD = 1
+
+# Reconnection backoff for unavailable casts (seconds), the delay doubles after each failed attempt
+CAST_RECONNECT_BASE_DELAY = 2
+CAST_RECONNECT_MAX_DELAY = 300
+# How often the cast health monitor checks the casts when nothing changes (seconds)
+CAST_HEALTH_CHECK_INTERVAL = 30
+# Chromecast app ids of the idle screen (backdrop) and of the Spotify receiver
+CAST_BACKDROP_APP_ID = 'E8C28D3C'
+CAST_SPOTIFY_APP_ID = 'CC32E753'
+# A saved Spotify device that is not a saved Chromecast is played to without discovery for this long,
+# discovery then checks it is a Spotify Connect device (seconds)
+CONNECT_DEVICE_GUESS_TTL = 3600
+
+# Seconds between the stack samples of the profiler
+PROFILE_SAMPLE_INTERVAL = 0.01
+# A profile that is not stopped stops by itself after this many seconds
+PROFILE_MAX_DURATION = 900
+# Frames kept per memory allocation by tracemalloc
+MEMORY_TRACE_FRAMES = 10
+# Lines of the profile and memory reports
+PROFILE_REPORT_LINES = 30
+
+# Seconds an event received while the app is starting waits for the Spotify token
+READY_TIMEOUT = 15
+
 def _is_spotify_country(value):
   """ ISO 3166-1 alpha-2 country code format (ex: 'US') """
   if value is None:
@@ -64,6 +242,14 @@ def _is_spotify_language(value):
     raise vol.Invalid('Invalid language format, please use an ISO 639 language code and an ISO 3166-1 alpha-2 country code, joined by an underscore.')
   return value
 
+ACCOUNT_SCHEMA = vol.Schema(
+  {
+    vol.Required(CONF_USERNAME): str,                                               # Spotify username
+    vol.Required(CONF_PASSWORD): str,                                               # Spotify password
+    vol.Optional(CONF_ACCOUNT_DEVICES, default=[]): [str],                          # Devices (names/aliases) that play with this account
+  }
+)
+
 SPOTIFY_CLIENT_SCHEMA = vol.Schema(
   {
     vol.Required(CONF_USERNAME): str,                                               # Spotify username
@@ -74,21 +260,113 @@ SPOTIFY_CLIENT_SCHEMA = vol.Schema(
     vol.Optional(CONF_LANGUAGE, default=DEFAULT_LANGUAGE): _is_spotify_language,    # Your language
     vol.Optional(CONF_USER_ALIASES, default={}): {str: str},                        # Map alias name to Spotify usernames
     vol.Optional(CONF_DEVICE_ALIASES, default={}): {str: str},                      # Map alias device name to Spotify device names
+    vol.Optional(CONF_TRACING, default=False): bool,                                # Record a span tree for every play/controls event
+    vol.Optional(CONF_TRACE_FILE, default=DEFAULT_TRACE_FILE): str,                 # JSONL file (relative to the apps folder) to write traces to
+    vol.Optional(CONF_TRACE_SLOW_THRESHOLD, default=DEFAULT_TRACE_SLOW_THRESHOLD): vol.Coerce(float), # Log traces slower than this (seconds)
+    vol.Optional(CONF_LIBRARY_INDEX, default=False): bool,                          # Keep a local SQLite index of the saved tracks library
+    vol.Optional(CONF_LIBRARY_INDEX_FILE, default=DEFAULT_LIBRARY_INDEX_FILE): str, # SQLite file (relative to the apps folder) for the library index
+    vol.Optional(CONF_LIBRARY_SYNC_INTERVAL, default=DEFAULT_LIBRARY_SYNC_INTERVAL): vol.All(int, vol.Range(min=60)), # Seconds between library syncs
+    vol.Optional(CONF_FUZZY_INDEX, default=False): bool,                            # Resolve names locally from playlists, library and play history
+    vol.Optional(CONF_FUZZY_MATCH_THRESHOLD, default=DEFAULT_FUZZY_MATCH_THRESHOLD): vol.All(vol.Coerce(float), vol.Range(min=0, max=1)), # Minimum fuzzy match confidence
+    vol.Optional(CONF_FUZZY_INDEX_INTERVAL, default=DEFAULT_FUZZY_INDEX_INTERVAL): vol.All(int, vol.Range(min=60)), # Seconds between fuzzy index rebuilds
+    vol.Optional(CONF_SNAPSHOT_FILE, default=DEFAULT_SNAPSHOT_FILE): str,           # JSON file (relative to the apps folder) snapshots are saved to
+    vol.Optional(CONF_WARM_CASTS, default=[]): [str],                               # Chromecasts to keep Spotify launched on
+    vol.Optional(CONF_CAST_HEALTH_MONITOR, default=True): bool,                     # Reconnect unavailable casts in the background
+    vol.Optional(CONF_DEVICE_REGISTRY_FILE, default=DEFAULT_DEVICE_REGISTRY_FILE): str, # JSON file (relative to the apps folder) known devices are saved to
+    vol.Optional(CONF_PLAY_CHUNK_SIZE, default=DEFAULT_PLAY_CHUNK_SIZE): vol.All(int, vol.Range(min=0)), # Tracks per chunk a long list is played in (0 = disabled)
+    vol.Optional(CONF_CAST_DISCOVERY, default=False): bool,                         # Discover the Chromecasts at startup instead of on first use
+    vol.Optional(CONF_TOKEN_FILE, default=DEFAULT_TOKEN_FILE): str,                 # File (relative to the apps folder) the access token is saved to
+    vol.Optional(CONF_RECOMMENDATION_CACHE_TTL, default=DEFAULT_RECOMMENDATION_CACHE_TTL): vol.All(int, vol.Range(min=0)), # Seconds recommendation candidates are cached (0 = disabled)
+    vol.Optional(CONF_PLAYBACK_SENSOR, default=False): bool,                        # Poll the playback in the background and publish it as a sensor
+    vol.Optional(CONF_CIRCUIT_BREAKER_THRESHOLD, default=DEFAULT_CIRCUIT_BREAKER_THRESHOLD): vol.All(int, vol.Range(min=0)), # Consecutive API failures that open a circuit (0 = disabled)
+    vol.Optional(CONF_CIRCUIT_BREAKER_TIMEOUT, default=DEFAULT_CIRCUIT_BREAKER_TIMEOUT): vol.All(int, vol.Range(min=1)), # Seconds before an open circuit lets a probe call through
+    vol.Optional(CONF_PLAY_DEADLINE, default=0): vol.All(vol.Coerce(float), vol.Range(min=0)), # Seconds to find music for a play event (0 = no limit)
+    vol.Optional(CONF_SPECULATIVE_RECOMMENDATION, default=False): bool,             # Run the genre/category/featured/new releases/fallback lookups at the same time
+    vol.Optional(CONF_HTTP_CACHE, default=False): bool,                             # Cache catalog/playlist responses and revalidate them with their ETag
+    vol.Optional(CONF_HTTP_CACHE_SIZE, default=DEFAULT_HTTP_CACHE_SIZE): vol.All(vol.Coerce(float), vol.Range(min=0)), # Megabytes of responses kept in memory
+    vol.Optional(CONF_HTTP_CACHE_DIR, default=''): str,                            # Folder (relative to the apps folder) evicted responses are spilled to ('' = no spill)
+    vol.Optional(CONF_ACCOUNTS, default=[]): [ACCOUNT_SCHEMA],                      # Additional Spotify accounts
+    vol.Optional(CONF_SHARED_CACHE_FILE, default=''): str,                          # SQLite file (relative to the apps folder) shared with other instances ('' = not shared)
+    vol.Optional(CONF_PROFILE_DIR, default=DEFAULT_PROFILE_DIR): str,               # Folder (relative to the apps folder) the profile action writes its results to
   }, 
   extra=vol.ALLOW_EXTRA
 )
 
+# The tracing span that is currently open in this thread/context (None when not tracing)
+_active_span = contextvars.ContextVar('spotify_client_active_span', default=None)
+
+# Candidate pools picked from while resolving the current event, recorded for the recommendation cache
+_choice_log = contextvars.ContextVar('spotify_client_choice_log', default=None)
+
+# Deadline of the play event being resolved (None when there is no time limit)
+_deadline = contextvars.ContextVar('spotify_client_deadline', default=None)
+
+# SpotifyAccount of the event being handled (None for the main account)
+_active_account = contextvars.ContextVar('spotify_client_active_account', default=None)
+
+class _AccountAttribute:
+  """ SpotifyClient attribute stored on the SpotifyAccount of the event being handled """
+
+  def __init__(self, name):
+    self.name = name
+
+  def __get__(self, app, owner=None):
+    if app is None:
+      return self
+    return getattr(app._account, self.name)
+
+  def __set__(self, app, value):
+    setattr(app._account, self.name, value)
+
+def _api_group(method):
+  """ Returns the circuit breaker group ('player', 'search' or 'catalog') of a spotipy.Spotify method """
+  if method in PLAYER_API_METHODS:
+    return 'player'
+  if method in SEARCH_API_METHODS:
+    return 'search'
+  return 'catalog'
+
+def _traced(name):
+  """ Decorator that records a tracing span around a SpotifyClient method (sync or async) """
+  def decorator(func):
+    if asyncio.iscoroutinefunction(func):
+      @functools.wraps(func)
+      async def async_wrapper(self, *args, **kwargs):
+        with self._span(name):
+          return await func(self, *args, **kwargs)
+      return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+      with self._span(name):
+        return func(self, *args, **kwargs)
+    return wrapper
+  return decorator
+
+async def _async_value(value):
+  """ Coroutine returning the value, used in place of a lookup that is not needed """
+  return value
+
 
 class SpotifyClient(hass.Hass):
 
+  # Each Spotify account has its own client, token and devices (see SpotifyAccount)
+  sp = _AccountAttribute('sp')
+  _username = _AccountAttribute('username')
+  _password = _AccountAttribute('password')
+  _access_token = _AccountAttribute('access_token')
+  _token_expires_at = _AccountAttribute('token_expires_at')
+  _token_file = _AccountAttribute('token_file')
+  _token_timer = _AccountAttribute('token_timer')
+  _spotify_devices = _AccountAttribute('spotify_devices')
+  _play_id = _AccountAttribute('play_id')
+
   def initialize(self):
     config = SPOTIFY_CLIENT_SCHEMA(self.args)
     self._event_domain_name = config.get(CONF_EVENT_DOMAIN_NAME)
     self._event_play = self._event_domain_name + DEFAULT_EVENT_PLAY
     self._event_controls = self._event_domain_name + DEFAULT_EVENT_CONTROLS
     self._debugging = config.get(CONF_DEBUGGING)
-    self._username = config.get(CONF_USERNAME)
-    self._password = config.get(CONF_PASSWORD)
     self._country = config.get(CONF_COUNTRY)
     self._language = config.get(CONF_LANGUAGE)
     self._user_aliases = {}
@@ -108,17 +386,89 @@ class SpotifyClient(hass.Hass):
     if self._event_domain_name != DEFAULT_EVENT_DOMAIN_NAME:
       self.log('Default event name has been changed to a custom event name: "{}".'.format(self._event_domain_name), level=self.DEBUG_LEVEL)
 
-    self.sp = None                      # Spotify client object
-    self._access_token = None           # Spotify access token
-    self._token_expires = None          # Spotify token expiry in seconds
+    token_file = os.path.join(self.app_dir, config.get(CONF_TOKEN_FILE))
+    self._main_account = self._create_account(config.get(CONF_USERNAME), config.get(CONF_PASSWORD), token_file)
+    self._accounts = {self._main_account.username: self._main_account} # Username -> SpotifyAccount
+    for account in config.get(CONF_ACCOUNTS):
+      # Each account saves its token to its own file
+      root, ext = os.path.splitext(token_file)
+      self._accounts[account[CONF_USERNAME]] = self._create_account(account[CONF_USERNAME], account[CONF_PASSWORD], 
+                                                                   '{}.{}{}'.format(root, account[CONF_USERNAME], ext), account[CONF_ACCOUNT_DEVICES])
     self._chromecasts = {}              # Cast UUID -> CastDevice object
-    self._spotify_devices = {}          # Spotify device_name -> device_id
-    self._last_cast_sc = None           # The last SpotifyController used
+    self._cast_lock = threading.RLock() # Guards _chromecasts, _known_casts and _connect_devices (changed by events, discovery, the registry restore and the monitor)
     self._last_device = None            # The name of the Spotify device last used
     self._transfer_retry_count = 0      # Current number of song replay tries from cc error
     self._play_retry_count = 0          # Current number of song replay tries from spotify error
-    self._snapshot_info = {}            # Captured snapshot information
+    self._snapshots = {}                # Snapshot name -> captured snapshot information
+    self._warm_casts = config.get(CONF_WARM_CASTS) # Chromecast names/aliases to keep Spotify launched on
+    self._cast_monitor = None           # CastHealthMonitor reconnecting unavailable casts in the background
+    self._snapshot_file = os.path.join(self.app_dir, config.get(CONF_SNAPSHOT_FILE))
     self._snapshot_uri = None           # Save last Spotify uri played (needed to restore from a list of tracks)
+    self._device_registry_file = os.path.join(self.app_dir, config.get(CONF_DEVICE_REGISTRY_FILE))
+    self._known_casts = {}              # Cast UUID string -> cast info saved by a previous run
+    self._connect_devices = set()       # Spotify device names discovery found not to be Chromecasts (not discovered again)
+    self._connect_guesses = {}          # Saved Spotify device name -> time.monotonic() it was guessed not to be a Chromecast (not saved)
+    self._play_chunk_size = config.get(CONF_PLAY_CHUNK_SIZE)
+    self._ready = threading.Event()     # Set once the first token request finished, early events wait for it
+    self._recommendation_cache = None   # TTLCache of recommendation candidates when the cache is enabled
+    self._playback_sensor = config.get(CONF_PLAYBACK_SENSOR)
+    self._playback_entity = 'sensor.{}_playback'.format(self._event_domain_name)
+    self._playback = None               # Last playback info fetched from Spotify ({} when nothing is active)
+    self._playback_fetched = 0          # time.monotonic() of the last playback fetch
+    self._playback_poll_timer = None    # Handle of the next playback poll, None while the poller is stopped
+    self._playback_lock = threading.Lock()
+    self._breakers = {}                 # API group -> CircuitBreaker, empty when the circuit breakers are disabled
+    self._circuit_entity = 'sensor.{}_api_circuit'.format(self._event_domain_name)
+    self._circuit_timer = None          # Handle of the update of the circuit entity when an open circuit half opens
+    self._play_deadline = config.get(CONF_PLAY_DEADLINE)
+    self._fallback_pool = []            # User playlists played when a play event runs out of time
+    self._speculative_recommendation = config.get(CONF_SPECULATIVE_RECOMMENDATION)
+    self._shared_cache = None           # SharedCache of tokens, devices and catalog data when a shared cache file is set
+    if config.get(CONF_SHARED_CACHE_FILE):
+      shared_file = os.path.join(self.app_dir, config.get(CONF_SHARED_CACHE_FILE))
+      self._shared_cache = SharedCache(shared_file, self)
+      self.log('Sharing tokens, devices and catalog data through: "{}".'.format(shared_file), level=self.DEBUG_LEVEL)
+    self._http_cache = None             # HTTPResponseCache of Web API responses when the HTTP cache is enabled
+    if config.get(CONF_HTTP_CACHE):
+      spill_dir = os.path.join(self.app_dir, config.get(CONF_HTTP_CACHE_DIR)) if config.get(CONF_HTTP_CACHE_DIR) else None
+      self._http_cache = HTTPResponseCache(int(config.get(CONF_HTTP_CACHE_SIZE) * 1024 * 1024), spill_dir, self._shared_cache)
+    self._branch_executor = None        # ThreadPoolExecutor running the recommendation branches in speculative mode
+    if self._speculative_recommendation:
+      self._branch_executor = concurrent.futures.ThreadPoolExecutor(SPECULATIVE_WORKERS, thread_name_prefix='spotify_client_recommendation')
+    if config.get(CONF_RECOMMENDATION_CACHE_TTL):
+      self._recommendation_cache = TTLCache(config.get(CONF_RECOMMENDATION_CACHE_TTL), RECOMMENDATION_CACHE_SIZE)
+    self._tracer = None                 # EventTracer used when tracing is enabled
+    self._library = None                # LibraryIndex of saved tracks when the library index is enabled
+    self._fuzzy_index = None            # FuzzyNameIndex of names the user plays when the fuzzy index is enabled
+    self._fuzzy_threshold = config.get(CONF_FUZZY_MATCH_THRESHOLD)
+    self._profile_dir = os.path.join(self.app_dir, config.get(CONF_PROFILE_DIR))
+    self._profiler = None               # SamplingProfiler while a profile is running
+    self._profile_timer = None          # Handle of the automatic stop of the running profile
+    self._memory_snapshots = None       # MemorySnapshots once the profile action took a memory snapshot
+    self._profile_lock = threading.Lock()
+
+    self._load_snapshots()
+    self._load_device_registry()
+
+    if config.get(CONF_CAST_HEALTH_MONITOR):
+      self._cast_health_entity = 'sensor.{}_cast_health'.format(self._event_domain_name)
+      self._cast_monitor = CastHealthMonitor(self._chromecasts, self, self.DEBUG_LEVEL, self._publish_cast_health)
+      self._cast_monitor.start()
+
+    if config.get(CONF_CIRCUIT_BREAKER_THRESHOLD):
+      for group in ('player', 'catalog', 'search'):
+        self._breakers[group] = CircuitBreaker(group, config.get(CONF_CIRCUIT_BREAKER_THRESHOLD), 
+                                               config.get(CONF_CIRCUIT_BREAKER_TIMEOUT), self._circuit_changed)
+      self._publish_circuits()
+
+    if config.get(CONF_TRACING):
+      trace_file = os.path.join(self.app_dir, config.get(CONF_TRACE_FILE))
+      self._tracer = EventTracer(trace_file, config.get(CONF_TRACE_SLOW_THRESHOLD), self, self.DEBUG_LEVEL)
+      self.log('Tracing is enabled, traces will be written to: "{}".'.format(trace_file), level=self.DEBUG_LEVEL)
+
+    if config.get(CONF_LIBRARY_INDEX):
+      library_file = os.path.join(self.app_dir, config.get(CONF_LIBRARY_INDEX_FILE))
+      self._library = LibraryIndex(library_file, self, self.DEBUG_LEVEL)
 
     # Register the Spotify play event listener
     self.listen_event(self._spotify_play_event_callback, event=self._event_play)
@@ -126,26 +476,599 @@ class SpotifyClient(hass.Hass):
     # Register the Spotify controls event listener
     self.listen_event(self._spotify_controls_event_callback, event=self._event_controls)
 
-    # Spotify web token is valid for 3600 seconds, so renew before 1 hour expires
-    self.run_every(self._renew_spotify_token, self.datetime() + datetime.timedelta(seconds=2), 3500)
+    # Start the slow startup work right away and in parallel, events received meanwhile wait for the token
+    self._run_in_background(self._get_first_token, 'token')
+    for account in self._accounts.values():
+      if account is not self._main_account:
+        self._run_in_background(self._start_account, 'token_' + account.username, account)
+    if self._known_casts or self._spotify_devices:
+      self._run_in_background(self._restore_device_registry, 'device_registry', {})
+    if config.get(CONF_CAST_DISCOVERY):
+      self._run_in_background(self._discover_casts, 'cast_discovery')
+
+    if self._library:
+      # Give the Spotify client time to initialize before the first sync
+      self.run_every(self._sync_library_index, self.datetime() + datetime.timedelta(seconds=10), config.get(CONF_LIBRARY_SYNC_INTERVAL))
+
+    if self._shared_cache:
+      self.run_every(self._purge_shared_cache, self.datetime() + datetime.timedelta(seconds=SHARED_CACHE_PURGE_INTERVAL), SHARED_CACHE_PURGE_INTERVAL)
+
+    # Any play event can set a deadline, the fallback playlists are kept ready even when play_deadline is disabled
+    self.run_every(self._refresh_fallback_pool, self.datetime() + datetime.timedelta(seconds=15), FALLBACK_REFRESH_INTERVAL)
+
+    if config.get(CONF_FUZZY_INDEX):
+      self._fuzzy_index = FuzzyNameIndex()
+      # Build after the first library sync so the saved tracks come from the library index
+      self.run_every(self._build_fuzzy_index, self.datetime() + datetime.timedelta(seconds=20), config.get(CONF_FUZZY_INDEX_INTERVAL))
+
+
+  def _create_account(self, username, password, token_file, devices=()):
+    """ 
+    Returns a new SpotifyAccount
+
+    param username: Spotify username
+    param password: Spotify password
+    param token_file: File the access token of the account is saved to
+    param devices: Device names/aliases that play with this account
+    """
+    return SpotifyAccount(username, password, token_file, devices)
+
+
+  @property
+  def _account(self):
+    """ The SpotifyAccount of the event being handled (the main account outside of events) """
+    return _active_account.get() or self._main_account
+
+
+  @contextlib.contextmanager
+  def _use_account(self, account):
+    """ 
+    Make the Spotify calls of the block with the account (the main account if None)
+
+    param account: SpotifyAccount or username of one
+    """
+    if isinstance(account, str):
+      account = self._accounts.get(account)
+    token = _active_account.set(account)
+    try:
+      yield account
+    finally:
+      _active_account.reset(token)
+
+
+  def _event_account(self, data):
+    """ 
+    Returns the account to handle an event with: the account of the event 'account', the account 
+    that owns the event device or the main account
+
+    The event 'username' is not used, it is the user whose playlists are searched
+
+    param data: Dictionary containing the event parameters
+    """
+    if len(self._accounts) == 1:
+      return self._main_account
+    username = data.get('account', None)
+    account = self._accounts.get(self._user_aliases.get(username, username))
+    if account is not None:
+      return account
+    device = data.get('device', None) or data.get('transfer_playback', None)
+    if device:
+      device_name = self._device_aliases.get(device, device)
+      for account in self._accounts.values():
+        if device in account.devices or device_name in account.devices:
+          return account
+    return self._main_account
+
+
+  def _start_account(self, account):
+    """ Get the first token of an additional account (reusing the saved one if it is still valid) """
+    with self._use_account(account):
+      access_token, expires_at = self._load_token()
+      if access_token:
+        self._initialize_spotify_client(access_token, expires_at)
+        self._schedule_token_renewal()
+      else:
+        self._renew_spotify_token({'account': account.username})
+
+
+  def _run_in_background(self, func, name, *args):
+    """ 
+    Run startup work in a daemon thread so initialize returns immediately
+
+    param func: Function to run
+    param name: Name of the work (used in the thread name and logs)
+    """
+    def run():
+      try:
+        func(*args)
+      except Exception as e:
+        self.log('Background {} failed: {}'.format(name, e), level='ERROR')
+    threading.Thread(target=run, name='spotify_client_' + name, daemon=True).start()
+
+
+  def _get_first_token(self):
+    """ Get the first Spotify token at startup (reusing the saved one if it is still valid), then let the waiting events through """
+    try:
+      access_token, expires_at = self._load_token()
+      with self._trace('token.reuse' if access_token else 'token.renew'):
+        if access_token:
+          self.log('Reusing the saved Spotify token ({}s left).'.format(int(expires_at - time.time())), level=self.DEBUG_LEVEL)
+        try:
+          self._initialize_spotify_client(access_token, expires_at)
+        finally:
+          self._schedule_token_renewal()
+    finally:
+      self._ready.set()
+      self.log('Spotify client is ready.', level=self.DEBUG_LEVEL)
+    # Events don't wait for Spotify to be launched on the warm casts
+    if self._access_token:
+      self._warm_up_casts(self._warm_casts)
+
+
+  @property
+  def ready(self):
+    """ True once the startup token request finished """
+    return self._ready.is_set()
+
+
+  def _wait_until_ready(self):
+    """ Wait (up to READY_TIMEOUT seconds) for the startup token request to finish """
+    if self._ready.is_set():
+      return
+    self.log('Spotify client is still starting, waiting up to {}s.'.format(READY_TIMEOUT), level=self.DEBUG_LEVEL)
+    with self._span('startup.wait_ready'):
+      if not self._ready.wait(READY_TIMEOUT):
+        self.log('Spotify client is not ready after {}s, handling the event anyway.'.format(READY_TIMEOUT), level='WARNING')
+
+
+  def _discover_casts(self):
+    """ Discover the Chromecasts on the network at startup so the first play to one doesn't wait for discovery """
+    with self._trace('cast.startup_discovery'):
+      self._add_discovered_casts(pychromecast.get_chromecasts(tries=5, retry_wait=1, timeout=30))
 
 
   def _renew_spotify_token(self, kwargs):
     """ Callback to renew spotify token """
-    self._initialize_spotify_client()
+    with self._use_account(kwargs.get('account', None)), self._trace('token.renew', account=kwargs.get('account', None)):
+      # The timer that called us has fired
+      self._token_timer = None
+      try:
+        self._initialize_spotify_client()
+      finally:
+        self._schedule_token_renewal()
+      # The Spotify receivers on the casts are still using the old token
+      if self._access_token and self._account is self._main_account:
+        self._warm_up_casts(self._warm_casts)
+
+
+  def _schedule_token_renewal(self):
+    """ Schedule the next token renewal shortly before the current token expires """
+    if self._token_timer is not None:
+      self.cancel_timer(self._token_timer)
+    delay = self._token_lifetime() - TOKEN_RENEW_MARGIN
+    if delay <= 0:
+      # No token, try again soon
+      delay = TOKEN_RETRY_DELAY
+    self._token_timer = self.run_in(self._renew_spotify_token, int(delay), account=self._username)
+    self.log('Spotify token renewal scheduled in {}s.'.format(int(delay)), level=self.DEBUG_LEVEL)
+
+
+  def _token_lifetime(self):
+    """ Returns the number of seconds the current token is still valid for """
+    if not self._access_token or self._token_expires_at is None:
+      return 0
+    return max(0, int(self._token_expires_at - time.time()))
+
+
+  def _load_token(self):
+    """ Returns the saved (access token, expiry time) if it belongs to this user and is valid long enough, else (None, None) """
+    if self._shared_cache is not None:
+      saved = self._shared_cache.get('token', self._username)
+      if saved and saved['expires_at'] - time.time() > TOKEN_RENEW_MARGIN:
+        return saved['access_token'], saved['expires_at']
+    if not os.path.exists(self._token_file):
+      return None, None
+    try:
+      with open(self._token_file) as f:
+        saved = json.load(f)
+      if saved.get('username') == self._username and saved['expires_at'] - time.time() > TOKEN_RENEW_MARGIN:
+        return saved['access_token'], saved['expires_at']
+    except (OSError, ValueError, KeyError, TypeError) as e:
+      self.log('Failed to load the saved Spotify token from "{}": {}'.format(self._token_file, e), level='WARNING')
+    return None, None
+
+
+  def _save_token(self):
+    """ Save the token to a file only the owner can read so restarts can reuse it """
+    saved = {'username': self._username, 'access_token': self._access_token, 'expires_at': self._token_expires_at}
+    if self._shared_cache is not None:
+      # Don't replace a newer token another instance got meanwhile
+      self._shared_cache.update('token', self._username, 
+                                lambda shared: shared if shared and shared['expires_at'] >= saved['expires_at'] else saved)
+    tmp_file = self._token_file + '.tmp'
+    try:
+      fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+      with os.fdopen(fd, 'w') as f:
+        json.dump(saved, f)
+      # O_CREAT doesn't change the mode of a file that already existed
+      os.chmod(tmp_file, 0o600)
+      os.replace(tmp_file, self._token_file)
+    except OSError as e:
+      self.log('Failed to save the Spotify token to "{}": {}'.format(self._token_file, e), level='WARNING')
+
+
+  def _warm_cast_callback(self, kwargs):
+    """ Callback to launch Spotify on a warm cast that reconnected """
+    with self._trace('cast.warm_up', cast=kwargs['cast_name']):
+      self._warm_up_casts([kwargs['cast_name']])
+
+
+  def _warm_up_casts(self, casts):
+    """ 
+    Launch and register Spotify on Chromecasts so plays to them don't need to launch the Spotify receiver
+
+    The Spotify device ids are refreshed since they change when Spotify is relaunched. Casts running
+    another app are skipped, Spotify is only launched over the idle screen
+
+    param casts: Chromecast names or aliases
+    """
+    for cast in casts:
+      cast_name = self.map_chromecasts(cast)
+      with self._span('cast.warm_up', cast=cast_name):
+        cast_device = self._get_cast_device(cast_name)
+        if cast_device is None:
+          self.log('No chromecast device was found with the name: "{}".'.format(cast_name), level='WARNING')
+          continue
+        app = cast_device.foreground_app()
+        if app is not None:
+          # Launching Spotify would stop what is on the screen, the next token renewal or reconnection tries again
+          self.log('Not warming up Spotify on "{}" while "{}" is running.'.format(cast_name, app), level=self.DEBUG_LEVEL)
+          continue
+        if not self._register_spotify_on_cast_device(cast_name):
+          self.log('Failed to warm up Spotify on "{}".'.format(cast_name), level='WARNING')
+          continue
+        if self._search_spotify_for_device(cast_name):
+          self.log('Spotify is warmed up on "{}".'.format(cast_name), level=self.DEBUG_LEVEL)
+        else:
+          self.log('Spotify was launched on "{}" but the Spotify device was not found.'.format(cast_name), level='WARNING')
+
+
+  def _cast_unavailable(self, cast_device):
+    """ 
+    Called from the pychromecast thread when a cast device becomes unavailable
+
+    param cast_device: The CastDevice that became unavailable
+    """
+    if self._cast_monitor:
+      self._cast_monitor.wake()
+
+
+  def _publish_cast_health(self, health):
+    """ 
+    Publish the health of the casts as a sensor entity (called from the cast health monitor thread)
+
+    param health: Cast name -> health information
+    """
+    healthy = all(h['available'] for h in health.values())
+    try:
+      self.set_state(self._cast_health_entity, state='ok' if healthy else 'degraded', attributes={'casts': health})
+    except Exception as e:
+      self.log('Failed to publish the cast health: {}'.format(e), level='WARNING')
+
+
+  def _circuit_open(self, group):
+    """ 
+    Returns True while the circuit of the API group is open (calls fail fast without contacting Spotify)
+
+    param group: API group ('player', 'catalog' or 'search')
+    """
+    breaker = self._breakers.get(group)
+    return breaker is not None and breaker.state == CircuitBreaker.OPEN
+
+
+  def _circuit_changed(self, breaker):
+    """ 
+    Called when a circuit breaker opens or closes (from the thread or event loop that made the API call)
+
+    param breaker: The CircuitBreaker that changed
+    """
+    if breaker.state == CircuitBreaker.OPEN:
+      self.log('The Spotify {} API keeps failing, failing its calls fast for {}s.'.format(breaker.name, round(breaker.retry_in())), level='WARNING')
+    else:
+      self.log('The Spotify {} API is working again.'.format(breaker.name), level='INFO')
+    # The scheduler and state calls can't be made from the event loop
+    self._run_in_background(self._publish_circuits, 'circuit_breaker')
+
+
+  def _publish_circuits_callback(self, kwargs):
+    """ Callback updating the circuit entity when an open circuit half opens """
+    self._circuit_timer = None
+    self._publish_circuits()
+
+
+  def _publish_circuits(self):
+    """ Publish the state of the circuit breakers as a sensor entity (open if any group is open) """
+    groups = {name: breaker.info() for name, breaker in self._breakers.items()}
+    states = [g['state'] for g in groups.values()]
+    state = CircuitBreaker.CLOSED
+    for s in (CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN):
+      if s in states:
+        state = s
+        break
+    try:
+      self.set_state(self._circuit_entity, state=state, attributes={'groups': groups, 'friendly_name': 'Spotify API circuit'})
+    except Exception as e:
+      self.log('Failed to publish the API circuit state: {}'.format(e), level='WARNING')
+
+    # Show the half open state on schedule
+    if self._circuit_timer is not None:
+      self.cancel_timer(self._circuit_timer)
+      self._circuit_timer = None
+    retry_in = [b.retry_in() for b in self._breakers.values() if b.state == CircuitBreaker.OPEN]
+    if retry_in:
+      self._circuit_timer = self.run_in(self._publish_circuits_callback, max(1, int(min(retry_in)) + 1))
+
+
+  def _cast_playback_info(self):
+    """ 
+    Returns the playback info reported by the cast Spotify last played on ({} if unknown)
+
+    Used while the Spotify player API is unavailable
+    """
+    for cast_device in list(self._chromecasts.values()):
+      # Known casts only, discovery is too slow here
+      if cast_device.name == self._last_device and cast_device.available:
+        return cast_device.playback_info()
+    return {}
+
+
+  def _cast_reconnected(self, cast_device):
+    """ 
+    Called from the pychromecast thread when a cast device reconnects
+
+    param cast_device: The CastDevice that reconnected
+    """
+    if cast_device.name in [self.map_chromecasts(c) for c in self._warm_casts]:
+      self.log('Warm cast "{}" reconnected, launching Spotify again.'.format(cast_device.name), level=self.DEBUG_LEVEL)
+      # Give the connection time to settle and launch from an Appdaemon thread
+      self.run_in(self._warm_cast_callback, 2, cast_name=cast_device.name)
+
+
+  def _restore_device_registry(self, kwargs):
+    """ 
+    Callback to connect straight to the Chromecasts saved by the last run and verify the saved Spotify device ids
+
+    Chromecasts that can't be reached are found by discovery the next time they are used
+    """
+    with self._trace('device.registry_restore'):
+      for info in list(self._known_casts.values()):
+        if uuid.UUID(info['uuid']) not in self._chromecasts:
+          self._connect_known_cast(info)
+
+      self._ready.wait(READY_TIMEOUT)
+      if not self.sp:
+        return
+      # Spotify device ids can change, update the ones Spotify currently reports
+      try:
+        devs = self.sp.devices()
+      except (spotipy.client.SpotifyException, requests.exceptions.RequestException) as e:
+        self.log('Failed to verify the saved Spotify devices: {}'.format(e), level='WARNING')
+        return
+      changed = False
+      for d in devs['devices']:
+        if d['name'] in self._spotify_devices and self._spotify_devices[d['name']] != d['id']:
+          self._spotify_devices[d['name']] = d['id']
+          changed = True
+      if changed:
+        self._save_device_registry()
+
+
+  def _connect_known_cast(self, info):
+    """ 
+    Returns the CastDevice of a saved Chromecast connected to without discovery, None if it can't be reached
+
+    param info: Saved cast info (See CastDevice.cast_info)
+    """
+    cast_uuid = uuid.UUID(info['uuid'])
+    cast_info = (info['host'], info['port'], cast_uuid, info['model_name'], info['friendly_name'])
+    try:
+      with self._span('cast.connect_known', cast=info['friendly_name']):
+        cast = pychromecast._get_chromecast_from_host(cast_info, tries=1, retry_wait=0, timeout=5)
+    except (pychromecast.error.ChromecastConnectionError, OSError) as e:
+      self.log('Saved Chromecast "{}" is not reachable at {}: {}'.format(info['friendly_name'], info['host'], e), level=self.DEBUG_LEVEL)
+      return None
+    with self._cast_lock:
+      if cast_uuid in self._chromecasts:
+        # Another thread connected to the cast in the meantime
+        CastDevice.discard(cast)
+        return self._chromecasts[cast_uuid]
+      self._chromecasts[cast_uuid] = CastDevice(cast, self, self.DEBUG_LEVEL, self._cast_reconnected, self._cast_unavailable)
+    self.log('Connected to saved Chromecast: "{}".'.format(info['friendly_name']), level=self.DEBUG_LEVEL)
+    return self._chromecasts[cast_uuid]
+
+
+  def _purge_shared_cache(self, kwargs):
+    """ Callback to remove the expired entries of the shared cache """
+    with self._trace('shared_cache.purge'):
+      self._shared_cache.purge()
+
+
+  def _sync_library_index(self, kwargs):
+    """ Callback to sync the local library index with the saved tracks on Spotify """
+    if not self.sp:
+      self.log('Spotify is not initialized, skipping library sync.', level=self.DEBUG_LEVEL)
+      return
+    with self._trace('library.sync'):
+      try:
+        self._library.sync(self.sp)
+      except (spotipy.client.SpotifyException, requests.exceptions.RequestException, sqlite3.Error) as e:
+        self.log('Failed to sync the library index: {}'.format(e), level='WARNING')
+
+
+  def _build_fuzzy_index(self, kwargs):
+    """ Callback to rebuild the fuzzy name index from the user's playlists, saved library and play history """
+    if not self.sp:
+      self.log('Spotify is not initialized, skipping fuzzy index build.', level=self.DEBUG_LEVEL)
+      return
+
+    index = FuzzyNameIndex()
+    with self._trace('fuzzy_index.build'):
+      try:
+        results = self.sp.current_user_playlists(limit=50)
+        while results:
+          for pl in results['items']:
+            index.add('playlist', pl['name'], pl['uri'])
+          results = self.sp.next(results) if results['next'] else None
+      except (spotipy.client.SpotifyException, requests.exceptions.RequestException) as e:
+        self.log('Failed to index playlist names: {}'.format(e), level='WARNING')
+
+      if self._library and self._library.synced:
+        for kind, entries in self._library.named_entries().items():
+          for uri, name, artist_name, artist_uri in entries:
+            index.add(kind, name, uri, artist_name, artist_uri)
+      else:
+        try:
+          self._index_track_items(index, self.sp.current_user_saved_tracks(limit=50)['items'])
+        except (spotipy.client.SpotifyException, requests.exceptions.RequestException) as e:
+          self.log('Failed to index saved track names: {}'.format(e), level='WARNING')
+
+      try:
+        self._index_track_items(index, self.sp.current_user_recently_played(limit=50)['items'])
+      except (spotipy.client.SpotifyException, requests.exceptions.RequestException) as e:
+        self.log('Failed to index recently played names: {}'.format(e), level='WARNING')
+
+    # Keep the names learned from searches since the last build
+    index.merge(self._fuzzy_index)
+    self._fuzzy_index = index
+    self.log('Fuzzy name index built with {} names.'.format(len(index)), level=self.DEBUG_LEVEL)
+
+
+  def _index_track_items(self, index, items):
+    """ 
+    Add the track, artist and album names of saved/recently played items to the fuzzy index
+
+    param index: FuzzyNameIndex to add to
+    param items: Spotify items containing a 'track' object
+    """
+    for item in items:
+      track = item.get('track')
+      if not track:
+        continue
+      artists = track.get('artists') or [{}]
+      index.add('track', track['name'], track['uri'], artists[0].get('name'), artists[0].get('uri'))
+      for artist in track.get('artists', []):
+        index.add('artist', artist['name'], artist['uri'])
+      album = track.get('album')
+      if album:
+        index.add('album', album['name'], album['uri'], artists[0].get('name'), artists[0].get('uri'))
+
+
+  def _fuzzy_lookup(self, kind, name, artist=None):
+    """ 
+    Returns the uri matching the name from the fuzzy index or None when there is no confident match
+
+    param kind: The uri type ('track', 'playlist', 'artist', 'album')
+    param name: The (possibly misspelled or partial) name to look for
+    param artist: Artist uri or name the result should belong to (optional)
+    """
+    if self._fuzzy_index is None or not isinstance(name, str):
+      return None
+    uri, matched_name, score = self._fuzzy_index.lookup(kind, name, artist)
+    if uri and score >= self._fuzzy_threshold:
+      self.log('Fuzzy matched {} "{}" to "{}" (confidence {:.2f}).'.format(kind, name, matched_name, score), level=self.DEBUG_LEVEL)
+      return uri
+    return None
+
+
+  def _remember_name(self, kind, name, uri, artist_name=None, artist_uri=None):
+    """ Add a name resolved through the Spotify API to the fuzzy index """
+    if self._fuzzy_index is not None:
+      self._fuzzy_index.add(kind, name, uri, artist_name, artist_uri)
 
 
-  def _initialize_spotify_client(self):
-    """ Refresh the Spotify client instance """
-    access_token, expires = self._get_spotify_token(self._username, self._password)
+  def _initialize_spotify_client(self, access_token=None, expires_at=None):
+    """ 
+    Refresh the Spotify client instance
+
+    param access_token: Saved access token to use instead of logging in
+    param expires_at: Time (epoch seconds) the saved access token expires
+    """
+    if access_token is None and self._shared_cache is not None:
+      access_token, expires_at = self._get_shared_token()
+    elif access_token is None:
+      access_token, expires = self._get_spotify_token(self._username, self._password)
+      expires_at = time.time() + expires if access_token else None
     self._access_token = access_token
-    self._token_expires = expires
+    self._token_expires_at = expires_at
+
+    if access_token:
+      self._save_token()
 
     if not access_token:
       self.log('Did not retrieve access token information for Spotify. SPOTIFY IS NOT INITIALIZED!', level='WARNING')
     else:
       self.log('Spotify client successfully initialized.', level=self.DEBUG_LEVEL)
       self.sp = spotipy.Spotify(auth=access_token)
+      if self._http_cache is not None:
+        # Keep the retry settings of the spotipy session
+        retries = self.sp._session.get_adapter(AsyncSpotifyWebAPI.PREFIX).max_retries
+        self.sp._session.mount(AsyncSpotifyWebAPI.PREFIX, CachingHTTPAdapter(self._http_cache, self._username, max_retries=retries))
+      if self._breakers:
+        self.sp = GuardedSpotify(self.sp, self._breakers)
+      if self._tracer:
+        self.sp = TracedSpotify(self.sp, self._tracer)
+
+
+  def _get_shared_token(self):
+    """ 
+    Returns (access token, expiry time) from the shared cache, logging in only when no other instance renewed the token yet
+
+    The shared cache entry stays locked while logging in, instances renewing at the same time wait and reuse the new token
+    """
+    def renew(saved):
+      if saved and saved['expires_at'] - time.time() > TOKEN_RENEW_MARGIN:
+        self.log('Reusing the Spotify token renewed by another instance.', level=self.DEBUG_LEVEL)
+        return saved
+      access_token, expires = self._get_spotify_token(self._username, self._password)
+      if not access_token:
+        return None
+      return {'username': self._username, 'access_token': access_token, 'expires_at': time.time() + expires}
+
+    saved = self._shared_cache.update('token', self._username, renew, timeout=SHARED_CACHE_LOGIN_TIMEOUT)
+    if not saved:
+      return None, None
+    return saved['access_token'], saved['expires_at']
+
+
+  def _trace(self, name, **attrs):
+    """ 
+    Returns a context manager that records a new trace (or a child span if a trace is already active)
+
+    param name: Name of the root span
+    param attrs: Extra attributes to record with the span
+    """
+    if self._tracer is None:
+      return contextlib.nullcontext()
+    return self._tracer.span(name, root=True, **attrs)
+
+
+  def _span(self, name, **attrs):
+    """ 
+    Returns a context manager that records a span in the active trace (no-op when tracing is disabled)
+
+    param name: Name of the span
+    param attrs: Extra attributes to record with the span
+    """
+    if self._tracer is None:
+      return contextlib.nullcontext()
+    return self._tracer.span(name, **attrs)
+
+
+  def _current_trace_id(self):
+    """ Returns the id of the active trace or None """
+    if self._tracer is None:
+      return None
+    return self._tracer.current_trace_id()
 
 
   def _get_spotify_token(self, username, password):
@@ -172,6 +1095,8 @@ class SpotifyClient(hass.Hass):
     response.raise_for_status()
     data = response.content.decode("utf-8")
 
+    # bs4/lxml are only needed here, import them on first use
+    from bs4 import BeautifulSoup
     xml_tree = BeautifulSoup(data, 'lxml')
     script_node = xml_tree.find("script", id="config")
     config = json.loads(script_node.string)
@@ -229,33 +1154,38 @@ class SpotifyClient(hass.Hass):
 
 
   def get_spotify_uri_type(self, uri):
-    """ Returns the type of the Spotify uri (ex: artist, playlist, track, album, etc) """
-    parts = uri.split(':')
-    if len(parts) < 3:
+    """ Returns the type of the Spotify uri (ex: artist, playlist, track, album) """
+    parsed = SpotifyURI.parse(uri)
+    if parsed is None:
       self.log('Invalid Spotify uri: {}.'.format(uri), level='WARNING')
       return ''
-    return parts[-2]
+    return parsed.type
 
 
   def is_spotify_uri(self, uri, media_type=None):
     """ 
     Verify if the uri is a valid Spotify uri
 
-    param uri: Spotify uri (Format: spotify:(track|playlist|artist|album):twenty-two-digits-here)
+    param uri: Spotify uri (Format: spotify:(track|playlist|artist|album):twenty-two-digits-here) or open.spotify.com url
     param media_type: The uri type ('track', 'playlist', 'artist', 'album') to check for
     """
-    if not uri or not isinstance(uri, str):
-      return False
+    return SpotifyURI.parse(uri, media_type) is not None
 
-    if isinstance(media_type, str):
-      media_type = [media_type]
-    elif not media_type:
-      media_type = ['track', 'playlist', 'artist', 'album']
 
-    parts = uri.split(':')
-    if len(parts) == 3 and parts[0] == 'spotify' and parts[1] in media_type and len(parts[2]) == 22:
-      return True
-    return False
+  def to_spotify_uri(self, uri, media_type=None):
+    """ 
+    Returns the 'spotify:<type>:<id>' uri (or list of uri's) of a uri/url (or list of them), None if any is invalid
+
+    Lists are validated in a single pass
+
+    param uri: Spotify uri/open.spotify.com url or a list of them
+    param media_type: The uri type ('track', 'playlist', 'artist', 'album') every uri must have
+    """
+    if isinstance(uri, list):
+      parsed = SpotifyURI.parse_many(uri, media_type)
+      return [p.uri for p in parsed] if parsed is not None else None
+    parsed = SpotifyURI.parse(uri, media_type)
+    return parsed.uri if parsed is not None else None
 
   def is_artist_uri(self, uri):
     """ Test if the given uri is a valid Spotify artist uri """
@@ -278,7 +1208,9 @@ class SpotifyClient(hass.Hass):
 
   def transfer_playback_timer_callback(self, kwargs):
     """ Callback for scheduler calls to call transfer_playback """
-    self.transfer_playback(kwargs['device'], kwargs.get('force_cc_update', False))
+    with self._use_account(kwargs.get('account', None)), \
+         self._trace('transfer_playback.retry', parent_trace=kwargs.get('parent_trace'), attempt=self._transfer_retry_count):
+      self.transfer_playback(kwargs['device'], kwargs.get('force_cc_update', False))
 
 
   def transfer_playback(self, device, force_cc_update=False):
@@ -299,10 +1231,14 @@ class SpotifyClient(hass.Hass):
       
     # No Spotify device was found or playback wasn't transfered correctly, retry if below limit
     if not success or dev_id is None: 
-      if self._transfer_retry_count < MAX_TRANSFER_ATTEMPTS:
+      if self._circuit_open('player'):
+        self.log('The Spotify player API is unavailable, not retrying to transfer playback to: "{}".'.format(device_name), level='WARNING')
+      elif self._transfer_retry_count < MAX_TRANSFER_ATTEMPTS:
         self.log('Retrying transfering playback now...', level=self.DEBUG_LEVEL)
         self._transfer_retry_count += 1
-        self.run_in(self.transfer_playback_timer_callback, 2, device=device, force_cc_update=True)
+        with self._span('transfer_playback.schedule_retry', attempt=self._transfer_retry_count, delay=2):
+          self.run_in(self.transfer_playback_timer_callback, 2, device=device, force_cc_update=True, parent_trace=self._current_trace_id(), 
+                      account=self._username)
         return
       else:
         self.log('Max retries reached trying to transfer playback to: "{}".'.format(device_name), level='ERROR')
@@ -310,6 +1246,7 @@ class SpotifyClient(hass.Hass):
     self._transfer_retry_count = 0
 
 
+  @_traced('transfer_playback.transfer')
   def _transfer_playback(self, spotify_device_id, force_play=True):
     """ 
     Transfer Spotify music to another device
@@ -330,56 +1267,93 @@ class SpotifyClient(hass.Hass):
 
   def play_timer_callback(self, kwargs):
     """ Callback for scheduler calls to call play """
-    self.play(kwargs['device'], kwargs['uri'], kwargs.get('off_set', None), kwargs.get('force_cc_update', False))
+    with self._use_account(kwargs.get('account', None)), \
+         self._trace('play.retry', parent_trace=kwargs.get('parent_trace'), attempt=self._play_retry_count):
+      self.play(kwargs['device'], kwargs['uri'], kwargs.get('off_set', None), kwargs.get('force_cc_update', False), kwargs.get('position_ms', None),
+                kwargs.get('shuffle', None), kwargs.get('repeat', None))
 
 
-  def play(self, device, uri, offset=None, force_cc_update=False):
+  def play(self, device, uri, offset=None, force_cc_update=False, position_ms=None, shuffle=None, repeat=None):
     """ 
     Top level call to play Spotify song
 
+    Returns True when playback started, a failed play is retried later (shuffle and repeat are then set by the retry)
+
     param device: Spotify device name/media_player id/Spotify device id
     param uri: Spotify track/playlist/artist/album uri/list of tracks
     param offset: Provide offset as an int or track uri to start playback at a particular offset.
     param force_cc_update: Force a chromecast update
+    param position_ms: Position in the starting track to start playback at (milliseconds)
+    param shuffle: Shuffle state to set once playback started (optional)
+    param repeat: Repeat state to set once playback started (optional)
     """
     device_name = self.map_chromecasts(device)
 
-    # Only a single uri or a list of tracks can be played
-    if isinstance(uri, list):
-      for u in uri:
-        if not self.is_track_uri(u):
-          self.log("Invalid list of Spotify uri's, the song will not play. Only a list of tracks can be played.".format(uri), level='WARNING')
-          return
-    elif not self.is_spotify_uri(uri):
-      self.log('Invalid Spotify uri: "{}", the song will not play.'.format(uri), level='WARNING')
-      return
+    uri = self._playable_uri(uri)
+    if uri is None:
+      return False
 
     dev_id = self._get_spotify_device_devid(device_name, force_cc_update)
 
     success = False
     if dev_id:
       self._last_device = device_name
-      success = self._play(dev_id, uri, offset)
+      success = self._play(dev_id, uri, offset, position_ms)
 
     if not success or dev_id is None:
-      if self._play_retry_count < MAX_PLAY_ATTEMPTS:
+      if self._circuit_open('player'):
+        self.log('The Spotify player API is unavailable, not retrying to play Spotify music on: "{}".'.format(device_name), level='WARNING')
+      elif self._play_retry_count < MAX_PLAY_ATTEMPTS:
         self.log('Retrying playing Spotify music now...', level=self.DEBUG_LEVEL)
         self._play_retry_count += 1
-        self.run_in(self.play_timer_callback, 1, device=device_name, uri=uri, off_set=offset, force_cc_update=True)
-        return
+        with self._span('play.schedule_retry', attempt=self._play_retry_count, delay=1):
+          self.run_in(self.play_timer_callback, 1, device=device_name, uri=uri, off_set=offset, force_cc_update=True, 
+                      position_ms=position_ms, shuffle=shuffle, repeat=repeat, parent_trace=self._current_trace_id(), 
+                      account=self._username)
+        return False
       else:
         self.log('Max retries reached trying to play Spotify music on: "{}". No music will play.'.format(device_name), level='ERROR')
 
     self._play_retry_count = 0
+    if not success:
+      return False
+
+    # Only change the play modes of the device and music that actually started
+    if shuffle is not None:
+      self.shuffle(shuffle, device_name)
+    if repeat is not None:
+      self.repeat(repeat, device_name)
+    return True
 
 
-  def _play(self, spotify_device_id, uri, offset=None):
+  def _playable_uri(self, uri):
     """ 
-    Play music on Spotify device using valid spotify uri (track, playlist, artist, album) and device id 
+    Returns the uri or list of tracks in the form _play accepts, None (logged) when it cannot be played
 
-    param spotify_device_id: Spotify device id
-    param uri: A valid Spotify uri
-    param offset: Provide offset as an int or track uri to start playback at a particular position. (Works for playlist/album/list of tracks)
+    param uri: Spotify track/playlist/artist/album uri/list of tracks
+    """
+    # Only a single uri or a list of tracks can be played
+    if isinstance(uri, TrackCollection):
+      # Only valid track ids can be added to a collection
+      return uri
+    if isinstance(uri, list):
+      spotify_uri = self.to_spotify_uri(uri, 'track')
+      if spotify_uri is None:
+        self.log("Invalid list of Spotify uri's, the song will not play. Only a list of tracks can be played.", level='WARNING')
+      return spotify_uri
+    spotify_uri = self.to_spotify_uri(uri)
+    if spotify_uri is None:
+      self.log('Invalid Spotify uri: "{}", the song will not play.'.format(uri), level='WARNING')
+    return spotify_uri
+
+
+  def _start_playback_args(self, uri, offset=None):
+    """ 
+    Returns the start_playback keyword arguments for a uri checked by _playable_uri and the ChunkedTrackList
+    to follow afterwards (None unless a long list of tracks is played)
+
+    param uri: A valid Spotify uri or list of tracks
+    param offset: Offset as an int or track uri to start playback at
     """
     # Offset format: {“position”: <int>} or {“uri”: “<track uri>”}
     if isinstance(offset, int):
@@ -389,25 +1363,110 @@ class SpotifyClient(hass.Hass):
     else:
       o = offset
 
+    if isinstance(uri, str) and self.is_track_uri(uri):
+      return {'uris': [uri], 'offset': o}, None
+    if isinstance(uri, (list, TrackCollection)):
+      uris, o, chunks = self._split_track_list(uri, o)
+      return {'uris': uris, 'offset': o}, chunks
+    return {'context_uri': uri, 'offset': o}, None
+
+
+  @_traced('play.start_playback')
+  def _play(self, spotify_device_id, uri, offset=None, position_ms=None):
+    """ 
+    Play music on Spotify device using valid spotify uri (track, playlist, artist, album) and device id 
+
+    param spotify_device_id: Spotify device id
+    param uri: A valid Spotify uri
+    param offset: Provide offset as an int or track uri to start playback at a particular position. (Works for playlist/album/list of tracks)
+    param position_ms: Position in the starting track to start playback at (milliseconds)
+    """
     device_name = self._map_spotify_devid_to_name(spotify_device_id) or spotify_device_id
+    # Stop following the chunks of a previous play
+    self._play_id += 1
+    # play() only passes track lists and valid uri's
+    args, chunks = self._start_playback_args(uri, offset)
     try:
-      if isinstance(uri, str) and uri.find('track') > 0:
-        self.sp.start_playback(device_id=spotify_device_id, uris=[uri], offset=o)
-      elif isinstance(uri, list) and uri[0].find('track') > 0:
-        self.sp.start_playback(device_id=spotify_device_id, uris=uri, offset=o)
-      else:
-        self.sp.start_playback(device_id=spotify_device_id, context_uri=uri, offset=o)
+      self.sp.start_playback(device_id=spotify_device_id, position_ms=position_ms, **args)
       # Save last played uri for potentially restoring list of tracks playback later
       self._snapshot_uri = uri
       # Log the appropriate messages based on uri type
       self._log_playback_action(uri, device_name)
+      self._wake_playback_poller()
     except spotipy.client.SpotifyException as e:
       # This can occur when a cached device is used that has been reconnected/dropped/disconnected from Spotify
       self.log('Error playing music on Spotify device ("{}"): {}'.format(device_name, e), level='ERROR')
       return False
+
+    if chunks is not None:
+      self.log('Playing the list of {} tracks in chunks of {}.'.format(len(chunks), chunks.size), level=self.DEBUG_LEVEL)
+      self.run_in(self._next_chunk_callback, CHUNK_CHECK_DELAY, play_id=self._play_id, device_id=spotify_device_id, chunks=chunks, 
+                  account=self._username)
     return True
 
 
+  def _split_track_list(self, uris, offset):
+    """ 
+    Split a long list of tracks into chunks that are played one after the other
+
+    Starting with a chunk keeps the request small so the time to first audio doesn't depend on the
+    length of the list. The chunk that contains the offset track is played from it, the offset is
+    converted to a position in the chunk.
+    Returns (tracks to play, offset to play with, ChunkedTrackList to follow or None)
+
+    param uris: List or TrackCollection of track uris
+    param offset: Offset dictionary ({'position': <int>} or {'uri': <track uri>}) or None
+    """
+    chunk = self._play_chunk_size
+    if not chunk or len(uris) <= chunk:
+      return list(uris), offset, None
+
+    start = 0
+    if offset and 'position' in offset:
+      start = offset['position']
+    elif offset and offset.get('uri') in uris:
+      start = uris.index(offset['uri'])
+    if not 0 <= start < len(uris):
+      start = 0
+    chunks = ChunkedTrackList(uris, chunk, start)
+    return chunks.chunk(), {'position': chunks.offset}, chunks
+
+
+  def _next_chunk_callback(self, kwargs):
+    """ Callback following the playback of a long list of tracks, the next chunk is played when the one playing ends """
+    chunks = kwargs['chunks']
+    with self._use_account(kwargs.get('account', None)):
+      if kwargs['play_id'] != self._play_id:
+        # Something else was played with the account since
+        return
+      with self._trace('play.next_chunk', remaining=chunks.remaining()):
+        delay = self._next_chunk(kwargs['device_id'], chunks)
+    if delay is not None:
+      self.run_in(self._next_chunk_callback, delay, **kwargs)
+
+
+  def _next_chunk(self, spotify_device_id, chunks):
+    """ 
+    Check the playback of the chunks and play the next chunk when the one playing ends, returns the
+    seconds until the next check or None to stop following the chunks
+
+    param spotify_device_id: Spotify device id
+    param chunks: ChunkedTrackList being played
+    """
+    delay = chunks.check(self.get_playback_info())
+    if delay == 0:
+      try:
+        self.sp.start_playback(device_id=spotify_device_id, uris=chunks.next_chunk())
+      except spotipy.client.SpotifyException as e:
+        self.log('Failed to play the next chunk, {} tracks will not play: {}'.format(chunks.remaining(), e), level='WARNING')
+        return None
+      self._wake_playback_poller()
+      delay = CHUNK_CHECK_DELAY
+    return delay
+
+
+
+  @_traced('device.resolve')
   def _get_spotify_device_devid(self, device_name, force_cc_update=False):
     """
     Get Spotify device id from the device name
@@ -416,17 +1475,16 @@ class SpotifyClient(hass.Hass):
 
     param device_name: Spotify device name
     """
-    # Check if Spotify is already connected to the device if device is not a CC or no CC update required
+    # Check if Spotify is already connected to the device if device is not a CC or Spotify is still running on the CC
     dev_id = None
-    is_cc_device = self._get_chromcast_device(device_name) is not None
-    if not is_cc_device:
-      self._last_cast_sc = None
-    if not force_cc_update and (not is_cc_device or (is_cc_device and self._last_cast_sc)):
+    cast_device = self._get_cast_device(device_name, force_cc_update)
+    is_cc_device = cast_device is not None
+    if not force_cc_update and (not is_cc_device or cast_device.spotify_ready(self._access_token)):
       dev_id = self._search_spotify_for_device(device_name)
 
     # We don't already have the device, look for a chromecast
     if dev_id is None and is_cc_device:
-      if not self._register_spotify_on_cast_device(device_name):
+      if not self._register_spotify_on_cast_device(device_name, force_cc_update):
         # Failed to connect Spotify to Chromecast
         return None
 
@@ -436,6 +1494,7 @@ class SpotifyClient(hass.Hass):
     return dev_id
 
 
+  @_traced('device.search')
   def _search_spotify_for_device(self, device_name):
     """ 
     Returns the Spotify device id given the name
@@ -446,29 +1505,39 @@ class SpotifyClient(hass.Hass):
     if device_name in self._spotify_devices:
       # self.log('Cached Spotify device used.', level=self.DEBUG_LEVEL)
       return self._spotify_devices[device_name]
+    elif self._load_shared_device(device_name):
+      return self._spotify_devices[device_name]
     else:
       devs = self.sp.devices()
       for d in devs['devices']:
         if d['name'] == device_name:
           # self.log('Newly discovered Spotify device used.', level=self.DEBUG_LEVEL)
           self._spotify_devices[device_name] = d['id']
+          self._save_device_registry()
           return d['id']
 
     return None
 
 
-  def _get_chromcast_device(self, device_name):
+  @_traced('cast.get_device')
+  def _get_chromcast_device(self, device_name, force_discovery=False):
     """
     Returns the chromecast device object that matches the device_name
     Uses CastDevice class to listen to the cast connection and let us know when an update is needed
 
     param device_name: The chromecast device name
+    param force_discovery: Discover the casts even if the device is a known Spotify Connect device
     """
-    for cast in self._chromecasts.values():
+    for cast in list(self._chromecasts.values()):
       if device_name == cast.name:
         if cast.available:
           # self.log('Cached chromecast device used.', level=self.DEBUG_LEVEL)
           return cast.get_cast()
+        elif self._cast_monitor:
+          # Don't hold up the request, the monitor is reconnecting the cast in the background
+          self.log('Chromecast "{}" is unavailable, it is being reconnected in the background.'.format(cast.name), level='WARNING')
+          self._cast_monitor.wake()
+          return None
         else:
           # Attempt to reconnect the unavailable cast
           self.log('Attempting to reset cast connection for: {}'.format(cast.name), level=self.DEBUG_LEVEL)
@@ -476,38 +1545,123 @@ class SpotifyClient(hass.Hass):
           if cast.available:
             return cast.get_cast()
 
+    if not force_discovery and self._is_connect_device(device_name):
+      # Spotify Connect devices are played to without pychromecast
+      return None
+
+    # Another instance sharing the cache may have found the cast already
+    info = self._shared_cast_info(device_name)
+    if info is not None and uuid.UUID(info['uuid']) not in self._chromecasts:
+      cast = self._connect_known_cast(info)
+      if cast is not None:
+        return cast.get_cast()
+
     # We have not discovered the cast yet or the reconnection attempt failed
-    chromecasts = pychromecast.get_chromecasts(tries=5, retry_wait=1, timeout=30)
+    with self._span('cast.discovery'):
+      chromecasts = pychromecast.get_chromecasts(tries=5, retry_wait=1, timeout=30)
+
+    self._add_discovered_casts(chromecasts)
+    chromecast = next((cast for cast in chromecasts if cast.name == device_name), None)
+    if chromecast is not None:
+      with self._cast_lock:
+        self._connect_devices.discard(device_name)
+    elif self._search_spotify_for_device(device_name):
+      # Spotify knows the device but it is not a cast, the next plays don't need discovery
+      self.log('"{}" is a Spotify Connect device, it will not be discovered again.'.format(device_name), level=self.DEBUG_LEVEL)
+      with self._cast_lock:
+        self._connect_devices.add(device_name)
+      self._save_device_registry()
+    return chromecast
+
+
+  def _is_connect_device(self, device_name):
+    """ 
+    Returns True if the device is a known Spotify Connect device that is not a Chromecast, discovery can be skipped for it
 
-    _cast = None
-    for cast in chromecasts:
-      if cast.name == device_name:
-          _cast = cast
+    Only discovery records Spotify Connect devices. Saved Spotify devices that are not saved Chromecasts
+    are guessed to be Spotify Connect devices for CONNECT_DEVICE_GUESS_TTL seconds (a cast is not known
+    to Spotify before Spotify was launched on it through discovery), the guess is not saved
 
-      if cast.uuid not in self._chromecasts:
-        # self.log('Found a new Chromecast device: {}'.format(cast.name), level=self.DEBUG_LEVEL)
-        c = CastDevice(cast, self, self.DEBUG_LEVEL)
-        self._chromecasts[c.uuid] = c
-      else:
-        # Try to update an existing CastDevice that is disconnected or failed
-        if not self._chromecasts[cast.uuid].available:
-          self.log('Updated existing CastDevice: {}'.format(self._chromecasts[cast.uuid].name), level=self.DEBUG_LEVEL)
-          self._chromecasts[cast.uuid].set_cast(cast)
+    param device_name: The device name
+    """
+    if device_name in self._connect_devices:
+      return True
+    guessed_at = self._connect_guesses.pop(device_name, None)
+    if guessed_at is not None:
+      if time.monotonic() - guessed_at < CONNECT_DEVICE_GUESS_TTL:
+        self._connect_guesses[device_name] = guessed_at
+        return True
+      # The guess expired, discovery checks it
+      return False
+    if any(info['friendly_name'] == device_name for info in list(self._known_casts.values())):
+      return False
+    if self._shared_cast_info(device_name) is not None:
+      return False
+    if device_name in self._spotify_devices or self._load_shared_device(device_name):
+      self.log('"{}" is a saved Spotify device but not a saved Chromecast, it is not discovered for now.'.format(device_name), level=self.DEBUG_LEVEL)
+      self._connect_guesses[device_name] = time.monotonic()
+      return True
+    return False
 
-    return _cast
 
+  def _add_discovered_casts(self, chromecasts):
+    """
+    Add newly discovered chromecasts and update the disconnected ones
 
-  def _register_spotify_on_cast_device(self, cast_name):
-    """ 
-    Register Spotify app on a given chromecast device 
-    
-    param cast_name: Chromecast device name
+    param chromecasts: List of pychromecast.Chromecast from discovery
+    """
+    with self._cast_lock:
+      for cast in chromecasts:
+        if cast.uuid not in self._chromecasts:
+          # self.log('Found a new Chromecast device: {}'.format(cast.name), level=self.DEBUG_LEVEL)
+          c = CastDevice(cast, self, self.DEBUG_LEVEL, self._cast_reconnected, self._cast_unavailable)
+          self._chromecasts[c.uuid] = c
+        else:
+          # Try to update an existing CastDevice that is disconnected or failed
+          if not self._chromecasts[cast.uuid].available:
+            self.log('Updated existing CastDevice: {}'.format(self._chromecasts[cast.uuid].name), level=self.DEBUG_LEVEL)
+            self._chromecasts[cast.uuid].set_cast(cast)
+
+    # Save the discovered hosts so the next run can connect without discovery
+    self._save_device_registry()
+
+
+  def _get_cast_device(self, device_name, force_discovery=False):
+    """
+    Returns the CastDevice for the chromecast name or None if the device is not a chromecast
+
+    param device_name: The chromecast device name
+    param force_discovery: Discover the casts even if the device is a known Spotify Connect device
+    """
+    cast = self._get_chromcast_device(device_name, force_discovery)
+    if cast is None:
+      return None
+    return self._chromecasts.get(cast.uuid)
+
+
+  @_traced('cast.register_spotify')
+  def _register_spotify_on_cast_device(self, cast_name, force=False):
+    """ 
+    Register Spotify app on a given chromecast device 
+
+    Each cast keeps its own SpotifyController, Spotify is only launched again when the receiver
+    is no longer running or it was launched with an old token
+    
+    param cast_name: Chromecast device name
+    param force: Launch Spotify even if it is still running
     """
     # Get the chromecast object
-    cast = self._get_chromcast_device(cast_name)
-    if not cast:
+    cast_device = self._get_cast_device(cast_name)
+    if not cast_device:
       self.log('No chromecast device was found with the name: "{}".'.format(cast_name), level='WARNING')
       return False
+    if not force and cast_device.spotify_ready(self._access_token):
+      return True
+
+    cast = cast_device.get_cast()
+    if cast is None:
+      self.log('Chromecast "{}" is not connected.'.format(cast_name), level='WARNING')
+      return False
     try:
       cast.wait(timeout=3)
     except RuntimeError as e:
@@ -515,9 +1669,7 @@ class SpotifyClient(hass.Hass):
       self.log('Chromecast threading error while waiting for "{}": {}.'.format(cast_name, e), level='ERROR')
       return False 
 
-    cast_sc = SpotifyController(self._access_token, self._token_expires)
-    self._last_cast_sc = cast_sc
-    cast.register_handler(cast_sc)
+    cast_sc = cast_device.get_spotify_controller(self._access_token, self._token_lifetime())
     try:
       cast_sc.launch_app(timeout=10)
     except pychromecast.error.LaunchError as e:
@@ -538,6 +1690,9 @@ class SpotifyClient(hass.Hass):
       self.log('Failed to launch spotify controller due to credentials error on "{}".'.format(cast_name), level='ERROR')
       return False
 
+    cast_device.spotify_launched(self._access_token)
+    # The Spotify device id can change when the receiver is relaunched
+    self._spotify_devices.pop(cast_name, None)
     return True
 
 
@@ -553,8 +1708,7 @@ class SpotifyClient(hass.Hass):
         track = self.get_track_info(uri)
         self.log('Playing: "{}" by "{}" on "{}" speaker.'.format(track['name'], track['artist'], device), level=self.DEBUG_LEVEL)
       elif self.is_playlist_uri(uri):
-        pl = self.get_playlist_info(uri)
-        self.log('Playing playlist named: "{}" on "{}" speaker.'.format(pl['name'], device), level=self.DEBUG_LEVEL)
+        self.log('Playing playlist named: "{}" on "{}" speaker.'.format(self.get_playlist_name(uri), device), level=self.DEBUG_LEVEL)
       elif self.is_artist_uri(uri):
         artist = self.get_artist_info(uri)
         self.log('Playing music from artist: "{}" on "{}" speaker.'.format(artist['name'], device), level=self.DEBUG_LEVEL)
@@ -579,14 +1733,28 @@ class SpotifyClient(hass.Hass):
     Event Data Parameters:
 
     Actions -> pause, stop, resume, next, previous, set_volume, 
-    increase_volume, decrease_volume, mute, snapshot, restore
+    increase_volume, decrease_volume, mute, snapshot, restore, profile
 
     device: The device to restore the playback on (optional)
 
+    snapshot_name: The snapshot slot to take/restore (optional)
+
     volume_level: Desired volume level (0 - 100)
 
     transfer_playback: The device name to transfer the music to
 
+    """
+    self._wait_until_ready()
+    with self._use_account(self._event_account(data)), self._trace(event_name, action=data.get('action', None)):
+      self._handle_controls_event(data)
+    self._wake_playback_poller()
+
+
+  def _handle_controls_event(self, data):
+    """
+    Perform the actions requested by the controls event
+
+    param data: Dictionary containing the controls event parameters (See the documentation)
     """
     action = data.get('action', None)
 
@@ -620,11 +1788,13 @@ class SpotifyClient(hass.Hass):
       self.set_volume(0)
     elif action == 'snapshot':
       self.log('Taking a snapshot of the current playback.', level=self.DEBUG_LEVEL)
-      self.take_playback_snapshot()
+      self.take_playback_snapshot(data.get('snapshot_name', DEFAULT_SNAPSHOT_NAME))
     elif action == 'restore':
       self.log('Resuming playback from the previous snapshot.', level=self.DEBUG_LEVEL)
       device = data.get('device', None)
-      self.restore_playback_from_snapshot(device)
+      self.restore_playback_from_snapshot(device, data.get('snapshot_name', DEFAULT_SNAPSHOT_NAME))
+    elif action == 'profile':
+      self.profile(data.get('command', 'start'), data.get('duration', None))
 
     if 'volume_level' in data:
       volume_level = data.get('volume_level', None)
@@ -640,17 +1810,106 @@ class SpotifyClient(hass.Hass):
       self.transfer_playback(device)
 
 
+  def profile(self, command='start', duration=None):
+    """ 
+    Look inside the running app: sample the stacks of the threads running its code or compare its memory allocations
+
+    Results are written to the profile folder. Nothing runs until a profile is started or a memory snapshot is taken.
+
+    param command: 'start' the sampling profiler, 'stop' it (and the memory tracing) and write the results, 
+                   'memory' take a memory snapshot and write what grew since the previous one
+    param duration: Seconds after which a started profile stops and writes its results (default: PROFILE_MAX_DURATION)
+    """
+    with self._profile_lock:
+      if command == 'start':
+        self._start_profile(duration)
+      elif command == 'stop':
+        self._stop_profile()
+      elif command == 'memory':
+        self._snapshot_memory()
+      else:
+        self.log('Invalid profile command: "{}", choose one of "start", "stop", "memory".'.format(command), level='WARNING')
+
+
+  def _start_profile(self, duration):
+    """ Start the sampling profiler, must be called with the profile lock held """
+    if self._profiler is not None:
+      self.log('A profile is already running, stop it first.', level='WARNING')
+      return
+    try:
+      duration = min(float(duration), PROFILE_MAX_DURATION) if duration else PROFILE_MAX_DURATION
+    except (TypeError, ValueError):
+      self.log('Invalid profile duration: "{}", please specify a number of seconds.'.format(duration), level='WARNING')
+      return
+    self._profiler = SamplingProfiler(PROFILE_SAMPLE_INTERVAL)
+    self._profiler.start()
+    self._profile_timer = self.run_in(self._stop_profile_callback, max(1, int(duration)))
+    self.log('Profiling for {}s (or until the "stop" profile command).'.format(int(duration)), level='INFO')
+
+
+  def _stop_profile_callback(self, kwargs):
+    """ Callback to stop a profile that ran for its duration """
+    with self._profile_lock:
+      # The timer that called us has fired
+      self._profile_timer = None
+      self._stop_profile()
+
+
+  def _stop_profile(self):
+    """ Stop the sampling profiler and the memory tracing, the profile is written to disk. Must be called with the profile lock held """
+    if self._profile_timer is not None:
+      self.cancel_timer(self._profile_timer)
+      self._profile_timer = None
+    if self._profiler is None and self._memory_snapshots is None:
+      self.log('No profile is running.', level='WARNING')
+      return
+
+    if self._profiler is not None:
+      profiler, self._profiler = self._profiler, None
+      profiler.stop()
+      try:
+        path = self._profile_path('profile')
+        profiler.write(path)
+        self.log('Profile of {} samples written to "{}.txt" (summary) and "{}.collapsed" (flame graph stacks).'.format(
+                 profiler.samples, path, path), level='INFO')
+      except OSError as e:
+        self.log('Failed to write the profile to "{}": {}'.format(self._profile_dir, e), level='WARNING')
+
+    if self._memory_snapshots is not None:
+      self._memory_snapshots.stop()
+      self._memory_snapshots = None
+      self.log('Memory tracing stopped.', level='INFO')
+
+
+  def _snapshot_memory(self):
+    """ Take a memory snapshot and write the allocations that grew since the previous one, must be called with the profile lock held """
+    first = self._memory_snapshots is None
+    if first:
+      # Only the allocations made from now on are traced
+      self._memory_snapshots = MemorySnapshots(MEMORY_TRACE_FRAMES)
+    try:
+      path = self._profile_path('memory') + '.txt'
+      traced, growth = self._memory_snapshots.take(path)
+    except OSError as e:
+      self.log('Failed to write the memory snapshot to "{}": {}'.format(self._profile_dir, e), level='WARNING')
+      return
+    if first:
+      self.log('Memory tracing started, take another memory snapshot to see what grew. Snapshot written to "{}".'.format(path), level='INFO')
+    else:
+      self.log('Memory snapshot written to "{}" ({:.1f} MB traced, {:+.1f} MB since the previous snapshot).'.format(
+               path, traced / 1048576, growth / 1048576), level='INFO')
+
+
+  def _profile_path(self, kind):
+    """ Returns the path (without extension) of a new profile or memory report """
+    os.makedirs(self._profile_dir, exist_ok=True)
+    return os.path.join(self._profile_dir, '{}_{}'.format(kind, datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')))
+
+
   @property
   def is_active(self):
     """ Returns if Spotify has recently played music """
-    active = False
-    try:
-      active = self.sp.current_playback() is not None
-    except spotipy.client.SpotifyException:
-      # Needed to catch improper credentials error
-      pass
-
-    return active
+    return bool(self.get_playback_info())
 
 
   @property
@@ -719,16 +1978,151 @@ class SpotifyClient(hass.Hass):
 
 
   def get_playback_info(self):
-    """ Return the current playback info if Spotify is active """
-    playback_info = {}
-    if self.is_active:
-      try:
-        playback_info = self.sp.current_playback()
-      except:
-        pass
+    """ 
+    Return the current playback info if Spotify is active
+
+    With the playback sensor enabled, the info fetched by the poller is shared by all readers
+    """
+    cached = self._cached_playback()
+    if cached is not None:
+      return cached
+    return self._fetch_playback()
+
+
+  def _fetch_playback(self):
+    """ Fetch the playback info from Spotify (a single Web API call) and share it with the poller """
+    if self._circuit_open('player'):
+      # Serve what the cast or the last poll reported until Spotify is reachable again
+      return self._cast_playback_info() or self._playback or {}
+    if not self.sp:
+      return {}
+    try:
+      playback_info = self.sp.current_playback() or {}
+    except (spotipy.client.SpotifyException, requests.exceptions.RequestException):
+      # Needed to catch improper credentials error, the last playback info is kept
+      return {}
+    self._store_playback(playback_info)
+    if self._playback_sensor and playback_info and self._playback_poll_timer is None and self._account is self._main_account:
+      # Something started playing while the poller was stopped
+      self._schedule_playback_poll(playback_info)
+    return playback_info
+
+
+  def _store_playback(self, playback_info):
+    """ Keep the playback info for the readers and publish it when the playback sensor is enabled """
+    if self._account is not self._main_account:
+      # The poller and the sensor follow the main account
+      return
+    self._playback = playback_info
+    self._playback_fetched = time.monotonic()
+    if self._playback_sensor:
+      self._publish_playback(playback_info)
+
+
+  def _cached_playback(self):
+    """ 
+    Returns the playback info of the poller (progress advanced to now) or None if it must be fetched
+
+    The info is reused while the poller is running (it is never older than one poll interval)
+    or for PLAYBACK_CACHE_AGE seconds after the poller stopped
+    """
+    if not self._playback_sensor or self._playback is None or self._account is not self._main_account:
+      return None
+    age = time.monotonic() - self._playback_fetched
+    if self._playback_poll_timer is None and age > PLAYBACK_CACHE_AGE:
+      return None
+
+    playback_info = self._playback
+    if playback_info.get('is_playing') and playback_info.get('progress_ms') is not None:
+      playback_info = dict(playback_info)
+      progress = playback_info['progress_ms'] + int(age * 1000)
+      duration = (playback_info.get('item') or {}).get('duration_ms')
+      playback_info['progress_ms'] = min(progress, duration) if duration else progress
     return playback_info
 
 
+  def _poll_playback(self, kwargs):
+    """ Callback of the playback poller """
+    self._playback_poll_timer = None
+    with self._trace('playback.poll'):
+      playback_info = self._fetch_playback()
+    if self._playback_poll_timer is None:
+      self._schedule_playback_poll(playback_info)
+
+
+  def _playback_poll_interval(self, playback_info):
+    """ 
+    Returns the seconds until the next poll or None to stop polling
+
+    Polls right after the current track ends, slowly while paused and not at all when nothing is active
+
+    param playback_info: Playback info from Spotify
+    """
+    if not playback_info:
+      return None
+    if not playback_info.get('is_playing'):
+      return PLAYBACK_POLL_PAUSED
+    duration = (playback_info.get('item') or {}).get('duration_ms') or 0
+    remaining = (duration - (playback_info.get('progress_ms') or 0)) / 1000
+    return max(PLAYBACK_POLL_MIN, min(PLAYBACK_POLL_PLAYING, remaining + 1))
+
+
+  def _schedule_playback_poll(self, playback_info=None, delay=None):
+    """ 
+    (Re)schedule the next playback poll
+
+    param playback_info: Playback info used to pick the interval
+    param delay: Seconds until the next poll (instead of the interval for the playback info)
+    """
+    if delay is None:
+      delay = self._playback_poll_interval(playback_info)
+    with self._playback_lock:
+      if self._playback_poll_timer is not None:
+        self.cancel_timer(self._playback_poll_timer)
+        self._playback_poll_timer = None
+      if delay is None:
+        self.log('Nothing is playing on Spotify, the playback poller is stopped.', level=self.DEBUG_LEVEL)
+        return
+      self._playback_poll_timer = self.run_in(self._poll_playback, max(1, int(round(delay))))
+
+
+  def _wake_playback_poller(self):
+    """ Poll shortly after a play/control action, starting the poller if it was stopped """
+    if self._playback_sensor:
+      self._schedule_playback_poll(delay=PLAYBACK_POLL_AFTER_ACTION)
+
+
+  def _publish_playback(self, playback_info):
+    """ 
+    Publish the playback info as the playback sensor entity
+
+    param playback_info: Playback info from Spotify
+    """
+    if not playback_info:
+      state, attributes = 'off', {}
+    else:
+      item = playback_info.get('item') or {}
+      device = playback_info.get('device') or {}
+      state = 'playing' if playback_info.get('is_playing') else 'paused'
+      attributes = {
+        'track' : item.get('name'),
+        'artist' : ', '.join(a['name'] for a in item.get('artists', [])),
+        'album' : (item.get('album') or {}).get('name'),
+        'uri' : item.get('uri'),
+        'device' : device.get('name'),
+        'volume' : device.get('volume_percent'),
+        'progress_ms' : playback_info.get('progress_ms'),
+        'duration_ms' : item.get('duration_ms'),
+        'shuffle' : playback_info.get('shuffle_state'),
+        'repeat' : playback_info.get('repeat_state'),
+      }
+    attributes['friendly_name'] = 'Spotify playback'
+    try:
+      self.set_state(self._playback_entity, state=state, attributes=attributes)
+    except Exception as e:
+      self.log('Failed to publish the playback sensor: {}'.format(e), level='WARNING')
+
+
   def repeat(self, state, device=None):
     """
     Sets the Spotify device's repeat state
@@ -833,65 +2227,215 @@ class SpotifyClient(hass.Hass):
       self.sp.seek_track(position_ms, device_id)
 
 
-  def take_playback_snapshot(self):
+  def take_playback_snapshot(self, name=DEFAULT_SNAPSHOT_NAME):
     """ 
     Take snapshot to allow us to resume playback later with this information
+
+    Snapshots are saved to disk so they survive restarts
+
+    param name: Name of the snapshot slot, use different names to nest snapshots (ex: announcements)
     """
-    # Reset previous snapshot info
-    self._snapshot_info = {}
+    self._store_snapshot(name, self.get_playback_info())
+
+
+  def _store_snapshot(self, name, result):
+    """ 
+    Save a snapshot of the playback info in the slot
 
-    result = self.get_playback_info()
+    param name: Name of the snapshot slot
+    param result: The current playback info
+    """
     if not result:
+      # Reset previous snapshot info
+      self._snapshots.pop(name, None)
+      self._save_snapshots()
       self.log('Nothing is currently playling, no snapshot will be taken.', level='INFO')
       return
 
-    self._snapshot_info['device_id'] = result['device']['id']
-    self._snapshot_info['device_name'] = result['device']['name']
-    self._snapshot_info['shuffle_state'] = result['shuffle_state']
-    self._snapshot_info['repeat_state'] = result['repeat_state']
-    self._snapshot_info['currently_playing_type'] = result['currently_playing_type']
-    self._snapshot_info['currently_playing_uri'] = result.get('item', {}).get('uri', 'Could not find uri')
-    if result['context']:
-      self._snapshot_info['context'] = result.get('context', {}).get('uri', False)
-    self._snapshot_info['progress_ms'] = result['progress_ms']
+    # While the player API is unavailable the playback info reported by the cast has no device id,
+    # shuffle, repeat or context (they are not changed when the snapshot is restored)
+    snapshot = {}
+    snapshot['device_id'] = (result.get('device') or {}).get('id')
+    snapshot['device_name'] = (result.get('device') or {}).get('name')
+    snapshot['shuffle_state'] = result.get('shuffle_state')
+    snapshot['repeat_state'] = result.get('repeat_state')
+    snapshot['currently_playing_type'] = result.get('currently_playing_type', 'track')
+    snapshot['currently_playing_uri'] = (result.get('item') or {}).get('uri', 'Could not find uri')
+    if result.get('context'):
+      snapshot['context'] = result.get('context', {}).get('uri', False)
+    elif isinstance(self._snapshot_uri, (list, TrackCollection)) and snapshot['currently_playing_uri'] in self._snapshot_uri:
+      # A list of tracks is playing, the chunk of it that plays is saved to restore (a long list is not saved whole)
+      snapshot['uris'] = self._playing_chunk(self._snapshot_uri, snapshot['currently_playing_uri'])
+    snapshot['progress_ms'] = result.get('progress_ms', 0)
+    snapshot['timestamp'] = datetime.datetime.now().isoformat()
+
+    self._snapshots[name] = snapshot
+    self._save_snapshots()
+    self.log('Snapshot "{}" taken from: "{}".'.format(name, snapshot['device_name']), level=self.DEBUG_LEVEL)
+
+
+  def _playing_chunk(self, uris, uri):
+    """ 
+    Returns the tracks of the list played with the track, the chunk that contains it when the list is played in chunks
 
-    self.log('Snapshot taken from: "{}".'.format(self._snapshot_info['device_name']), level=self.DEBUG_LEVEL)
-    # self.pause()
+    param uris: List or TrackCollection of track uris
+    param uri: Track uri in the list
+    """
+    if not self._play_chunk_size or len(uris) <= self._play_chunk_size:
+      return list(uris)
+    return ChunkedTrackList(uris, self._play_chunk_size, uris.index(uri)).chunk()
 
 
-  def restore_playback_from_snapshot(self, device=None):
+  def restore_playback_from_snapshot(self, device=None, name=DEFAULT_SNAPSHOT_NAME):
     """ 
     Resume playback with the info from the previous snapshot
 
+    Playback is started at the snapshot position in a single call, shuffle and repeat are only
+    set when they differ from the current state and once playback has started (also when the play is retried)
+
     param device: Spotify device name to restore the playback on (optional)
+    param name: Name of the snapshot slot to restore
     """
-    if not self._snapshot_info:
-      self.log('Cannot restore playback since the previous snapshot did not capture anything.', level='WARNING')
+    snapshot = self._snapshots.get(name)
+    if not snapshot:
+      self.log('Cannot restore playback since the snapshot "{}" did not capture anything.'.format(name), level='WARNING')
       return
 
-    if self._snapshot_info.get('context', False): 
+    uri, offset = self._snapshot_music(snapshot)
+    dev = device if device else snapshot['device_name']
+
+    self.log('Restoring snapshot "{}" to: "{}".'.format(name, self.map_chromecasts(dev)), level=self.DEBUG_LEVEL)
+
+    shuffle, repeat = self._snapshot_play_modes(snapshot, self.get_playback_info())
+
+    # Resume playing at the track and position we left off at
+    self.play(dev, uri, offset, position_ms=snapshot['progress_ms'], shuffle=shuffle, repeat=repeat)
+
+
+  @staticmethod
+  def _snapshot_music(snapshot):
+    """ Returns the uri and offset to resume the music of a snapshot at """
+    if snapshot.get('context', False): 
       # A playlist, album, artist was previously playing
-      uri = self._snapshot_info['context']
-      offset = self._snapshot_info['currently_playing_uri']
-    else: 
-      if isinstance(self._snapshot_uri, list):
-        # A list of tracks was previously playing
-        uri = self._snapshot_uri
-        offset = self._snapshot_info['currently_playing_uri']
-      else:
-        # A single track was previously playing
-        uri = self._snapshot_info['currently_playing_uri']
-        offset = None
+      return snapshot['context'], snapshot['currently_playing_uri']
+    if snapshot.get('uris'):
+      # A list of tracks was previously playing
+      return snapshot['uris'], snapshot['currently_playing_uri']
+    # A single track was previously playing
+    return snapshot['currently_playing_uri'], None
+
+
+  @staticmethod
+  def _snapshot_play_modes(snapshot, current):
+    """ 
+    Returns the shuffle and repeat states to set when restoring a snapshot (None for the states that are unchanged)
+
+    param snapshot: The snapshot being restored
+    param current: The current playback info
+    """
+    current = current or {}
+    shuffle = snapshot['shuffle_state'] if current.get('shuffle_state', False) != snapshot['shuffle_state'] else None
+    repeat = snapshot['repeat_state'] if current.get('repeat_state', 'off') != snapshot['repeat_state'] else None
+    return shuffle, repeat
+
+
+  def _load_snapshots(self):
+    """ Load the snapshots saved by a previous run """
+    if not os.path.exists(self._snapshot_file):
+      return
+    try:
+      with open(self._snapshot_file) as f:
+        self._snapshots = json.load(f)
+      self.log('Loaded {} saved snapshots.'.format(len(self._snapshots)), level=self.DEBUG_LEVEL)
+    except (OSError, ValueError) as e:
+      self.log('Failed to load saved snapshots from "{}": {}'.format(self._snapshot_file, e), level='WARNING')
+
+
+  def _save_snapshots(self):
+    """ Save the snapshots to disk """
+    try:
+      tmp_file = self._snapshot_file + '.tmp'
+      with open(tmp_file, 'w') as f:
+        json.dump(self._snapshots, f)
+      os.replace(tmp_file, self._snapshot_file)
+    except OSError as e:
+      self.log('Failed to save snapshots to "{}": {}'.format(self._snapshot_file, e), level='WARNING')
+
+  def _load_device_registry(self):
+    """ Load the Chromecasts and Spotify device ids saved by a previous run (and by the instances sharing the cache) """
+    if os.path.exists(self._device_registry_file):
+      try:
+        with open(self._device_registry_file) as f:
+          registry = json.load(f)
+        with self._cast_lock:
+          self._known_casts.update(registry.get('casts', {}))
+          self._connect_devices.update(registry.get('connect_devices', []))
+        self._spotify_devices.update(registry.get('spotify_devices', {}))
+      except (OSError, ValueError, AttributeError) as e:
+        self.log('Failed to load saved devices from "{}": {}'.format(self._device_registry_file, e), level='WARNING')
+    if self._shared_cache is not None:
+      with self._cast_lock:
+        self._known_casts.update(self._shared_cache.get('devices', 'casts') or {})
+        self._connect_devices.update(self._shared_cache.get('devices', 'connect') or [])
+      for account in self._accounts.values():
+        account.spotify_devices.update(self._shared_cache.get('devices', account.username) or {})
+    if self._known_casts or self._spotify_devices:
+      self.log('Loaded {} saved Chromecasts and {} saved Spotify devices.'.format(len(self._known_casts), len(self._spotify_devices)), level=self.DEBUG_LEVEL)
+
+
+  def _shared_cast_info(self, cast_name):
+    """ 
+    Returns the info of a Chromecast saved by an instance sharing the cache, None if it is unknown
+
+    param cast_name: The chromecast device name
+    """
+    if self._shared_cache is None:
+      return None
+    casts = self._shared_cache.get('devices', 'casts') or {}
+    with self._cast_lock:
+      self._known_casts.update(casts)
+    return next((info for info in casts.values() if info['friendly_name'] == cast_name), None)
 
-    dev = device if device else self._snapshot_info['device_name']
 
-    self.log('Restoring snapshot to: "{}".'.format(self.map_chromecasts(dev)), level=self.DEBUG_LEVEL)
+  def _load_shared_device(self, device_name):
+    """ 
+    Returns True if an instance sharing the cache knows the Spotify device id, it is added to the cached devices
+
+    param device_name: The Spotify device name
+    """
+    if self._shared_cache is None:
+      return False
+    devices = self._shared_cache.get('devices', self._username) or {}
+    if device_name not in devices:
+      return False
+    self._spotify_devices[device_name] = devices[device_name]
+    return True
+
 
-    # Resume playing at the track we left off at
-    self.play(dev, uri, offset)
-    # Skip to the last position in the previously playing track
-    self.seek_track(self._snapshot_info['progress_ms'])
-    # self.run_in(lambda *_: self.seek_track(self._snapshot_info['progress_ms']), 0.1)
+  def _save_device_registry(self):
+    """ Save the known Chromecasts and Spotify device ids to disk """
+    # The devices are changed by other threads while the copies are written
+    with self._cast_lock:
+      for cast in self._chromecasts.values():
+        if cast.complete_info:
+          self._known_casts[str(cast.uuid)] = cast.cast_info()
+      known_casts = dict(self._known_casts)
+      connect_devices = set(self._connect_devices)
+      devices = dict(self._spotify_devices)
+      registry = {'casts': known_casts, 'spotify_devices': dict(self._main_account.spotify_devices), 
+                  'connect_devices': sorted(connect_devices)}
+    try:
+      tmp_file = self._device_registry_file + '.tmp'
+      with open(tmp_file, 'w') as f:
+        json.dump(registry, f)
+      os.replace(tmp_file, self._device_registry_file)
+    except OSError as e:
+      self.log('Failed to save devices to "{}": {}'.format(self._device_registry_file, e), level='WARNING')
+    if self._shared_cache is not None:
+      # Merge with what the other instances saved meanwhile
+      self._shared_cache.update('devices', 'casts', lambda casts: dict(casts or {}, **known_casts))
+      self._shared_cache.update('devices', 'connect', lambda names: sorted(set(names or []) | connect_devices))
+      self._shared_cache.update('devices', self._username, lambda saved: dict(saved or {}, **devices))
 
   ######################   SPOTIFY DEVICE CONTROLS METHODS END   ########################
 
@@ -1021,6 +2565,7 @@ class SpotifyClient(hass.Hass):
     return [u['uri'] for u in res['playlists']['items']]
 
 
+  @_traced('recommendation.artist_tracks')
   def get_artist_tracks(self, artist, limit=10, similar_artists=False, random_search=False):
     """
     Returns artist tracks as a list of uri's
@@ -1050,11 +2595,11 @@ class SpotifyClient(hass.Hass):
           if random_search:
             random.shuffle(artist_albums)
           for album in artist_albums:
-            if len(res) >= limit:
+            if len(res) >= limit or self._deadline_passed():
               break
             tracks = self.get_album_tracks(album)
             res += tracks
-    if not res:
+    if not res and not self._deadline_passed():
       # Find tracks from similar artists
       if len(res) < limit:
         related_artists = self.get_related_artists(search_artist)
@@ -1062,13 +2607,13 @@ class SpotifyClient(hass.Hass):
           if random_search:
             random.shuffle(related_artists)
           for artist in related_artists:
-            if len(res) >= limit:
+            if len(res) >= limit or self._deadline_passed():
               break
             tracks = self.get_top_tracks(artist)
             if tracks:
               res += tracks
 
-    if len(res) < limit:
+    if len(res) < limit and not self._deadline_passed():
       res += self.get_spotify_recommendation(artists=search_artist, limit=limit)
     if random_search:
       random.shuffle(res)
@@ -1144,21 +2689,50 @@ class SpotifyClient(hass.Hass):
     return [a['uri'] for a in results['items']]
 
 
-  def get_current_user_saved_tracks(self):
+  def get_current_user_saved_tracks(self, limit=SAVED_TRACKS_LIMIT):
+    """
+    Returns the most recently saved tracks from the current user as a list of track uri's
+
+    Served from the library index without an API call once it has been synced
+
+    param limit: The number of tracks to return (None returns the whole library when the library index is enabled)
+    """
+    if self._library and self._library.synced:
+      return self._library.saved_tracks(limit)
+    res = self.sp.current_user_saved_tracks(limit=min(limit or 50, 50))
+    return [u['track']['uri'] for u in res['items'] if u.get('track')]
+
+
+  def get_random_saved_tracks(self, limit=SAVED_TRACKS_LIMIT):
+    """
+    Returns randomly chosen saved tracks from the current user as a list of track uri's
+
+    param limit: The number of tracks to return
+    """
+    if self._library and self._library.synced:
+      return self._library.random_tracks(limit)
+    # Without the index only a single page of the library can be sampled
+    tracks = self.get_current_user_saved_tracks(50)
+    return random.sample(tracks, min(limit, len(tracks)))
+
+
+  def get_saved_track_count(self):
     """
-    Returns saved tracks from the current user as a list of track uri's
+    Returns the number of tracks saved in the current user's library
     """
-    res = self.sp.current_user_saved_tracks()
-    return [u['track']['uri'] for u in res['items']]
+    if self._library and self._library.synced:
+      return self._library.count()
+    return self.sp.current_user_saved_tracks(limit=1)['total']
 
 
-  def get_all_playlist_tracks_for_user(self, username='me', include_playlist=None, exclude_playlist=None):
+  def get_all_playlist_tracks_for_user(self, username='me', include_playlist=None, exclude_playlist=None, compact=True):
     """
-    Returns all playlist tracks for a user as a list of uri's
+    Returns all playlist tracks for a user as a de-duplicated TrackCollection of uri's
 
     param username: Spotify username
     param include: Name or uri of playlists to include in the results
     param exclude: Name or uri of playlists to exclude in the results
+    param compact: Return a TrackCollection (much less memory for large libraries), False returns a list with duplicates and local files
     """
     if include_playlist and exclude_playlist:
       self.log('Cannot specify both include and exclude playlists.', level='WARNING')
@@ -1173,10 +2747,13 @@ class SpotifyClient(hass.Hass):
     # playlists = [self.get_playlist_info(pl, username)['tracks'] for pl in self.get_playlists(username, include_playlist, exclude_playlist)]
     # return [track for tracks in playlists for track in tracks]
 
-    res = []
+    res = TrackCollection() if compact else []
     for pl in self.get_playlists(username, include_playlist, exclude_playlist):
-      for track in self.get_playlist_info(pl, username)['tracks']:
-        res.append(track)
+      if compact:
+        # Local files have no Spotify track id
+        res.update(u for u in self.get_playlist_track_uris(pl, username) if self.is_track_uri(u))
+      else:
+        res += self.get_playlist_track_uris(pl, username)
     return res
 
 
@@ -1201,7 +2778,18 @@ class SpotifyClient(hass.Hass):
     playlists = self.sp.user_playlists(username)
 
     if include:
-      return [pl['uri'] for pl in playlists['items'] if pl['name'] in include or pl['uri'] in include]
+      res = [pl['uri'] for pl in playlists['items'] if pl['name'] in include or pl['uri'] in include]
+      if not res and self._fuzzy_index is not None:
+        # No exact name match, use the closest playlist name for each name instead
+        index = FuzzyNameIndex()
+        for pl in playlists['items']:
+          index.add('playlist', pl['name'], pl['uri'])
+        for name in include:
+          uri, matched_name, score = index.lookup('playlist', name)
+          if uri and score >= self._fuzzy_threshold and uri not in res:
+            self.log('Fuzzy matched playlist "{}" to "{}" (confidence {:.2f}).'.format(name, matched_name, score), level=self.DEBUG_LEVEL)
+            res.append(uri)
+      return res
     elif exclude:
       return [pl['uri'] for pl in playlists['items'] if pl['name'] not in exclude and pl['uri'] not in exclude]
     else:
@@ -1223,7 +2811,7 @@ class SpotifyClient(hass.Hass):
     
     param uri: Spotify playlist uri
     """
-    return self.get_playlist_info(uri).get('tracks', [])
+    return self.get_playlist_track_uris(uri)
 
 
   def get_playlist_info(self, playlist, username='me'):
@@ -1237,8 +2825,7 @@ class SpotifyClient(hass.Hass):
       self.log('Invalid playlist: {}.'.format(playlist), level='WARNING')
       return {}
     
-    username = self._map_spotify_usernames(username)
-    pl_info = self.sp.user_playlist(username, playlist)
+    pl_info = self._get_playlist_fields(playlist, PLAYLIST_INFO_FIELDS, username)
 
     return {
       'name' : pl_info['name'],
@@ -1247,10 +2834,68 @@ class SpotifyClient(hass.Hass):
       'owner_id' : pl_info['owner']['id'],
       'description' : pl_info['description'],
       'num_tracks' : pl_info['tracks']['total'],
-      'tracks' : [t['track']['uri'] for t in pl_info['tracks']['items']],
+      'tracks' : self._playlist_item_uris(pl_info),
     }
 
 
+  def get_playlist_name(self, playlist, username='me'):
+    """
+    Returns the name of a playlist (only the name is requested from Spotify)
+
+    param playlist: Valid Spotify playlist uri
+    param username: The user that the playlist belongs to
+    """
+    if not self.is_playlist_uri(playlist):
+      self.log('Invalid playlist: {}.'.format(playlist), level='WARNING')
+      return None
+    return self._get_playlist_fields(playlist, PLAYLIST_NAME_FIELDS, username)['name']
+
+
+  def get_playlist_track_count(self, playlist, username='me'):
+    """
+    Returns the number of tracks in a playlist (only the total is requested from Spotify)
+
+    param playlist: Valid Spotify playlist uri
+    param username: The user that the playlist belongs to
+    """
+    if not self.is_playlist_uri(playlist):
+      self.log('Invalid playlist: {}.'.format(playlist), level='WARNING')
+      return 0
+    return self._get_playlist_fields(playlist, PLAYLIST_TOTAL_FIELDS, username)['tracks']['total']
+
+
+  def get_playlist_track_uris(self, playlist, username='me'):
+    """
+    Returns the track uri's of a playlist (only the uri's are requested from Spotify)
+
+    Same tracks as get_playlist_info(playlist)['tracks'] without downloading the full track objects
+
+    param playlist: Valid Spotify playlist uri
+    param username: The user that the playlist belongs to
+    """
+    if not self.is_playlist_uri(playlist):
+      self.log('Invalid playlist: {}.'.format(playlist), level='WARNING')
+      return []
+    return self._playlist_item_uris(self._get_playlist_fields(playlist, PLAYLIST_URIS_FIELDS, username))
+
+
+  def _get_playlist_fields(self, playlist, fields, username='me'):
+    """
+    Returns the playlist object filtered down to the requested fields
+
+    param playlist: Valid Spotify playlist uri
+    param fields: Spotify Web API fields filter (ex: 'tracks.total')
+    param username: The user that the playlist belongs to
+    """
+    return self.sp.user_playlist(self._map_spotify_usernames(username), playlist, fields=fields, market=self._country)
+
+
+  @staticmethod
+  def _playlist_item_uris(pl_info):
+    """ Returns the track uri's of a (field filtered) playlist object, removed tracks have no track object """
+    return [t['track']['uri'] for t in pl_info['tracks']['items'] if t.get('track')]
+
+
   def get_track_info(self, track, artist=None):
     """
     Returns track info as a dictionary
@@ -1259,6 +2904,8 @@ class SpotifyClient(hass.Hass):
     param artist: Spotify artist uri or name
     """
     track_uri = track
+    if not self.is_track_uri(track_uri):
+      track_uri = self._fuzzy_lookup('track', track, artist) or track
     if not self.is_track_uri(track_uri):
       results = None
       if artist:
@@ -1275,6 +2922,7 @@ class SpotifyClient(hass.Hass):
         return {}
 
     result = self.sp.track(track_uri)
+    self._remember_name('track', result['name'], track_uri, result['album']['artists'][0]['name'], result['album']['artists'][0]['uri'])
     return {
       'uri' : track_uri,
       'name' : result['name'],
@@ -1298,6 +2946,8 @@ class SpotifyClient(hass.Hass):
     else:
       artist_uri = artist
 
+    if not self.is_artist_uri(artist_uri):
+      artist_uri = self._fuzzy_lookup('artist', artist_uri) or artist_uri
     if not self.is_artist_uri(artist_uri):
       results = self.sp.search(q='artist:' + artist_uri, limit=1, type='artist')
       if results['artists']['items']:
@@ -1308,6 +2958,7 @@ class SpotifyClient(hass.Hass):
         return {}
 
     results = self.sp.artist(artist_uri)
+    self._remember_name('artist', results['name'], results['uri'])
     return {
       'name' : results['name'],
       'uri' : results['uri'],
@@ -1323,6 +2974,8 @@ class SpotifyClient(hass.Hass):
     param artist: Spotify artist uri or name
     """
     album_uri = album
+    if not self.is_album_uri(album_uri):
+      album_uri = self._fuzzy_lookup('album', album, artist) or album
     if not self.is_album_uri(album_uri):
       if artist:
         results = self.sp.search(q='album:' + album + ' artist:' + artist, type='album', limit=1)
@@ -1337,6 +2990,7 @@ class SpotifyClient(hass.Hass):
         return {}
     
     result = self.sp.album(album_uri)
+    self._remember_name('album', result['name'], album_uri, result['artists'][0]['name'], result['artists'][0]['uri'])
     return {
       'uri' : album_uri,
       'num_tracks' : result['total_tracks'],
@@ -1355,6 +3009,17 @@ class SpotifyClient(hass.Hass):
     """
     Handles the play event - play a spotify song to a Spotiy device using an event fired from HA or AD
     """
+    self._wait_until_ready()
+    with self._use_account(self._event_account(data)), self._trace(event_name, device=data.get('device', None)):
+      self._handle_play_event(data)
+
+
+  def _handle_play_event(self, data):
+    """
+    Find music matching the play event parameters and play it on the requested device
+
+    param data: Dictionary containing user parameters (See the documentation)
+    """
     d = data
     
     device = d.get('device', None)
@@ -1385,6 +3050,7 @@ class SpotifyClient(hass.Hass):
       self.log('Nothing was found matching your "{}" event parameters. No music will play.'.format(self._event_play), level='INFO')
 
 
+  @_traced('recommendation')
   def get_recommendation(self, data):
     """
     Make a music recommendation based on the input data
@@ -1404,105 +3070,297 @@ class SpotifyClient(hass.Hass):
       self.log('Please specifiy a number for "tracks".', level='WARNING')
       num_tracks = 0
 
-    to_play = None
-    if not similar:
-      # Check if a uri was passed in
-      to_play = self._check_for_uri(data)
-    if not to_play:
-      # Nothing uri was found, make a recommendation
-      to_play = self._get_recommendation(data)
+    deadline = _deadline.get() or self._event_deadline(data)
+    deadline_token = _deadline.set(deadline)
+    try:
+      to_play = self._cached_recommendation(data, random_search)
+      if to_play is None:
+        choices = _choice_log.set([])
+        try:
+          if not similar:
+            # Check if a uri was passed in
+            to_play = self._check_for_uri(data)
+          if not to_play:
+            # Nothing uri was found, make a recommendation
+            to_play = self._get_recommendation(data)
+          if not self._deadline_passed():
+            # A recommendation cut short is not cached
+            self._cache_recommendation(data, to_play)
+        finally:
+          _choice_log.reset(choices)
 
-    if to_play:
-      if single:
-        self.log('A single song has been requested to play.', level=self.DEBUG_LEVEL)
-        to_play = self.get_single_track(to_play, random_search)
-      elif multiple:
-        self.log('Multiple songs have been requested to play.', level=self.DEBUG_LEVEL)
-        to_play = self.get_multiple_tracks(to_play)
-      elif num_tracks > 0: # User defined a specific number of tracks they would like to hear
-        self.log('"{}" songs have been requested to play.'.format(num_tracks), level=self.DEBUG_LEVEL)
-        to_play = self.get_number_of_tracks(to_play, num_tracks, similar, random_search)
+      if to_play:
+        if single:
+          self.log('A single song has been requested to play.', level=self.DEBUG_LEVEL)
+          to_play = self.get_single_track(to_play, random_search)
+        elif multiple:
+          self.log('Multiple songs have been requested to play.', level=self.DEBUG_LEVEL)
+          to_play = self.get_multiple_tracks(to_play)
+        elif num_tracks > 0: # User defined a specific number of tracks they would like to hear
+          self.log('"{}" songs have been requested to play.'.format(num_tracks), level=self.DEBUG_LEVEL)
+          to_play = self.get_number_of_tracks(to_play, num_tracks, similar, random_search)
+      self._log_deadline(deadline)
+    finally:
+      _deadline.reset(deadline_token)
 
     return to_play
 
 
-  def _check_for_uri(self, data):
+  def _event_deadline(self, data):
+    """ 
+    Returns the Deadline of a play event or None when there is no time limit
+
+    param data: Dictionary containing user parameters, 'deadline' overrides the play_deadline of the app config
     """
-    Checks for a Spotify uri in the data and return the track/playlist/artist/album uri if found
+    seconds = data.get('deadline', self._play_deadline)
+    try:
+      seconds = float(seconds or 0)
+    except (TypeError, ValueError):
+      self.log('Please specifiy a number of seconds for "deadline".', level='WARNING')
+      seconds = self._play_deadline
+    return Deadline(seconds) if seconds > 0 else None
 
-    Priority order: track -> playlist -> album -> artist
 
-    param data: Dictionary containing user parameters (See the documentation)
-    """
-    d = data 
+  def _deadline_passed(self):
+    """ Returns True once the play event being resolved is out of time (always False without a deadline) """
+    deadline = _deadline.get()
+    return deadline is not None and deadline.passed()
 
-    track = d.get('track', None)
-    playlist = d.get('playlist', None)
-    album = d.get('album', None)
-    artist = d.get('artist', None)
 
-    multiple = True if d.get('multiple', False) else False
-    random_search = True if d.get('random_search', False) else False
+  def _log_deadline(self, deadline):
+    """ Log that a play event ran out of time """
+    if deadline is not None and deadline.expired:
+      self.log('The play deadline ({}s) was reached, playing the best music found so far.'.format(deadline.seconds), level='INFO')
 
-    to_play = None
 
-    if track:
-      valid = True
-      if self.is_track_uri(track) and multiple: # User wants multiple songs
-        return ''
-      elif isinstance(track, list):
-        for u in track:
-          if not self.is_track_uri(u):
-            valid = False
-      elif not self.is_track_uri(track):
-        valid = False
-      if valid:
-        self.log("Found a track uri or list of track uri's.", level=self.DEBUG_LEVEL)
-        to_play = track
+  def _deadline_fallback(self, random_search):
+    """ 
+    Returns music that is ready without calling Spotify, for when a play event is out of time
 
-    elif playlist and not to_play:
-      if self.is_playlist_uri(playlist):
-        self.log('Found a playlist uri.', level=self.DEBUG_LEVEL)
-        to_play = playlist
+    param random_search: Whether or not to pick randomly
+    """
+    # The playlists are the main account's
+    pool = self._fallback_pool if self._account is self._main_account else []
+    with self._span('recommendation.deadline_fallback'):
+      return self._choose(pool, random_search) or self._snapshot_uri
 
-    elif album and not to_play:
-      if self.is_album_uri(album):
-        self.log('Found a album uri.', level=self.DEBUG_LEVEL)
-        to_play = album
 
-    elif artist and not to_play:
-      if self.is_artist_uri(artist):
-        self.log('Found a artist uri.', level=self.DEBUG_LEVEL)
-        to_play = artist
-        if random_search:
-          albums = self.get_artist_albums(artist)
-          to_play = random.choice(albums)
+  def _refresh_fallback_pool(self, kwargs):
+    """ Callback to refresh the user's playlists played when a play event runs out of time """
+    if not self.sp:
+      return
+    with self._trace('recommendation.refresh_fallback'):
+      try:
+        pool = self.get_playlists()
+      except (spotipy.client.SpotifyException, requests.exceptions.RequestException) as e:
+        self.log('Failed to refresh the fallback playlists: {}'.format(e), level='WARNING')
+        return
+    if pool:
+      self._fallback_pool = pool
 
-    return to_play
 
+  def _choose(self, pool, random_search):
+    """ 
+    Pick from a pool of candidates (randomly or the first one) and record the pool for the recommendation cache
 
-  def _get_recommendation(self, data):
+    param pool: List of candidate uri's
+    param random_search: Whether or not to pick randomly
     """
-    Returns a Spotify recommendation based on user input data
+    if not pool:
+      return None
+    choice = random.choice(pool) if random_search else pool[0]
+    choices = _choice_log.get()
+    if choices is not None:
+      choices.append((pool, choice))
+    return choice
 
-    Priority order: user defined playlist -> track defined -> album defined -> artist defined -> genre -> category -> 
-      -> featured playlist -> newly released album -> users playlist (nothing defined - fallback)
+
+  def _recommendation_cache_key(self, data):
+    """ 
+    Returns the recommendation cache key of the event parameters
+
+    Names are compared case insensitively, uri's exactly and flags only by whether they are set
 
     param data: Dictionary containing user parameters (See the documentation)
     """
-    d = data
+    def normalize(value):
+      if isinstance(value, str):
+        return value if SpotifyURI.parse(value) else value.strip().casefold()
+      if isinstance(value, (list, tuple)):
+        return tuple(normalize(v) for v in value)
+      return value
 
-    track = d.get('track', None)
-    playlist = d.get('playlist', None)
-    album = d.get('album', None)
+    key = tuple((k, normalize(data[k])) for k in RECOMMENDATION_PARAMS if data.get(k))
+    # The user's own playlists and library differ between accounts
+    return (self._username,) + key + tuple(k for k in RECOMMENDATION_FLAGS if data.get(k))
+
+
+  def _cached_recommendation(self, data, random_search):
+    """ 
+    Returns a pick from the cached candidates of an identical event or None if there are none
+
+    param data: Dictionary containing user parameters (See the documentation)
+    param random_search: Whether or not to pick randomly
+    """
+    if self._recommendation_cache is None:
+      return None
+    cached = self._recommendation_cache.get(('event', self._recommendation_cache_key(data)))
+    if cached is None:
+      return None
+
+    kind, candidates = cached
+    self.log('Using the cached recommendation candidates.', level=self.DEBUG_LEVEL)
+    with self._span('recommendation.cached', kind=kind):
+      if kind == 'pool':
+        return self._choose(candidates, random_search)
+      if isinstance(candidates, list):
+        candidates = list(candidates)
+        if random_search:
+          random.shuffle(candidates)
+      return candidates
+
+
+  def _cache_recommendation(self, data, to_play):
+    """ 
+    Cache the candidates the recommendation was picked from
+
+    The pool the final pick came from is cached rather than the pick itself so identical events still vary,
+    a recommendation that was not picked from a pool (ex: a list of recommended tracks) is cached as is
+
+    param data: Dictionary containing user parameters (See the documentation)
+    param to_play: The recommendation
+    """
+    if self._recommendation_cache is None or not to_play:
+      return
+    entry = ('value', to_play)
+    # Speculative branches that were not used record their pools too, find the pool of the pick
+    for pool, choice in reversed(_choice_log.get() or []):
+      if choice == to_play:
+        entry = ('pool', list(pool))
+        break
+    self._recommendation_cache.set(('event', self._recommendation_cache_key(data)), entry)
+
+
+  def _get_uri_tracks(self, uri):
+    """ 
+    Returns the track uri's of a playlist or album as a TrackCollection, cached along with the recommendation candidates
+
+    param uri: Spotify playlist or album uri
+    """
+    tracks = self._cached_uri_tracks(uri)
+    if tracks is None:
+      if self.is_playlist_uri(uri):
+        tracks = self.get_playlist_track_uris(uri)
+      elif self.is_album_uri(uri):
+        tracks = self.get_album_info(uri).get('tracks', [])
+      else:
+        tracks = []
+      # Local files have no Spotify track id
+      tracks = TrackCollection(u for u in tracks if self.is_track_uri(u))
+      self._cache_uri_tracks(uri, tracks)
+    return tracks
+
+
+  def _cached_uri_tracks(self, uri):
+    """ 
+    Returns the cached track uri's of a playlist or album (fetched by this or an instance sharing the cache), None if not cached
+
+    param uri: Spotify playlist or album uri
+    """
+    if self._recommendation_cache is None:
+      return None
+    tracks = self._recommendation_cache.get(('tracks', uri))
+    if tracks is None and self._shared_cache is not None:
+      tracks = self._shared_cache.get('tracks', uri)
+      if tracks:
+        tracks = TrackCollection(tracks)
+        self._recommendation_cache.set(('tracks', uri), tracks)
+    return tracks
+
+
+  def _cache_uri_tracks(self, uri, tracks):
+    """ 
+    Cache the track uri's of a playlist or album for as long as the recommendation candidates
+
+    param uri: Spotify playlist or album uri
+    param tracks: TrackCollection of track uri's
+    """
+    if not tracks or self._recommendation_cache is None:
+      return
+    self._recommendation_cache.set(('tracks', uri), tracks)
+    if self._shared_cache is not None:
+      self._shared_cache.set('tracks', uri, list(tracks), self._recommendation_cache.ttl)
+
+
+  @_traced('recommendation.check_for_uri')
+  def _check_for_uri(self, data):
+    """
+    Checks for a Spotify uri in the data and return the track/playlist/artist/album uri if found
+
+    Priority order: track -> playlist -> album -> artist
+
+    param data: Dictionary containing user parameters (See the documentation)
+    """
+    d = data 
+
+    track = d.get('track', None)
+    playlist = d.get('playlist', None)
+    album = d.get('album', None)
+    artist = d.get('artist', None)
+
+    multiple = True if d.get('multiple', False) else False
+    random_search = True if d.get('random_search', False) else False
+
+    to_play = None
+
+    if track:
+      if self.is_track_uri(track) and multiple: # User wants multiple songs
+        return ''
+      # Validates a whole list in one pass
+      track_uri = self.to_spotify_uri(track, 'track')
+      if track_uri:
+        self.log("Found a track uri or list of track uri's.", level=self.DEBUG_LEVEL)
+        to_play = track_uri
+
+    elif playlist and not to_play:
+      if self.is_playlist_uri(playlist):
+        self.log('Found a playlist uri.', level=self.DEBUG_LEVEL)
+        to_play = self.to_spotify_uri(playlist)
+
+    elif album and not to_play:
+      if self.is_album_uri(album):
+        self.log('Found a album uri.', level=self.DEBUG_LEVEL)
+        to_play = self.to_spotify_uri(album)
+
+    elif artist and not to_play:
+      if self.is_artist_uri(artist):
+        self.log('Found a artist uri.', level=self.DEBUG_LEVEL)
+        to_play = self.to_spotify_uri(artist)
+        if random_search:
+          to_play = self._choose(self.get_artist_albums(artist), True) or to_play
+
+    return to_play
+
+
+  def _get_recommendation(self, data):
+    """
+    Returns a Spotify recommendation based on user input data
+
+    Priority order: user defined playlist -> track defined -> album defined -> artist defined -> genre -> category -> 
+      -> featured playlist -> newly released album -> users playlist (nothing defined - fallback)
+
+    param data: Dictionary containing user parameters (See the documentation)
+    """
+    d = data
+
+    track = d.get('track', None)
+    playlist = d.get('playlist', None)
+    album = d.get('album', None)
     artist = d.get('artist', None)
 
     random_search = True if d.get('random_search', False) else False
     user = d.get('username', 'me')
     genre = d.get('genre', None)
-    category = d.get('category', None)
-    featured = True if d.get('featured', False) else False
-    new_releases = True if d.get('new_releases', False) else False
     single = True if d.get('single', False) else False
     multiple = True if d.get('multiple', False) else False
     similar = True if d.get('similar', False) else False
@@ -1511,151 +3369,225 @@ class SpotifyClient(hass.Hass):
 
     # Use the user defined 'playlist' parameter to find music
     if playlist:
-      self.log('Attempting to use the playlist name to find a user playlist.', level=self.DEBUG_LEVEL)
-      pl = self.get_playlists(username=user, include=playlist)
-      if pl:
-        if random_search:
-          to_play = random.choice(pl)
-        else:
-          to_play = pl[0]
+      with self._span('recommendation.playlist'):
+        self.log('Attempting to use the playlist name to find a user playlist.', level=self.DEBUG_LEVEL)
+        to_play = self._choose(self.get_playlists(username=user, include=playlist), random_search)
 
     # Use the user defined 'track' parameter to find music
-    if not to_play and track:
-      if not similar:
-        self.log('Attempting to use the track name to find the song.', level=self.DEBUG_LEVEL)
-        to_play = self.get_track_info(track, artist).get('uri', None)
-      if not to_play:
-        self.log('Attempting to use the track name to make a similar track recommendation.', level=self.DEBUG_LEVEL)
-        to_play = self.get_spotify_recommendation(tracks=track, genres=genre, artists=artist)
+    if not to_play and track and not self._deadline_passed():
+      with self._span('recommendation.track'):
+        if not similar:
+          self.log('Attempting to use the track name to find the song.', level=self.DEBUG_LEVEL)
+          to_play = self.get_track_info(track, artist).get('uri', None)
+        if not to_play:
+          self.log('Attempting to use the track name to make a similar track recommendation.', level=self.DEBUG_LEVEL)
+          to_play = self.get_spotify_recommendation(tracks=track, genres=genre, artists=artist)
 
     # Use the user defined 'album' parameter to find music
-    if not to_play and album:
-      if not similar:
-        self.log('Attempting to use the album name to the album.', level=self.DEBUG_LEVEL)
-        to_play = self.get_album_info(album, artist).get('uri', None)
-      elif similar or not to_play:
-        self.log('Attempting to use the album name to find a similar album.', level=self.DEBUG_LEVEL)
-        album_info = self.get_album_info(album, artist)
-        album_artist = album_info.get('artist_uri', None)
-        album_uri = album_info.get('uri', None)
-
-        if album_artist:
-          chosen_artist = album_artist
-          if random.choice([1,2]) == 1: # Randomly pick a related artist
-            self.log('Attemping to use a different artist than the input album artist.', level=self.DEBUG_LEVEL)
-            related_artists = self.get_related_artists(album_artist)
-            if related_artists:
-              if random_search:
-                chosen_artist = random.choice(related_artists)
-              else:
-                chosen_artist = related_artists[0]
-          artist_albums = self.get_artist_albums(chosen_artist)
-          if album_uri in artist_albums and len(artist_albums) > 1: # Remove the user defined album from the choices
-            artist_albums.remove(album_uri)
-          if random_search:
-            to_play = random.choice(artist_albums)
-          else:
-            to_play = artist_albums[0]
+    if not to_play and album and not self._deadline_passed():
+      with self._span('recommendation.album'):
+        if not similar:
+          self.log('Attempting to use the album name to the album.', level=self.DEBUG_LEVEL)
+          to_play = self.get_album_info(album, artist).get('uri', None)
+        elif similar or not to_play:
+          self.log('Attempting to use the album name to find a similar album.', level=self.DEBUG_LEVEL)
+          album_info = self.get_album_info(album, artist)
+          album_artist = album_info.get('artist_uri', None)
+          album_uri = album_info.get('uri', None)
+
+          if album_artist:
+            chosen_artist = album_artist
+            if random.choice([1,2]) == 1: # Randomly pick a related artist
+              self.log('Attemping to use a different artist than the input album artist.', level=self.DEBUG_LEVEL)
+              chosen_artist = self._choose(self.get_related_artists(album_artist), random_search) or album_artist
+            artist_albums = self.get_artist_albums(chosen_artist)
+            if album_uri in artist_albums and len(artist_albums) > 1: # Remove the user defined album from the choices
+              artist_albums.remove(album_uri)
+            to_play = self._choose(artist_albums, random_search)
 
     # Use the user defined 'artist' parameter to find music
-    if not to_play and artist:
-      self.log('Attempting to use the artist name to find music.', level=self.DEBUG_LEVEL)
-      chosen_artist = artist
-      if similar:
-        self.log('Attempting to find similar music from the artist.', level=self.DEBUG_LEVEL)
-        artist_info = self.get_artist_info(artist)
-        similar_artists = self.get_related_artists(artist_info['uri'])
-        if similar_artists:
-          if random_search:
-            chosen_artist = random.choice(similar_artists)
-          else:
-            chosen_artist = similar_artists[0]
+    if not to_play and artist and not self._deadline_passed():
+      with self._span('recommendation.artist'):
+        self.log('Attempting to use the artist name to find music.', level=self.DEBUG_LEVEL)
+        chosen_artist = artist
+        if similar:
+          self.log('Attempting to find similar music from the artist.', level=self.DEBUG_LEVEL)
+          artist_info = self.get_artist_info(artist)
+          chosen_artist = self._choose(self.get_related_artists(artist_info['uri']), random_search) or artist
+
+        if single or not multiple:
+          to_play = self.get_top_tracks(chosen_artist)
+          if random_search and not self._deadline_passed():
+            to_play += self.get_artist_tracks(chosen_artist, 10, similar, random_search)
+            random.shuffle(to_play)
+        if (not single and multiple) or not to_play:
+          to_play = self._choose(self.get_artist_albums(chosen_artist), random_search) or to_play
+
+        if not to_play and not self._deadline_passed():
+          to_play = self.get_spotify_recommendation(artists=artist, genres=genre, tracks=track)
+
+    # Genre -> category -> featured playlist -> newly released album -> users playlist (fallback)
+    if not to_play:
+      to_play = self._run_recommendation_branches(data, random_search)
 
-      if single or not multiple:
-        to_play = self.get_top_tracks(chosen_artist)
-        if random_search:
-          to_play += self.get_artist_tracks(chosen_artist, 10, similar, random_search)
-          random.shuffle(to_play)
-      if (not single and multiple) or not to_play:
-        artist_albums = self.get_artist_albums(chosen_artist)
-        if artist_albums:
-          if random_search:
-            to_play = random.choice(artist_albums)
-          else:
-            to_play = artist_albums[0]
+    return to_play
+
+
+  def _recommendation_branches(self, data):
+    """ 
+    Returns the independent recommendation branches that apply to the event in priority order (the fallback excluded)
+
+    param data: Dictionary containing user parameters (See the documentation)
+    """
+    branches = []
+    if data.get('genre', None):
+      branches.append(self._recommend_genre)
+    if data.get('category', None):
+      branches.append(self._recommend_category)
+    if data.get('featured', False):
+      branches.append(self._recommend_featured)
+    if data.get('new_releases', False):
+      branches.append(self._recommend_new_releases)
+    return branches
+
+
+  def _run_recommendation_branches(self, data, random_search):
+    """ 
+    Returns the result of the first recommendation branch that finds music, or of the fallback
+
+    param data: Dictionary containing user parameters (See the documentation)
+    param random_search: Whether or not to pick randomly
+    """
+    branches = self._recommendation_branches(data)
+    speculative = self._speculative_recommendation and branches
+    to_play = None
+    if speculative:
+      to_play = self._run_branches_speculatively(branches, data, random_search)
+    else:
+      for branch in branches:
+        if self._deadline_passed():
+          break
+        to_play = branch(data, random_search)
+        if to_play:
+          return to_play
+
+    # Out of time - use what is ready, Spotify is not called anymore
+    if self._deadline_passed():
+      return to_play or self._deadline_fallback(random_search)
+
+    # Nothing matches the user defined parameters or none were defined - use the fallback
+    if not to_play:
+      self.log('No music was found, using the fallback which is a saved user playlist or track.', level=self.DEBUG_LEVEL)
+      to_play = self._recommend_fallback(data, random_search)
+    return to_play
+
+
+  def _run_branches_speculatively(self, branches, data, random_search):
+    """ 
+    Run the recommendation branches at the same time and return the result of the first one (in priority order) that finds music
+
+    Branches that are no longer needed are cancelled if they have not started, running ones stop before
+    their next Web API call and their results are dropped
+
+    param branches: Recommendation branch methods in priority order
+    param data: Dictionary containing user parameters (See the documentation)
+    param random_search: Whether or not to pick randomly
+    """
+    deadline = _deadline.get()
+    futures = []
+    branch_deadlines = []
+    for branch in branches:
+      # Each branch runs in a copy of the context so it keeps the trace and the choice log, with its own
+      # deadline (the event's time left) that is cancelled once the branch is no longer needed
+      branch_deadline = Deadline(deadline.remaining() if deadline else float('inf'))
+      context = contextvars.copy_context()
+      context.run(_deadline.set, branch_deadline)
+      branch_deadlines.append(branch_deadline)
+      futures.append(self._branch_executor.submit(context.run, branch, data, random_search))
+    try:
+      with self._span('recommendation.speculative', branches=len(branches)):
+        for branch, future in zip(branches, futures):
+          try:
+            to_play = future.result(deadline.remaining() if deadline else None)
+          except concurrent.futures.TimeoutError:
+            deadline.expired = True
+            return None
+          except (spotipy.client.SpotifyException, requests.exceptions.RequestException) as e:
+            self.log('The {} recommendation failed: {}'.format(branch.__name__, e), level='WARNING')
+            continue
+          except Exception as e:
+            # The other branches can still find music
+            self.log('The {} recommendation failed unexpectedly: {!r}'.format(branch.__name__, e), level='ERROR')
+            continue
+          if to_play:
+            return to_play
+    finally:
+      for future, branch_deadline in zip(futures, branch_deadlines):
+        future.cancel()
+        branch_deadline.cancel()
+    return None
 
-      if not to_play:
-        to_play = self.get_spotify_recommendation(artists=artist, genres=genre, tracks=track)
 
-    # Use the user defined 'genre' parameter to find music
-    if not to_play and genre:
+  def _recommend_genre(self, data, random_search):
+    """ Recommendation branch using the 'genre' parameter """
+    genre = data.get('genre', None)
+    with self._span('recommendation.genre'):
       self.log('Attempting to use the genre name to make a recommendation.', level=self.DEBUG_LEVEL)
-      if genre in self.get_recommendation_genre_seeds():
-        to_play = self.get_spotify_recommendation(artists=artist, genres=genre, tracks=track)
-      if not to_play:
+      to_play = None
+      if genre in self.get_recommendation_genre_seeds() and not self._deadline_passed():
+        to_play = self.get_spotify_recommendation(artists=data.get('artist', None), genres=genre, tracks=data.get('track', None))
+      if not to_play and not self._deadline_passed():
         self.log('No music found matching your genre, attempting to find a matching category.', level=self.DEBUG_LEVEL)
-        to_play = self.get_playlists_by_category(category)
-        if to_play:
-          if random_search:
-            to_play = random.choice(to_play)
-          else:
-            to_play = to_play[0]
-      
+        to_play = self._choose(self.get_playlists_by_category(data.get('category', None)), random_search)
+      return to_play
+
 
-    # Use the user defined 'category' parameter to find music
-    if not to_play and category:
+  def _recommend_category(self, data, random_search):
+    """ Recommendation branch using the 'category' parameter """
+    category = data.get('category', None)
+    with self._span('recommendation.category'):
       self.log('Attempting to use the category name to make a recommendation.', level=self.DEBUG_LEVEL)
-      to_play = self.get_playlists_by_category(category)
-      if to_play:
-        if random_search:
-          to_play = random.choice(to_play)
-        else:
-          to_play = to_play[0]
-      if not to_play:
+      to_play = self._choose(self.get_playlists_by_category(category), random_search)
+      if not to_play and not self._deadline_passed():
         self.log('No music found matching your category, attempting to find a matching genre.', level=self.DEBUG_LEVEL)
         to_play = self.get_spotify_recommendation(genres=category)
+      return to_play
+
 
-    # Use the user defined 'featured' parameter to find music
-    if not to_play and featured:
+  def _recommend_featured(self, data, random_search):
+    """ Recommendation branch using the 'featured' parameter """
+    with self._span('recommendation.featured'):
       self.log('Attempting to find a featured playlist.', level=self.DEBUG_LEVEL)
       to_play = self.get_featured_playlists() # List of playlists
-      if not to_play:
+      if not to_play and not self._deadline_passed():
         self.log('No featured playlists were found, attempting to find a newly released album.', level=self.DEBUG_LEVEL)
         to_play = self.new_releases() # List of albums
-      if to_play:
-        if random_search:
-          to_play = random.choice(to_play)
-        else:
-          to_play = to_play[0]
+      return self._choose(to_play, random_search)
+
 
-    # Use the user defined 'new_releases' parameter to find music
-    if not to_play and new_releases:
+  def _recommend_new_releases(self, data, random_search):
+    """ Recommendation branch using the 'new_releases' parameter """
+    with self._span('recommendation.new_releases'):
       self.log('Attempting to find a newly released album.', level=self.DEBUG_LEVEL)
       to_play = self.new_releases() # List of albums
-      if not to_play:
+      if not to_play and not self._deadline_passed():
         self.log('No newly released albums were found, attempting to find a featured playlist.', level=self.DEBUG_LEVEL)
         to_play = self.get_featured_playlists() # List of playlists
-      if to_play:
-        if random_search:
-          to_play = random.choice(to_play)
-        else:
-          to_play = to_play[0]
+      return self._choose(to_play, random_search)
 
-    # Nothing matches the user defined parameters or none were defined - use the fallback
-    if not to_play:
-      self.log('No music was found, using the fallback which is a saved user playlist or track.', level=self.DEBUG_LEVEL)
-      to_play = self.get_playlists()
-      if to_play:
-        if random_search:
-          to_play = random.choice(to_play)
-        else:
-          to_play = to_play[0]
-      else:
-        to_play = self.get_current_user_saved_tracks()
 
-    return to_play
+  def _recommend_fallback(self, data, random_search):
+    """ Recommendation fallback, a saved user playlist or track """
+    with self._span('recommendation.fallback'):
+      to_play = self._choose(self.get_playlists(), random_search)
+      if not to_play and random_search:
+        to_play = self.get_random_saved_tracks()
+      elif not to_play:
+        to_play = self.get_current_user_saved_tracks()
+      return to_play
 
 
+  @_traced('recommendation.multiple_tracks')
   def get_multiple_tracks(self, uri):
     """
     Ensures the return uri will contain a Spotify uri or list of track uri's that will play multiple songs
@@ -1668,9 +3600,10 @@ class SpotifyClient(hass.Hass):
     return uri
 
 
+  @_traced('recommendation.number_of_tracks')
   def get_number_of_tracks(self, uri, num_tracks, similar=False, random_search=False):
     """
-    Returns a list of tracks that is the num_tracks in length using the given uri for recommendations
+    Returns a de-duplicated TrackCollection of tracks that is the num_tracks in length using the given uri for recommendations
 
     The return number of tracks is not a guarantee
 
@@ -1679,36 +3612,35 @@ class SpotifyClient(hass.Hass):
     similar: Find tracks from similar artists
     param random_search: Whether or not to randomly choose songs
     """
-    res = []
+    res = TrackCollection()
 
     # Add the provided uri(s) to the start of our result
-    if isinstance(uri, list):
-      res = uri
+    if isinstance(uri, (list, TrackCollection)):
+      res.update(u for u in uri if self.is_track_uri(u))
       if random_search:
         search_uri = random.choice(uri)
       else:
         search_uri = uri[0]
     else: # single uri passed in
       search_uri = uri
-      if self.is_track_uri(uri):
-        res.append(uri)
-      elif self.is_playlist_uri(uri):
-        pl_tracks = self.get_playlist_info(search_uri).get('tracks', [])
-        res += pl_tracks
-      elif self.is_album_uri(uri):
-        album_tracks = self.get_album_info(uri).get('tracks', [])
-        res += album_tracks
+      uri_type = getattr(SpotifyURI.parse(uri), 'type', None)
+      if uri_type == 'track':
+        res.add(uri)
+      elif uri_type in ('playlist', 'album'):
+        res.update(self._get_uri_tracks(uri))
       # If uri is an artist uri, we will get tracks later
 
     if len(res) >= num_tracks:
       if random_search:
-        return random.sample(res, num_tracks)
+        return TrackCollection(random.sample(res, num_tracks))
       return res[:num_tracks]
+    if self._deadline_passed():
+      return res or uri
 
     # Determine the artist of the given uri
     search_artist = None
     if self.is_playlist_uri(search_uri):
-      tracks = self.get_playlist_info(search_uri)['tracks']
+      tracks = self._get_uri_tracks(search_uri)
       if tracks:
         track = random.choice(tracks)
         search_artist = self.get_artist_info(track).get('uri', None)
@@ -1716,19 +3648,20 @@ class SpotifyClient(hass.Hass):
       search_artist = self.get_artist_info(search_uri).get('uri', None)
 
     # Add artist tracks until we reach our desired number of tracks
-    if search_artist:
+    if search_artist and not self._deadline_passed():
       tracks = self.get_artist_tracks(search_artist, num_tracks-len(res), similar, random_search)
-      res += tracks
-      if len(res) < num_tracks:
+      res.update(tracks)
+      if len(res) < num_tracks and not self._deadline_passed():
         tracks = self.get_artist_tracks(search_artist, num_tracks-len(res), not similar, random_search)
-        res += tracks
-      if len(res) < num_tracks:
+        res.update(tracks)
+      if len(res) < num_tracks and not self._deadline_passed():
         tracks = self.get_spotify_recommendation(artists=search_artist, limit=num_tracks-len(res))
-        res += tracks
+        res.update(tracks)
 
     return res[:num_tracks]
 
 
+  @_traced('recommendation.single_track')
   def get_single_track(self, uri, random_track=False):
     """ 
     Extracts a single track uri from the provided uri
@@ -1737,7 +3670,7 @@ class SpotifyClient(hass.Hass):
     param random_track: Whether or not to randomly choose the track
     """
     # If a list of tracks is passed in, deal with it
-    if isinstance(uri, list):
+    if isinstance(uri, (list, TrackCollection)):
       if random_track:
         uri = random.choice(uri)
       else:
@@ -1746,10 +3679,8 @@ class SpotifyClient(hass.Hass):
     tracks = []
     if self.is_track_uri(uri):
       return uri
-    if self.is_playlist_uri(uri):
-      tracks = self.get_playlist_info(uri).get('tracks', [])
-    if self.is_album_uri(uri):
-      tracks = self.get_album_info(uri).get('tracks', [])
+    if self.is_playlist_uri(uri) or self.is_album_uri(uri):
+      tracks = self._get_uri_tracks(uri)
     elif self.is_artist_uri(uri):
       albums = self.get_artist_albums(uri)
       if albums:
@@ -1777,10 +3708,10 @@ class SpotifyClient(hass.Hass):
 
     param uri: A valid Spotify uri or list of track uri's
     """
-    if isinstance(uri, list):
+    if isinstance(uri, (list, TrackCollection)):
       nt = len(uri)
     elif self.is_playlist_uri(uri):
-      nt = self.get_playlist_info(uri)['num_tracks']
+      nt = self.get_playlist_track_count(uri)
     elif self.is_album_uri(uri):
       nt = self.get_album_info(uri)['num_tracks']
     else:
@@ -1794,132 +3725,2487 @@ class SpotifyClient(hass.Hass):
     """ 
     Disconnect all discovered Chromecast devices from socket connection
     """
-    for cast in self._chromecasts.values():
+    for cast in list(self._chromecasts.values()):
       cast.stop()
 
 
   def terminate(self):
+    if self._cast_monitor:
+      self._cast_monitor.stop()
     self._disconnect_casts()
+    if self._library:
+      self._library.close()
+    if self._branch_executor is not None:
+      self._branch_executor.shutdown(wait=False)
+    if self._shared_cache:
+      self._shared_cache.close()
+    if self._profiler is not None:
+      self._profiler.stop()
+    if self._memory_snapshots is not None:
+      self._memory_snapshots.stop()
 
 
 
-class CastDevice:
-  """Representation of a Cast device on the network.
-
-  Modified version of: https://github.com/home-assistant/home-assistant/blob/dev/homeassistant/components/cast/media_player.py
+class AsyncSpotifyClient(SpotifyClient):
+  """
+  Asyncio version of the Spotify client app (use 'class: AsyncSpotifyClient' in apps.yaml)
 
-  This class is the holder of the pychromecast.Chromecast object and its socket client.
+  The play and controls events are handled by async callbacks that use AsyncSpotifyWebAPI for the
+  player Web API calls, so waiting on the player does not hold an Appdaemon worker thread. Only the player
+  calls are async: finding the music to play, the device registry and the blocking Chromecast operations
+  run the synchronous SpotifyClient methods in executor threads, so the decisions are made by the same
+  code in both apps. The synchronous methods of SpotifyClient remain available to other apps.
   """
 
-  def __init__(self, chromecast, logger, debug_level='DEBUG'):
-    self._chromecast = None # pychromecast.Chromecast
-    self._cast_info = {} 
-    self.cast_status = None
-    self.media_status = None
-    self.connection_status = None
-    self._available = False
-    self._status_listener = None
-    self.logger = logger
-    self._debug_level = debug_level
+  _web_api = _AccountAttribute('web_api')
+  _chunks_task = _AccountAttribute('chunks_task')
 
-    self.set_cast(chromecast)
+  def initialize(self):
+    super().initialize()
+    for account in self._accounts.values():
+      account.web_api.set_breakers(self._breakers)
 
-  @property
-  def name(self):
-    return self._cast_info.get('friendly_name', None)
 
-  @property
-  def model_name(self):
-    return self._cast_info.get('model_name', None)
+  def _create_account(self, username, password, token_file, devices=()):
+    """ Returns a new SpotifyAccount with its own async Web API client """
+    account = super()._create_account(username, password, token_file, devices)
+    account.web_api = AsyncSpotifyWebAPI()
+    return account
 
-  @property
-  def uuid(self):
-    return self._cast_info.get('uuid', None)
 
-  @property
-  def host(self):
-    return self._cast_info.get('host', None)
+  def _initialize_spotify_client(self, access_token=None, expires_at=None):
+    """ Refresh the Spotify client instance and the token used by the async Web API client """
+    super()._initialize_spotify_client(access_token, expires_at)
+    self._web_api.set_token(self._access_token)
 
-  @property
-  def port(self):
-    return self._cast_info.get('port', None)
 
-  @property
-  def available(self):
-    """ Return True if the cast device is connected or connecting """
-    return self._available or self.connection_status == CONNECTION_STATUS_CONNECTING
+  async def _async_run(self, func, *args):
+    """ 
+    Run a SpotifyClient method in an executor
 
-  @property
-  def complete_info(self):
-    return all([self.name, self.host, self.port, self.model_name, self.uuid])
+    The executor thread gets a copy of the context, so it uses the account, trace and deadline of the event being handled
+    """
+    return await self.run_in_executor(contextvars.copy_context().run, func, *args)
 
-  def get_cast(self):
-    return self._chromecast
 
-  def reset_cast_connection(self):
-    """
-    Attempt to initialize a new cast connection after disconnected/failed
-    """
-    if not self.complete_info:
-      self.logger.log('Incomplete cast information ({}), skipping reconnection attempt.'.format(self.name), self._debug_level)
-      return
+  async def _async_wait_until_ready(self):
+    """ Async version of _wait_until_ready, the wait runs in an executor """
+    if not self._ready.is_set():
+      await self.run_in_executor(self._wait_until_ready)
 
-    info = (self.host, self.port, self.uuid, self.model_name, self.name)
-    chromecast = pychromecast._get_chromecast_from_host(info, tries=5, retry_wait=1, timeout=30)
-    self.set_cast(chromecast)
 
-  def set_cast(self, chromecast):
-    """ 
-    Initially setup using the cast device
+  async def terminate(self):
+    for account in self._accounts.values():
+      if account.chunks_task is not None:
+        account.chunks_task.cancel()
+      await account.web_api.close()
+    await self.run_in_executor(super().terminate)
 
-    param chromecast: pychromecast.Chromecast device
+
+  ######################   ASYNC PLAY SPOTIFY MUSIC METHODS   ########################
+
+  async def async_map_chromecasts(self, device):
     """
-    if self._chromecast is not None:
-      # The chromecast is already setup
-      self.logger.log('Chromecast is already setup: {}'.format(self.name), self._debug_level)
-      return
+    Async version of map_chromecasts
 
-    self._cast_info['host'] = chromecast.host
-    self._cast_info['port'] = chromecast.port
-    self._cast_info['friendly_name'] = chromecast.device.friendly_name
-    self._cast_info['model_name'] = chromecast.device.model_name
-    self._cast_info['manufacturer'] = chromecast.device.manufacturer
-    self._cast_info['uuid'] = chromecast.device.uuid
-    self._cast_info['cast_type'] = chromecast.device.cast_type
+    param device: Spotify device id/media_player entity_id/Alias (from app config device_aliases)
+    """
+    if device in self._device_aliases:
+      return self._device_aliases[device]
+    for mp in (await self.get_state('media_player')).values():
+      if mp['entity_id'] == device:
+        return mp['attributes']['friendly_name']
+    dev_name = self._map_spotify_devid_to_name(device)
+    if dev_name:
+      return dev_name
+    return device
 
-    self._chromecast = chromecast
 
-    self._status_listener = CastStatusListener(self, chromecast, self.logger, self._debug_level)
+  async def _async_device_id(self, device):
+    """ Returns the Spotify device id for a device name/id cached by the play method """
+    if device is None:
+      return None
+    device_id = await self.async_map_chromecasts(device)
+    return self._spotify_devices.get(device_id, device_id)
 
-    # Assume connection is successful until told otherwise
-    self._available = True
 
-  def new_cast_status(self, cast_status):
-    """ Handle updates of the cast status """
-    self.cast_status = cast_status
-    # self.logger.log('[{}] Received new cast device status on.'.format(self.name))
+  async def async_transfer_playback(self, device, force_cc_update=False):
+    """
+    Async version of transfer_playback
 
-  def new_media_status(self, media_status):
-    """ Handle updates of the media status """
-    self.media_status = media_status
-    # self.logger.log('[{}] Received new cast device media status on.'.format(self.name))
+    param device: Spotify device name/media_player id/Spotify device id
+    param force_cc_update: Force a chromecast update
+    """
+    device_name = await self.async_map_chromecasts(device)
 
-  def new_connection_status(self, connection_status):
-    """ Handle updates of connection status """
-    self.connection_status = connection_status.status
-    # self.logger.log("[{}] Received new cast device connection status: {}".format(self.name, connection_status.status), self._debug_level)
+    for attempt in range(MAX_TRANSFER_ATTEMPTS + 1):
+      if attempt and self._circuit_open('player'):
+        self.log('The Spotify player API is unavailable, not retrying to transfer playback to: "{}".'.format(device_name), level='WARNING')
+        return False
+      if attempt:
+        self.log('Retrying transfering playback now...', level=self.DEBUG_LEVEL)
+        with self._span('transfer_playback.retry', attempt=attempt):
+          await asyncio.sleep(2)
+        force_cc_update = True
 
-    if connection_status.status == CONNECTION_STATUS_DISCONNECTED:
-      self._available = False
-      self._invalidate()
-      return
+      dev_id = await self._async_get_spotify_device_devid(device_name, force_cc_update)
+      if dev_id:
+        self._last_device = device_name
+        if await self._async_transfer_playback(dev_id, True):
+          return True
 
-    new_available = connection_status.status == CONNECTION_STATUS_CONNECTED
-    if new_available != self._available:
-      # Connection status callbacks happen often when disconnected.
-      # Only update state when availability changed
-      # self.logger.log("[{}] Cast device availability changed: {}".format(self.name, connection_status.status), self._debug_level)
-      self._available = new_available
+    self.log('Max retries reached trying to transfer playback to: "{}".'.format(device_name), level='ERROR')
+    return False
+
+
+  @_traced('transfer_playback.transfer')
+  async def _async_transfer_playback(self, spotify_device_id, force_play=True):
+    """
+    Async version of _transfer_playback
+
+    param device: Valid Spotify device id
+    param force_play: State of playback when transfered (True: Play, False: Maintain current state)
+    """
+    device_name = self._map_spotify_devid_to_name(spotify_device_id) or spotify_device_id
+    try:
+      await self._web_api.transfer_playback(device_id=spotify_device_id, force_play=force_play)
+      self.log('Transfering music to: "{}".'.format(device_name), level=self.DEBUG_LEVEL)
+    except spotipy.client.SpotifyException as e:
+      self.log('Error transfering music on Spotify device ("{}"): {}'.format(device_name, e), level='ERROR')
+      return False
+    return True
+
+
+  async def async_play(self, device, uri, offset=None, force_cc_update=False, position_ms=None, shuffle=None, repeat=None):
+    """
+    Async version of play
+
+    Retries wait with asyncio.sleep instead of scheduling a new callback, returns True when playback started
+
+    param device: Spotify device name/media_player id/Spotify device id
+    param uri: Spotify track/playlist/artist/album uri/list of tracks
+    param offset: Provide offset as an int or track uri to start playback at a particular offset.
+    param force_cc_update: Force a chromecast update
+    param position_ms: Position in the starting track to start playback at (milliseconds)
+    param shuffle: Shuffle state to set once playback started (optional)
+    param repeat: Repeat state to set once playback started (optional)
+    """
+    device_name = await self.async_map_chromecasts(device)
+
+    uri = self._playable_uri(uri)
+    if uri is None:
+      return False
+
+    for attempt in range(MAX_PLAY_ATTEMPTS + 1):
+      if attempt and self._circuit_open('player'):
+        self.log('The Spotify player API is unavailable, not retrying to play Spotify music on: "{}".'.format(device_name), level='WARNING')
+        return False
+      if attempt:
+        self.log('Retrying playing Spotify music now...', level=self.DEBUG_LEVEL)
+        with self._span('play.retry', attempt=attempt):
+          await asyncio.sleep(1)
+        force_cc_update = True
+
+      dev_id = await self._async_get_spotify_device_devid(device_name, force_cc_update)
+      if dev_id:
+        self._last_device = device_name
+        if await self._async_play(dev_id, uri, offset, position_ms):
+          break
+    else:
+      self.log('Max retries reached trying to play Spotify music on: "{}". No music will play.'.format(device_name), level='ERROR')
+      return False
+
+    # Only change the play modes of the device and music that actually started
+    if shuffle is not None:
+      await self.async_shuffle(shuffle, device_name)
+    if repeat is not None:
+      await self.async_repeat(repeat, device_name)
+    return True
+
+
+  @_traced('play.start_playback')
+  async def _async_play(self, spotify_device_id, uri, offset=None, position_ms=None):
+    """
+    Async version of _play
+
+    param spotify_device_id: Spotify device id
+    param uri: A valid Spotify uri
+    param offset: Provide offset as an int or track uri to start playback at a particular position. (Works for playlist/album/list of tracks)
+    param position_ms: Position in the starting track to start playback at (milliseconds)
+    """
+    device_name = self._map_spotify_devid_to_name(spotify_device_id) or spotify_device_id
+    # Stop following the chunks of a previous play
+    self._play_id += 1
+    if self._chunks_task is not None:
+      self._chunks_task.cancel()
+      self._chunks_task = None
+    args, chunks = self._start_playback_args(uri, offset)
+    try:
+      await self._web_api.start_playback(device_id=spotify_device_id, position_ms=position_ms, **args)
+      self._snapshot_uri = uri
+    except spotipy.client.SpotifyException as e:
+      self.log('Error playing music on Spotify device ("{}"): {}'.format(device_name, e), level='ERROR')
+      return False
+
+    if chunks is not None:
+      self.log('Playing the list of {} tracks in chunks of {}.'.format(len(chunks), chunks.size), level=self.DEBUG_LEVEL)
+      self._chunks_task = asyncio.ensure_future(self._async_follow_chunks(spotify_device_id, chunks))
+    # Logging needs extra lookups, don't hold up the caller
+    asyncio.ensure_future(self._async_log_playback_action(uri, device_name))
+    if self._playback_sensor:
+      asyncio.ensure_future(self.run_in_executor(self._wake_playback_poller))
+    return True
+
+
+  async def _async_follow_chunks(self, spotify_device_id, chunks):
+    """
+    Async version of _next_chunk_callback, follows the playback and plays the next chunk when the one playing ends
+
+    The task is cancelled when something else is played, it also stops when the synchronous methods played something
+
+    param spotify_device_id: Spotify device id
+    param chunks: ChunkedTrackList being played
+    """
+    play_id = self._play_id
+    delay = CHUNK_CHECK_DELAY
+    while delay is not None:
+      await asyncio.sleep(delay)
+      if play_id != self._play_id:
+        return
+      delay = chunks.check(await self.async_get_playback_info())
+      if delay == 0:
+        try:
+          await self._web_api.start_playback(device_id=spotify_device_id, uris=chunks.next_chunk())
+        except spotipy.client.SpotifyException as e:
+          self.log('Failed to play the next chunk, {} tracks will not play: {}'.format(chunks.remaining(), e), level='WARNING')
+          return
+        delay = CHUNK_CHECK_DELAY
+
+
+  @_traced('device.resolve')
+  async def _async_get_spotify_device_devid(self, device_name, force_cc_update=False):
+    """
+    Async version of _get_spotify_device_devid, the Chromecast operations run in an executor
+
+    param device_name: Spotify device name
+    """
+    dev_id = None
+    with self._span('cast.get_device'):
+      cast_device = await self._async_run(self._get_cast_device, device_name, force_cc_update)
+    is_cc_device = cast_device is not None
+    if not force_cc_update and (not is_cc_device or cast_device.spotify_ready(self._access_token)):
+      dev_id = await self._async_search_spotify_for_device(device_name)
+
+    if dev_id is None and is_cc_device:
+      with self._span('cast.register_spotify'):
+        # The executor thread needs the context for the token of the event's account
+        registered = await self._async_run(self._register_spotify_on_cast_device, device_name, force_cc_update)
+      if not registered:
+        return None
+      dev_id = await self._async_search_spotify_for_device(device_name)
+
+    return dev_id
+
+
+  async def _async_lookup_spotify_device(self, device_name):
+    """
+    Look up the Chromecast and the Spotify device id of a device without launching Spotify on it
+
+    Failures are only logged, playing looks the device up again
+
+    param device_name: Spotify device name
+    """
+    try:
+      with self._span('cast.get_device'):
+        cast_device = await self._async_run(self._get_cast_device, device_name)
+      if cast_device is None or cast_device.spotify_ready(self._access_token):
+        await self._async_search_spotify_for_device(device_name)
+    except (spotipy.client.SpotifyException, OSError) as e:
+      self.log('Failed to look up the Spotify device "{}": {}'.format(device_name, e), level=self.DEBUG_LEVEL)
+
+
+  @_traced('device.search')
+  async def _async_search_spotify_for_device(self, device_name):
+    """
+    Async version of _search_spotify_for_device
+
+    param device_name: The Spotify device name
+    """
+    if device_name in self._spotify_devices:
+      return self._spotify_devices[device_name]
+    # The shared cache and the registry file are read and written in executors, they can wait on another instance
+    if await self._async_run(self._load_shared_device, device_name):
+      return self._spotify_devices[device_name]
+
+    devs = await self._web_api.devices()
+    for d in devs['devices']:
+      if d['name'] == device_name:
+        self._spotify_devices[device_name] = d['id']
+        await self._async_run(self._save_device_registry)
+        return d['id']
+    return None
+
+
+  async def _async_log_playback_action(self, uri, device):
+    """
+    Run _log_playback_action in an executor
+
+    param uri: A valid Spotify uri
+    param device: Device name music is playing on
+    """
+    try:
+      await self._async_run(self._log_playback_action, uri, device)
+    except (spotipy.client.SpotifyException, requests.exceptions.RequestException, KeyError) as e:
+      self.log('Failed to look up what is playing on "{}": {}'.format(device, e), level=self.DEBUG_LEVEL)
+
+  ######################   ASYNC PLAY SPOTIFY MUSIC METHODS END   ########################
+
+
+  ######################   ASYNC SPOTIFY DEVICE CONTROLS METHODS   ########################
+
+  async def _spotify_controls_event_callback(self, event_name, data, kwargs):
+    """ Async callback for the controls event (See SpotifyClient._spotify_controls_event_callback) """
+    await self._async_wait_until_ready()
+    with self._use_account(self._event_account(data)), self._trace(event_name, action=data.get('action', None)):
+      await self._async_handle_controls_event(data)
+    if self._playback_sensor:
+      await self.run_in_executor(self._wake_playback_poller)
+
+
+  async def _async_handle_controls_event(self, data):
+    """
+    Async version of _handle_controls_event
+
+    param data: Dictionary containing the controls event parameters (See the documentation)
+    """
+    action = data.get('action', None)
+
+    if action == 'pause':
+      self.log('Spotify device paused.', level=self.DEBUG_LEVEL)
+      await self.async_pause()
+    elif action == 'resume':
+      self.log('Spotify device resumed.', level=self.DEBUG_LEVEL)
+      await self.async_resume()
+    elif action == 'stop':
+      self.log('Spotify device stopped.', level=self.DEBUG_LEVEL)
+      await self.async_pause()
+    elif action in ['skip', 'next', 'next_track']:
+      self.log('Spotify device skipped track.', level=self.DEBUG_LEVEL)
+      await self.async_next_track()
+    elif action in ['previous', 'previous_track']:
+      self.log('Spotify device skipped to previous track.', level=self.DEBUG_LEVEL)
+      await self.async_previous_track()
+    elif action == 'decrease_volume':
+      self.log('Reduced Spotify device volume.', level=self.DEBUG_LEVEL)
+      current_volume = await self.async_current_volume()
+      await self.async_set_volume(current_volume - 5)
+    elif action == 'increase_volume':
+      self.log('Increased Spotify device volume.', level=self.DEBUG_LEVEL)
+      current_volume = await self.async_current_volume()
+      if current_volume < 0:
+        current_volume = 0
+      await self.async_set_volume(current_volume + 5)
+    elif action == 'mute':
+      self.log('Spotify device was muted.', level=self.DEBUG_LEVEL)
+      await self.async_set_volume(0)
+    elif action == 'snapshot':
+      self.log('Taking a snapshot of the current playback.', level=self.DEBUG_LEVEL)
+      await self.async_take_playback_snapshot(data.get('snapshot_name', DEFAULT_SNAPSHOT_NAME))
+    elif action == 'restore':
+      self.log('Resuming playback from the previous snapshot.', level=self.DEBUG_LEVEL)
+      device = data.get('device', None)
+      await self.async_restore_playback_from_snapshot(device, data.get('snapshot_name', DEFAULT_SNAPSHOT_NAME))
+    elif action == 'profile':
+      # Sampling the stacks and comparing snapshots is not Web API work, it runs in an executor
+      await self.run_in_executor(self.profile, data.get('command', 'start'), data.get('duration', None))
+
+    if 'volume_level' in data:
+      volume_level = data.get('volume_level', None)
+      if volume_level:
+        try:
+          await self.async_set_volume(int(volume_level))
+          self.log('Set the current Spotify device volume to "{}" percent.'.format(volume_level), level=self.DEBUG_LEVEL)
+        except ValueError:
+          self.log('Please specify a volume_level between 0 and 100 to set the Spotify device volume.', level='WARNING')
+
+    if 'transfer_playback' in data:
+      device = data.get('transfer_playback', None)
+      await self.async_transfer_playback(device)
+
+
+  async def async_get_playback_info(self):
+    """ Async version of get_playback_info, needs a single Web API call """
+    cached = self._cached_playback()
+    if cached is not None:
+      return cached
+    if self._circuit_open('player'):
+      return self._cast_playback_info() or self._playback or {}
+    try:
+      playback_info = await self._web_api.current_playback() or {}
+    except spotipy.client.SpotifyException:
+      # Needed to catch improper credentials error
+      return {}
+    if self._account is not self._main_account:
+      # The poller and the sensor follow the main account
+      return playback_info
+    if self._playback_sensor and playback_info and self._playback_poll_timer is None:
+      # The scheduler calls are made from an executor thread
+      await self.run_in_executor(self._store_and_schedule_playback, playback_info)
+    else:
+      self._playback = playback_info
+      self._playback_fetched = time.monotonic()
+    return playback_info
+
+
+  def _store_and_schedule_playback(self, playback_info):
+    """ Store the playback info fetched by an async reader and start the stopped poller """
+    self._store_playback(playback_info)
+    self._schedule_playback_poll(playback_info)
+
+
+  async def async_is_active(self):
+    """ Async version of is_active """
+    return bool(await self.async_get_playback_info())
+
+
+  async def async_current_volume(self):
+    """ Async version of current_volume """
+    playback_info = await self.async_get_playback_info()
+    if not playback_info:
+      return 0
+    return playback_info.get('device', {}).get('volume_percent', None)
+
+
+  async def async_repeat(self, state, device=None):
+    """
+    Async version of repeat
+
+    param state: Desired repeat state (track, context, or off)
+    param device: Spotify device id (or name if the play method has cached the device)
+    """
+    if await self.async_is_active():
+      await self._web_api.repeat(state, await self._async_device_id(device))
+
+
+  async def async_shuffle(self, state, device=None):
+    """
+    Async version of shuffle
+
+    param state: Desired shuffle state (True/False)
+    param device: Spotify device id (or name if the play method has cached the device)
+    """
+    if await self.async_is_active():
+      await self._web_api.shuffle(state, await self._async_device_id(device))
+
+
+  async def async_next_track(self):
+    """ Async version of next_track """
+    if await self.async_is_active():
+      await self._web_api.next_track()
+
+
+  async def async_previous_track(self):
+    """ Async version of previous_track """
+    if await self.async_is_active():
+      await self._web_api.previous_track()
+
+
+  async def async_pause(self):
+    """ Async version of pause """
+    if await self.async_is_active():
+      await self._web_api.pause_playback()
+
+
+  async def async_resume(self):
+    """ Async version of resume """
+    if await self.async_is_active():
+      await self._web_api.start_playback()
+
+
+  async def async_set_volume(self, volume):
+    """
+    Async version of set_volume
+
+    param volume: Desired volume level (1 - 100)
+    """
+    if await self.async_is_active():
+      if 0 < volume < 1:
+        volume = int(volume*100)
+      await self._web_api.volume(volume)
+
+
+  async def async_take_playback_snapshot(self, name=DEFAULT_SNAPSHOT_NAME):
+    """
+    Async version of take_playback_snapshot
+
+    param name: Name of the snapshot slot
+    """
+    result = await self.async_get_playback_info()
+    await self._async_run(self._store_snapshot, name, result)
+
+
+  async def async_restore_playback_from_snapshot(self, device=None, name=DEFAULT_SNAPSHOT_NAME):
+    """
+    Async version of restore_playback_from_snapshot
+
+    param device: Spotify device name to restore the playback on (optional)
+    param name: Name of the snapshot slot to restore
+    """
+    snapshot = self._snapshots.get(name)
+    if not snapshot:
+      self.log('Cannot restore playback since the snapshot "{}" did not capture anything.'.format(name), level='WARNING')
+      return
+
+    uri, offset = self._snapshot_music(snapshot)
+    dev = device if device else snapshot['device_name']
+    self.log('Restoring snapshot "{}" to: "{}".'.format(name, await self.async_map_chromecasts(dev)), level=self.DEBUG_LEVEL)
+
+    shuffle, repeat = self._snapshot_play_modes(snapshot, await self.async_get_playback_info())
+    await self.async_play(dev, uri, offset, position_ms=snapshot['progress_ms'], shuffle=shuffle, repeat=repeat)
+
+  ######################   ASYNC SPOTIFY DEVICE CONTROLS METHODS END   ########################
+
+
+  ######################   ASYNC SPOTIFY PLAY EVENT HANDLING METHODS   ########################
+
+  async def _spotify_play_event_callback(self, event_name, data, kwargs):
+    """ Async callback for the play event (See SpotifyClient._spotify_play_event_callback) """
+    await self._async_wait_until_ready()
+    with self._use_account(self._event_account(data)), self._trace(event_name, device=data.get('device', None)):
+      await self._async_handle_play_event(data)
+
+
+  async def _async_handle_play_event(self, data):
+    """
+    Async version of _handle_play_event
+
+    param data: Dictionary containing user parameters (See the documentation)
+    """
+    d = data
+
+    device = d.get('device', None)
+    if not device:
+      self.log('Please specify a device.', level='WARNING')
+      return
+
+    random_start = True if d.get('random_start', False) else False
+    shuffle = True if d.get('shuffle', False) else False
+    repeat = d.get('repeat', 'off')
+    if repeat not in ['track', 'context', 'off']:
+      self.log("Invalid repeat state specified: {}, choose one of 'track', 'context', 'off'. Repeat set to 'off'.".format(repeat), level='WARNING')
+      repeat = 'off'
+
+    # Look up the device while the music is found, Spotify is only launched on a Chromecast once there is music to play
+    lookup = asyncio.ensure_future(self._async_lookup_spotify_device(await self.async_map_chromecasts(device)))
+    try:
+      to_play = await self.async_get_recommendation(data)
+      if to_play:
+        await lookup
+    finally:
+      lookup.cancel()
+
+    if to_play:
+      offset = None
+      if random_start:
+        self.log('Random start is turned on.', level=self.DEBUG_LEVEL)
+        offset = await self._async_run(self._get_random_offset, to_play)
+      if await self.async_play(device, to_play, offset):
+        await asyncio.gather(self.async_repeat(repeat), self.async_shuffle(shuffle))
+        if repeat != 'off': self.log('Repeat is turned on to "{}".'.format(repeat), level=self.DEBUG_LEVEL)
+        if shuffle: self.log('Shuffle is turned on.')
+    else:
+      self.log('Nothing was found matching your "{}" event parameters. No music will play.'.format(self._event_play), level='INFO')
+
+
+  async def async_get_recommendation(self, data):
+    """
+    Run get_recommendation in an executor
+
+    param data: Dictionary containing user parameters (See the documentation)
+    """
+    return await self._async_run(self.get_recommendation, data)
+
+  ######################   ASYNC SPOTIFY PLAY EVENT HANDLING METHODS END   ########################
+
+
+class LibraryIndex:
+  """ Local SQLite index of the user's saved tracks along with their artists and albums
+
+  The first sync downloads the whole library. Spotify returns saved tracks newest first, so later
+  syncs stop paging as soon as they reach a track that is older than the newest 'added_at' in the index.
+  A full sync is done again whenever the number of indexed tracks no longer matches the library
+  (ex: tracks were removed from the library).
+  """
+
+  PAGE_SIZE = 50
+
+  def __init__(self, path, logger, debug_level='DEBUG'):
+    self.logger = logger
+    self._debug_level = debug_level
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(path, check_same_thread=False)
+    with self._lock, self._conn:
+      self._conn.executescript("""
+        CREATE TABLE IF NOT EXISTS tracks (
+          uri TEXT PRIMARY KEY, name TEXT, added_at TEXT, album_uri TEXT, duration_ms INTEGER);
+        CREATE INDEX IF NOT EXISTS tracks_added_at ON tracks (added_at);
+        CREATE TABLE IF NOT EXISTS artists (uri TEXT PRIMARY KEY, name TEXT);
+        CREATE TABLE IF NOT EXISTS albums (uri TEXT PRIMARY KEY, name TEXT, artist_uri TEXT);
+        CREATE TABLE IF NOT EXISTS track_artists (
+          track_uri TEXT, artist_uri TEXT, position INTEGER, PRIMARY KEY (track_uri, artist_uri));
+      """)
+    self.synced = self.count() > 0
+
+  def sync(self, sp):
+    """ 
+    Bring the index up to date with the saved tracks on Spotify
+
+    param sp: spotipy.Spotify client
+    """
+    newest = self._query_one('SELECT MAX(added_at) FROM tracks')
+    items, total = self._fetch(sp, newest)
+    with self._lock, self._conn:
+      self._store(items)
+
+    count = self.count()
+    if newest is not None and count != total:
+      self.logger.log('Library index is out of date ({} indexed, {} saved), doing a full sync.'.format(count, total), level=self._debug_level)
+      items, total = self._fetch(sp)
+      with self._lock, self._conn:
+        for table in ['tracks', 'artists', 'albums', 'track_artists']:
+          self._conn.execute('DELETE FROM {}'.format(table))
+        self._store(items)
+      count = self.count()
+
+    self.synced = True
+    self.logger.log('Library index synced: {} tracks fetched, {} tracks indexed.'.format(len(items), count), level=self._debug_level)
+
+  def _fetch(self, sp, since=None):
+    """ 
+    Returns the saved track items added at or after 'since' (all when None) and the library size
+
+    param sp: spotipy.Spotify client
+    param since: Timestamp of the newest indexed track (ISO 8601 format)
+    """
+    items = []
+    offset = 0
+    while True:
+      page = sp.current_user_saved_tracks(limit=self.PAGE_SIZE, offset=offset)
+      for item in page['items']:
+        if since is not None and item['added_at'] < since:
+          return items, page['total']
+        items.append(item)
+      if not page['next'] or not page['items']:
+        return items, page['total']
+      offset += len(page['items'])
+
+  def _store(self, items):
+    """ Insert or update saved track items, must be called with the lock held inside a transaction """
+    for item in items:
+      track = item.get('track')
+      if not track:
+        continue
+      album = track.get('album') or {}
+      album_artists = album.get('artists') or [{}]
+      self._conn.execute('INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?)',
+                         (track['uri'], track['name'], item['added_at'], album.get('uri'), track.get('duration_ms')))
+      if album.get('uri'):
+        self._conn.execute('INSERT OR REPLACE INTO albums VALUES (?, ?, ?)', (album['uri'], album.get('name'), album_artists[0].get('uri')))
+      for position, artist in enumerate(track.get('artists', [])):
+        self._conn.execute('INSERT OR REPLACE INTO artists VALUES (?, ?)', (artist['uri'], artist['name']))
+        self._conn.execute('INSERT OR REPLACE INTO track_artists VALUES (?, ?, ?)', (track['uri'], artist['uri'], position))
+
+  def _query(self, sql, params=()):
+    with self._lock:
+      return self._conn.execute(sql, params).fetchall()
+
+  def _query_one(self, sql, params=()):
+    rows = self._query(sql, params)
+    return rows[0][0] if rows else None
+
+  def count(self):
+    """ Returns the number of indexed saved tracks """
+    return self._query_one('SELECT COUNT(*) FROM tracks')
+
+  def saved_tracks(self, limit=None):
+    """ Returns saved track uri's, newest first """
+    if limit is None:
+      return [r[0] for r in self._query('SELECT uri FROM tracks ORDER BY added_at DESC')]
+    return [r[0] for r in self._query('SELECT uri FROM tracks ORDER BY added_at DESC LIMIT ?', (limit,))]
+
+  def random_tracks(self, limit):
+    """ Returns randomly chosen saved track uri's """
+    return [r[0] for r in self._query('SELECT uri FROM tracks ORDER BY RANDOM() LIMIT ?', (limit,))]
+
+  def artists(self):
+    """ Returns the uri's of the artists in the saved tracks library """
+    return [r[0] for r in self._query('SELECT uri FROM artists')]
+
+  def albums(self):
+    """ Returns the uri's of the albums in the saved tracks library """
+    return [r[0] for r in self._query('SELECT uri FROM albums')]
+
+  def named_entries(self):
+    """ Returns the indexed (uri, name, artist name, artist uri) tuples for each uri type """
+    return {
+      'track' : self._query('SELECT t.uri, t.name, a.name, a.uri FROM tracks t '
+                            'LEFT JOIN track_artists ta ON ta.track_uri = t.uri AND ta.position = 0 '
+                            'LEFT JOIN artists a ON a.uri = ta.artist_uri'),
+      'album' : self._query('SELECT al.uri, al.name, ar.name, ar.uri FROM albums al LEFT JOIN artists ar ON ar.uri = al.artist_uri'),
+      'artist' : [(uri, name, None, None) for uri, name in self._query('SELECT uri, name FROM artists')],
+    }
+
+  def artist_tracks(self, artist_uri):
+    """ Returns the saved track uri's from an artist """
+    return [r[0] for r in self._query('SELECT track_uri FROM track_artists WHERE artist_uri = ?', (artist_uri,))]
+
+  def close(self):
+    with self._lock:
+      self._conn.close()
+
+
+class FuzzyNameIndex:
+  """ In-memory trigram index that resolves misspelled or partial names to Spotify uri's
+
+  Names are compared using the Dice coefficient of their character trigrams. A query that is
+  contained in a longer name only scores well when it covers most of that name, so a short query
+  (ex: "Hello") is not taken for a longer saved name (ex: "Hello Goodbye") and is searched instead.
+  When an artist is requested, the confidence is multiplied by how well the artist of the name matches.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._entries = {}          # (kind, uri) -> (name, trigrams, artist name trigrams, artist uri)
+    self._postings = {}         # (kind, trigram) -> set of uri's
+
+  def __len__(self):
+    return len(self._entries)
+
+  @staticmethod
+  def normalize(name):
+    """ Lower case the name and remove accents, punctuation and extra whitespace """
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c)).lower()
+    return ' '.join(re.sub(r'[^\w\s]', ' ', name).split())
+
+  @classmethod
+  def trigrams(cls, name):
+    """ Returns the set of character trigrams of the normalized name """
+    name = '  {} '.format(cls.normalize(name))
+    return {name[i:i+3] for i in range(len(name) - 2)}
+
+  @staticmethod
+  def _score(query, grams):
+    """ Similarity between two trigram sets (0 - 1) """
+    if not query or not grams:
+      return 0.0
+    shared = len(query & grams)
+    dice = 2.0 * shared / (len(query) + len(grams))
+    if len(query) < 5:
+      # Containment is meaningless for very short queries
+      return dice
+    # Weight containment by how much of the name the query covers
+    coverage = min(1.0, float(len(query)) / len(grams))
+    return max(dice, 0.9 * shared / len(query) * math.sqrt(coverage))
+
+  def add(self, kind, name, uri, artist_name=None, artist_uri=None):
+    """ 
+    Add or replace a name in the index
+
+    param kind: The uri type ('track', 'playlist', 'artist', 'album')
+    param name: The name of the item
+    param uri: The Spotify uri of the item
+    param artist_name: The name of the artist of a track/album (optional)
+    param artist_uri: The uri of the artist of a track/album (optional)
+    """
+    if not name or not uri:
+      return
+    grams = self.trigrams(name)
+    artist_grams = self.trigrams(artist_name) if artist_name else None
+    with self._lock:
+      old = self._entries.get((kind, uri))
+      if old:
+        for gram in old[1]:
+          self._postings.get((kind, gram), set()).discard(uri)
+      self._entries[(kind, uri)] = (name, grams, artist_grams, artist_uri)
+      for gram in grams:
+        self._postings.setdefault((kind, gram), set()).add(uri)
+
+  def merge(self, other):
+    """ Add the entries from another index that are not already in this one """
+    if other is None:
+      return
+    with other._lock:
+      entries = list(other._entries.items())
+    for (kind, uri), (name, grams, artist_grams, artist_uri) in entries:
+      if (kind, uri) in self._entries:
+        continue
+      with self._lock:
+        self._entries[(kind, uri)] = (name, grams, artist_grams, artist_uri)
+        for gram in grams:
+          self._postings.setdefault((kind, gram), set()).add(uri)
+
+  def lookup(self, kind, query, artist=None):
+    """ 
+    Returns the best (uri, name, confidence) match for the query or (None, None, 0.0)
+
+    param kind: The uri type ('track', 'playlist', 'artist', 'album')
+    param query: The name to look for
+    param artist: Artist uri or name the result must belong to (optional), names of other artists or without a known artist don't match
+    """
+    query_grams = self.trigrams(query)
+    artist_grams = None
+    if artist and not artist.startswith('spotify:'):
+      artist_grams = self.trigrams(artist)
+
+    with self._lock:
+      candidates = set()
+      for gram in query_grams:
+        candidates |= self._postings.get((kind, gram), set())
+      entries = [(uri, self._entries[(kind, uri)]) for uri in candidates]
+
+    best = (None, None, 0.0)
+    for uri, (name, grams, entry_artist_grams, entry_artist_uri) in entries:
+      score = self._score(query_grams, grams)
+      if artist:
+        # The same name by another artist is not a match, it is searched instead
+        if artist_grams is None:
+          score *= 1.0 if artist == entry_artist_uri else 0.0
+        else:
+          score *= self._score(artist_grams, entry_artist_grams) if entry_artist_grams else 0.0
+      if score > best[2]:
+        best = (uri, name, score)
+    return best
+
+
+class SpotifyAccount:
+  """ Credentials, Web API client, token and Spotify devices of one Spotify account of the app """
+
+  def __init__(self, username, password, token_file, devices=()):
+    self.username = username
+    self.password = password
+    self.token_file = token_file        # File the access token is saved to
+    self.devices = set(devices)         # Device names/aliases that play with this account
+    self.sp = None                      # Spotify client object
+    self.web_api = None                 # AsyncSpotifyWebAPI (AsyncSpotifyClient only)
+    self.chunks_task = None             # asyncio task following the chunks of a long list of tracks (AsyncSpotifyClient only)
+    self.access_token = None            # Spotify access token
+    self.token_expires_at = None        # Time (epoch seconds) the Spotify token expires
+    self.token_timer = None             # Handle of the scheduled token renewal
+    self.spotify_devices = {}           # Spotify device_name -> device_id
+    self.play_id = 0                    # Incremented on every play so following the chunks of an older list of tracks stops
+
+
+class Deadline:
+  """ Time budget of a play event, shared with the resolver steps through the _deadline context variable """
+
+  def __init__(self, seconds):
+    self.seconds = seconds
+    self.expires_at = time.monotonic() + seconds
+    self.expired = False
+
+  def remaining(self):
+    """ Returns the seconds left (0 when the deadline passed) """
+    return max(0, self.expires_at - time.monotonic())
+
+  def passed(self):
+    """ Returns True once the deadline passed """
+    if not self.expired and time.monotonic() >= self.expires_at:
+      self.expired = True
+    return self.expired
+
+  def cancel(self):
+    """ End the time budget now, the steps sharing the deadline stop before their next Web API call """
+    self.expired = True
+
+
+class TTLCache:
+  """ Thread safe dictionary whose entries expire ttl seconds after they were set
+
+  The oldest entries are evicted when there are more than max_entries.
+  """
+
+  def __init__(self, ttl, max_entries=256):
+    self._ttl = ttl
+    self._max_entries = max_entries
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()   # key -> (expiry time.monotonic(), value)
+
+  def __len__(self):
+    return len(self._entries)
+
+  @property
+  def ttl(self):
+    return self._ttl
+
+  def get(self, key, default=None):
+    """ Returns the value of the key or default if it is missing or expired """
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        return default
+      if entry[0] <= time.monotonic():
+        del self._entries[key]
+        return default
+      return entry[1]
+
+  def set(self, key, value):
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (time.monotonic() + self._ttl, value)
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+
+class SharedCache:
+  """ Key/value store in a SQLite file shared by the SpotifyClient instances of a host
+
+  Values are JSON, stored under a namespace and a key with an optional time to live. The database uses
+  write-ahead logging so reading never waits for a writer. update() is an atomic read-modify-write: the
+  database stays locked for writing while the new value is computed, so when several instances need the
+  same thing (ex: a new token) only the first one does the work and the others get its result.
+  Errors are logged and handled like cache misses, the instances keep working on their own.
+  The database holds the tokens, it is only readable by its owner.
+  """
+
+  def __init__(self, path, logger):
+    self._path = path
+    self.logger = logger
+    self._local = threading.local()     # Each thread has its own connection
+    self._lock = threading.Lock()
+    self._connections = []
+    try:
+      # SQLite creates the -wal and -shm files with the permissions of the database
+      os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+      self._connection().execute("""
+        CREATE TABLE IF NOT EXISTS entries (
+          namespace TEXT, key TEXT, value TEXT, expires REAL, PRIMARY KEY (namespace, key))""")
+      # O_CREAT doesn't change the mode of files that already existed
+      for file in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(file):
+          os.chmod(file, 0o600)
+    except (OSError, sqlite3.Error) as e:
+      self.logger.log('Failed to open the shared cache "{}": {}'.format(path, e), level='WARNING')
+    self.purge()
+
+  def _connection(self):
+    conn = getattr(self._local, 'conn', None)
+    if conn is None:
+      # Autocommit mode, update() begins its own transaction
+      conn = sqlite3.connect(self._path, timeout=SHARED_CACHE_BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+      conn.execute('PRAGMA journal_mode=WAL')
+      conn.execute('PRAGMA synchronous=NORMAL')
+      self._local.conn = conn
+      with self._lock:
+        self._connections.append(conn)
+    return conn
+
+  @staticmethod
+  def _read(conn, namespace, key):
+    row = conn.execute('SELECT value, expires FROM entries WHERE namespace = ? AND key = ?', (namespace, key)).fetchone()
+    if row is None or (row[1] is not None and row[1] <= time.time()):
+      return None
+    return json.loads(row[0])
+
+  @staticmethod
+  def _write(conn, namespace, key, value, ttl):
+    expires = time.time() + ttl if ttl else None
+    conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', (namespace, key, json.dumps(value), expires))
+
+  def get(self, namespace, key):
+    """ Returns the value of the key or None if it is missing or expired """
+    try:
+      return self._read(self._connection(), namespace, key)
+    except (sqlite3.Error, ValueError) as e:
+      self.logger.log('Failed to read "{}" from the shared cache: {}'.format(key, e), level='WARNING')
+      return None
+
+  def set(self, namespace, key, value, ttl=None):
+    """ 
+    Store the value of the key
+
+    param value: JSON serializable value
+    param ttl: Seconds the value is kept (None = until it is replaced)
+    """
+    try:
+      self._write(self._connection(), namespace, key, value, ttl)
+    except sqlite3.Error as e:
+      self.logger.log('Failed to write "{}" to the shared cache: {}'.format(key, e), level='WARNING')
+
+  def update(self, namespace, key, func, ttl=None, timeout=SHARED_CACHE_BUSY_TIMEOUT):
+    """ 
+    Atomically replace the value of the key by func(value) and return the new value
+
+    param func: Called with the current value (None if missing), returns the new value or None to leave it unchanged
+    param ttl: Seconds the new value is kept (None = until it is replaced)
+    param timeout: Seconds to wait for another instance updating the cache
+    """
+    conn = self._connection()
+    try:
+      conn.execute('PRAGMA busy_timeout = {}'.format(int(timeout * 1000)))
+      try:
+        conn.execute('BEGIN IMMEDIATE')
+      finally:
+        conn.execute('PRAGMA busy_timeout = {}'.format(SHARED_CACHE_BUSY_TIMEOUT * 1000))
+    except sqlite3.Error as e:
+      self.logger.log('Failed to lock "{}" in the shared cache, updating it without the lock: {}'.format(key, e), level='WARNING')
+      value = func(self.get(namespace, key))
+      if value is not None:
+        self.set(namespace, key, value, ttl)
+      return value
+
+    computed = False
+    try:
+      try:
+        current = self._read(conn, namespace, key)
+      except ValueError:
+        current = None
+      value = func(current)
+      computed = True
+      if value is not None and value != current:
+        self._write(conn, namespace, key, value, ttl)
+      conn.execute('COMMIT')
+    except sqlite3.Error as e:
+      self._rollback(conn)
+      self.logger.log('Failed to update "{}" in the shared cache, it was not saved: {}'.format(key, e), level='WARNING')
+      return value if computed else func(self.get(namespace, key))
+    except BaseException:
+      self._rollback(conn)
+      raise
+    return value
+
+  @staticmethod
+  def _rollback(conn):
+    try:
+      conn.execute('ROLLBACK')
+    except sqlite3.Error:
+      # The transaction was already rolled back
+      pass
+
+  def purge(self):
+    """ Remove the expired entries """
+    try:
+      self._connection().execute('DELETE FROM entries WHERE expires <= ?', (time.time(),))
+    except sqlite3.Error as e:
+      self.logger.log('Failed to purge the shared cache: {}'.format(e), level='WARNING')
+
+  def close(self):
+    with self._lock:
+      for conn in self._connections:
+        conn.close()
+      self._connections = []
+
+
+class SpotifyURI(collections.namedtuple('SpotifyURI', ['type', 'id'])):
+  """ Parsed Spotify uri (type, id) of a track, playlist, artist or album
+
+  Accepts 'spotify:<type>:<id>' uri's and open.spotify.com urls, str() returns the uri format.
+  """
+
+  TYPES = ('track', 'playlist', 'artist', 'album')
+  # One precompiled matcher for both formats, the type is captured by one of the two groups
+  PATTERN = re.compile(
+    r'(?:spotify:(track|playlist|artist|album):'
+    r'|https?://open\.spotify\.com/(?:intl-[a-zA-Z-]+/)?(?:user/[^/]+/)?(track|playlist|artist|album)/)'
+    r'([0-9A-Za-z]{22})(?:\?\S*)?')
+
+  __slots__ = ()
+
+  @property
+  def uri(self):
+    return 'spotify:{}:{}'.format(self.type, self.id)
+
+  def __str__(self):
+    return self.uri
+
+  @classmethod
+  def parse(cls, value, media_type=None):
+    """
+    Returns the SpotifyURI of a uri/url or None if it is not valid
+
+    param value: Spotify uri or open.spotify.com url
+    param media_type: Type or list of types ('track', 'playlist', 'artist', 'album') the uri must have
+    """
+    if not value or not isinstance(value, str):
+      return None
+    parsed = _parse_spotify_uri(value)
+    if parsed is None or not media_type:
+      return parsed
+    if isinstance(media_type, str):
+      return parsed if parsed.type == media_type else None
+    return parsed if parsed.type in media_type else None
+
+  @classmethod
+  def parse_many(cls, values, media_type=None):
+    """
+    Validate a list of uri's/urls in a single pass, returns the list of SpotifyURI or None if any is not valid
+
+    param values: List of Spotify uri's or open.spotify.com urls
+    param media_type: Type or list of types ('track', 'playlist', 'artist', 'album') every uri must have
+    """
+    if isinstance(media_type, str):
+      media_type = (media_type,)
+    match = cls.PATTERN.fullmatch
+    res = []
+    for value in values:
+      m = match(value) if isinstance(value, str) else None
+      if m is None:
+        return None
+      kind = m.group(1) or m.group(2)
+      if media_type and kind not in media_type:
+        return None
+      res.append(cls(kind, m.group(3)))
+    return res
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_spotify_uri(value):
+  """ Cached parse of a single uri/url, the same values are checked many times while handling an event """
+  m = SpotifyURI.PATTERN.fullmatch(value)
+  if m is None:
+    return None
+  return SpotifyURI(m.group(1) or m.group(2), m.group(3))
+
+
+class TrackCollection(collections.abc.Sequence):
+  """ Compact, de-duplicated collection of Spotify track uri's
+
+  Track ids are base62 encoded 128 bit numbers, each one is stored as 16 bytes in a single buffer
+  instead of a ~90 byte uri string. An open addressing hash table of positions gives O(1)
+  membership without a set of strings. Uri's are rebuilt when they are read, so iterating, indexing,
+  random.choice and random.sample return regular 'spotify:track:<id>' strings. Slicing returns a
+  TrackCollection.
+  """
+
+  ID_SIZE = 16
+  ID_LENGTH = 22
+  URI_PREFIX = 'spotify:track:'
+  ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+  _DIGITS = {c: i for i, c in enumerate(ALPHABET)}
+
+  def __init__(self, uris=()):
+    self._ids = bytearray()     # Track ids, ID_SIZE bytes each in insertion order
+    self._slots = None          # Hash table of positions in _ids (-1 = empty), built on first lookup
+    self.update(uris)
+
+  @classmethod
+  def encode(cls, uri):
+    """ Returns the 16 byte representation of a track uri, url or id (ValueError if it is not a valid track id) """
+    track_id = uri.split('?')[0].rstrip('/').split('/')[-1].split(':')[-1]
+    if len(track_id) != cls.ID_LENGTH:
+      raise ValueError('Invalid Spotify track id: {}'.format(uri))
+    value = 0
+    try:
+      for c in track_id:
+        value = value * 62 + cls._DIGITS[c]
+      return value.to_bytes(cls.ID_SIZE, 'big')
+    except (KeyError, OverflowError):
+      raise ValueError('Invalid Spotify track id: {}'.format(uri))
+
+  @classmethod
+  def decode(cls, raw):
+    """ Returns the track uri of a 16 byte track id """
+    value = int.from_bytes(raw, 'big')
+    chars = []
+    for _ in range(cls.ID_LENGTH):
+      value, digit = divmod(value, 62)
+      chars.append(cls.ALPHABET[digit])
+    return cls.URI_PREFIX + ''.join(reversed(chars))
+
+  def __len__(self):
+    return len(self._ids) // self.ID_SIZE
+
+  def __iter__(self):
+    for i in range(0, len(self._ids), self.ID_SIZE):
+      yield self.decode(self._ids[i:i + self.ID_SIZE])
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      res = TrackCollection()
+      size = self.ID_SIZE
+      for i in range(*index.indices(len(self))):
+        res._ids += self._ids[i * size:(i + 1) * size]
+      return res
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError('TrackCollection index out of range')
+    return self.decode(self._ids[index * self.ID_SIZE:(index + 1) * self.ID_SIZE])
+
+  def __contains__(self, uri):
+    try:
+      return self._find(self.encode(uri))[0] >= 0
+    except (ValueError, AttributeError):
+      return False
+
+  def index(self, uri):
+    """ Returns the position of the track uri (ValueError if it is not in the collection) """
+    pos = self._find(self.encode(uri))[0]
+    if pos < 0:
+      raise ValueError('{} is not in the collection'.format(uri))
+    return pos
+
+  def add(self, uri):
+    """ Add a track uri, returns False if the track was already in the collection """
+    raw = self.encode(uri)
+    pos, slot = self._find(raw)
+    if pos >= 0:
+      return False
+    self._slots[slot] = len(self)
+    self._ids += raw
+    if len(self) * 2 > len(self._slots):
+      self._build_slots(len(self._slots) * 2)
+    return True
+
+  def update(self, uris):
+    """ Add track uri's, duplicates are skipped """
+    for uri in uris:
+      self.add(uri)
+
+  def _find(self, raw):
+    """ Returns (position of the id or -1, hash table slot of the id or of the empty slot to use) """
+    if self._slots is None:
+      self._build_slots()
+    mask = len(self._slots) - 1
+    # The low bits of a track id are already uniformly distributed
+    slot = int.from_bytes(raw[-8:], 'big') & mask
+    size = self.ID_SIZE
+    while True:
+      pos = self._slots[slot]
+      if pos < 0:
+        return -1, slot
+      if self._ids[pos * size:(pos + 1) * size] == raw:
+        return pos, slot
+      slot = (slot + 1) & mask
+
+  def _build_slots(self, capacity=8):
+    """ (Re)build the hash table with at least twice as many slots as tracks """
+    while capacity < len(self) * 2:
+      capacity *= 2
+    self._slots = array.array('i', [-1]) * capacity
+    mask = capacity - 1
+    size = self.ID_SIZE
+    for pos in range(len(self)):
+      slot = int.from_bytes(self._ids[(pos + 1) * size - 8:(pos + 1) * size], 'big') & mask
+      while self._slots[slot] >= 0:
+        slot = (slot + 1) & mask
+      self._slots[slot] = pos
+
+
+class ChunkedTrackList:
+  """ A long list of tracks played as consecutive chunks of tracks
+
+  Spotify only plays the chunk it was given, the playback is checked once per track and the next chunk
+  is played when the last track of the chunk playing ends, so the tracks play in list order. With
+  shuffle on, Spotify shuffles the chunk playing and the next chunk starts once every track of the
+  chunk has been seen playing. With repeat on, the first chunk follows the last one. Nothing is added
+  to the Spotify queue.
+
+  The chunks are aligned on multiples of the chunk size, playing from a track starts the chunk that
+  contains it at the track (offset) so the tracks before it are in the list that plays.
+  """
+
+  def __init__(self, uris, size, start=0):
+    self._uris = uris
+    self.size = size
+    self._start = start - start % size
+    self.offset = start - self._start # Position of the start track in the first chunk
+    self._tracks = set(self.chunk())  # Tracks of the chunk playing
+    self._seen = set()                # Tracks of the chunk seen playing
+
+  def __len__(self):
+    return len(self._uris)
+
+  def chunk(self):
+    """ Returns the tracks of the chunk playing """
+    return list(self._uris[self._start:self._start + self.size])
+
+  def has_next(self):
+    return self._start + self.size < len(self._uris)
+
+  def remaining(self):
+    """ Returns the number of tracks after the chunk playing """
+    return max(0, len(self._uris) - self._start - self.size)
+
+  def next_chunk(self):
+    """ Move to the next chunk (the first one after the last one) and return its tracks """
+    self._start += self.size
+    if self._start >= len(self._uris):
+      self._start = 0
+    self._tracks = set(self.chunk())
+    self._seen = set()
+    return self.chunk()
+
+  def check(self, playback_info):
+    """ 
+    Returns the seconds until the playback should be checked again, 0 to play the next chunk now
+    or None to stop following the playback (something else is playing)
+
+    param playback_info: The current playback info
+    """
+    playback_info = playback_info or {}
+    item = playback_info.get('item') or {}
+    uri = item.get('uri')
+    if uri not in self._tracks:
+      return None
+    self._seen.add(uri)
+    progress = playback_info.get('progress_ms') or 0
+    remaining = max(0, (item.get('duration_ms') or 0) - progress) / 1000.0
+    chunk = self.chunk()
+    if not playback_info.get('is_playing'):
+      if (progress == 0 or remaining <= CHUNK_SWITCH_LEAD) and (uri == chunk[-1] or (uri == chunk[0] and chunk[-1] in self._seen)
+                                                                or (playback_info.get('shuffle_state') and len(self._seen) >= len(self._tracks))):
+        # The switch missed the end of the chunk and Spotify stopped on its last (or back on its first) track
+        return self._switch(playback_info)
+      return CHUNK_PAUSED_INTERVAL
+
+    if playback_info.get('shuffle_state'):
+      last = len(self._seen) >= len(self._tracks)
+    else:
+      last = uri == chunk[-1]
+    if not last or playback_info.get('repeat_state') == 'track':
+      # Check again once the track ends
+      return remaining + 1
+    if remaining > CHUNK_SWITCH_LEAD:
+      return remaining - CHUNK_SWITCH_LEAD
+    return self._switch(playback_info)
+
+  def _switch(self, playback_info):
+    """ Returns 0 to play the next chunk or None at the end of the list (when it doesn't repeat) """
+    if self.has_next() or playback_info.get('repeat_state') == 'context':
+      return 0
+    return None
+
+
+class AsyncSpotifyWebAPI:
+  """ Minimal asyncio client for the Spotify Web API player endpoints used by AsyncSpotifyClient
+
+  Method names, arguments and return values mirror spotipy.Spotify so the async code reads like the
+  synchronous code. Errors are raised as spotipy.client.SpotifyException.
+  """
+
+  PREFIX = 'https://api.spotify.com/v1/'
+  MAX_RETRIES = 3
+
+  def __init__(self, token=None, timeout=10):
+    self._token = token
+    self._timeout = timeout
+    self._session = None
+    self._breakers = {}
+
+  def set_token(self, token):
+    self._token = token
+
+  def set_breakers(self, breakers):
+    """ Guard the requests with the circuit breakers (API group -> CircuitBreaker) """
+    self._breakers = breakers
+
+  async def close(self):
+    if self._session is not None and not self._session.closed:
+      await self._session.close()
+
+  async def _get_session(self):
+    if self._session is None or self._session.closed:
+      import aiohttp
+      self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self._timeout))
+    return self._session
+
+  async def _request(self, method, path, params=None, payload=None):
+    """
+    Send a request to the Web API and return the decoded JSON response (None when there is no content)
+
+    Rate limited and server error responses are retried
+    """
+    if not self._token:
+      raise spotipy.client.SpotifyException(401, -1, 'Spotify is not initialized (no access token).')
+
+    # Only player endpoints are called
+    breaker = self._breakers.get('player')
+    if breaker is None:
+      return await self._send(method, path, params, payload)
+    breaker.before_call()
+    try:
+      res = await self._send(method, path, params, payload)
+    except Exception as e:
+      breaker.record(e)
+      raise
+    except BaseException:
+      # asyncio.CancelledError (the task was cancelled)
+      breaker.abandon()
+      raise
+    breaker.record()
+    return res
+
+  async def _send(self, method, path, params=None, payload=None):
+    """ Send the request, retrying rate limited and server error responses, connection errors and timeouts are raised as SpotifyException """
+    import aiohttp
+    try:
+      return await self._send_request(method, path, params, payload)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      # Counted as a failure by the circuit breaker like a server error
+      raise spotipy.client.SpotifyException(599, -1, '{}{}:\n {}'.format(self.PREFIX, path, repr(e)))
+
+  async def _send_request(self, method, path, params=None, payload=None):
+    session = await self._get_session()
+    url = self.PREFIX + path
+    headers = {'Authorization': 'Bearer {}'.format(self._token)}
+    query = {}
+    for k, v in (params or {}).items():
+      if v is None:
+        continue
+      query[k] = str(v).lower() if isinstance(v, bool) else v
+
+    for attempt in range(self.MAX_RETRIES + 1):
+      async with session.request(method, url, params=query, json=payload, headers=headers) as resp:
+        if resp.status == 429 and attempt < self.MAX_RETRIES:
+          await asyncio.sleep(int(resp.headers.get('Retry-After', 1)))
+          continue
+        if resp.status >= 500 and attempt < self.MAX_RETRIES:
+          await asyncio.sleep(0.3 * 2 ** attempt)
+          continue
+        text = await resp.text()
+        if resp.status >= 400:
+          try:
+            msg = json.loads(text)['error']['message']
+          except (ValueError, KeyError, TypeError):
+            msg = text
+          raise spotipy.client.SpotifyException(resp.status, -1, '{}:\n {}'.format(resp.url, msg), headers=dict(resp.headers))
+        return json.loads(text) if text else None
+
+  ######## Player ########
+
+  async def current_playback(self, market=None):
+    return await self._request('GET', 'me/player', {'market': market})
+
+  async def devices(self):
+    return await self._request('GET', 'me/player/devices')
+
+  async def start_playback(self, device_id=None, context_uri=None, uris=None, offset=None, position_ms=None):
+    data = {}
+    if context_uri is not None:
+      data['context_uri'] = context_uri
+    if uris is not None:
+      data['uris'] = uris
+    if offset is not None:
+      data['offset'] = offset
+    if position_ms is not None:
+      data['position_ms'] = position_ms
+    return await self._request('PUT', 'me/player/play', {'device_id': device_id}, data)
+
+  async def transfer_playback(self, device_id, force_play=True):
+    return await self._request('PUT', 'me/player', payload={'device_ids': [device_id], 'play': force_play})
+
+  async def pause_playback(self, device_id=None):
+    return await self._request('PUT', 'me/player/pause', {'device_id': device_id})
+
+  async def next_track(self, device_id=None):
+    return await self._request('POST', 'me/player/next', {'device_id': device_id})
+
+  async def previous_track(self, device_id=None):
+    return await self._request('POST', 'me/player/previous', {'device_id': device_id})
+
+  async def volume(self, volume_percent, device_id=None):
+    return await self._request('PUT', 'me/player/volume', {'volume_percent': volume_percent, 'device_id': device_id})
+
+  async def seek_track(self, position_ms, device_id=None):
+    return await self._request('PUT', 'me/player/seek', {'position_ms': position_ms, 'device_id': device_id})
+
+  async def shuffle(self, state, device_id=None):
+    return await self._request('PUT', 'me/player/shuffle', {'state': state, 'device_id': device_id})
+
+  async def repeat(self, state, device_id=None):
+    return await self._request('PUT', 'me/player/repeat', {'state': state, 'device_id': device_id})
+
+  async def add_to_queue(self, uri, device_id=None):
+    return await self._request('POST', 'me/player/queue', {'uri': uri, 'device_id': device_id})
+
+
+class EventTracer:
+  """ Records a tree of timed spans for each play/controls event
+
+  Completed traces are written as JSON lines to a rotating file and traces slower than
+  the threshold are logged with their slowest spans.
+  """
+
+  def __init__(self, path, slow_threshold, logger, debug_level='DEBUG'):
+    self._slow_threshold = slow_threshold
+    self.logger = logger
+    self._debug_level = debug_level
+
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=TRACE_FILE_MAX_BYTES, backupCount=TRACE_FILE_BACKUP_COUNT)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    self._writer = logging.getLogger('spotify_client.traces.{}'.format(path))
+    self._writer.setLevel(logging.INFO)
+    self._writer.propagate = False
+    for h in list(self._writer.handlers):
+      # Drop the handler from a previous app reload
+      self._writer.removeHandler(h)
+      h.close()
+    self._writer.addHandler(handler)
+
+  def current_trace_id(self):
+    """ Returns the id of the trace active in this context or None """
+    span = _active_span.get()
+    return span['trace_id'] if span else None
+
+  @contextlib.contextmanager
+  def span(self, name, root=False, **attrs):
+    """ 
+    Record a span as a child of the active span
+
+    param name: Name of the span
+    param root: Start a new trace when no trace is active (otherwise the span is ignored)
+    param attrs: Extra attributes to record with the span
+    """
+    parent = _active_span.get()
+    if parent is None and not root:
+      yield None
+      return
+
+    start = time.perf_counter()
+    span = {
+      'name' : name,
+      'trace_id' : parent['trace_id'] if parent else uuid.uuid4().hex,
+      'offset_ms' : round((start - parent['_start']) * 1000, 3) if parent else 0,
+      'attrs' : {k: v for k, v in attrs.items() if v is not None},
+      'children' : [],
+      '_start' : start,
+    }
+    if parent is not None:
+      parent['children'].append(span)
+    else:
+      span['timestamp'] = datetime.datetime.now().isoformat()
+
+    token = _active_span.set(span)
+    try:
+      yield span
+    except Exception as e:
+      span['error'] = repr(e)
+      raise
+    finally:
+      span['duration_ms'] = round((time.perf_counter() - start) * 1000, 3)
+      _active_span.reset(token)
+      if parent is None:
+        self._finish(span)
+
+  def _finish(self, trace):
+    """ Export a completed trace and log it if it was slow """
+    try:
+      self._writer.info(json.dumps(self._export(trace), default=str))
+    except Exception as e:
+      self.logger.log('Failed to write trace "{}": {}'.format(trace['name'], e), level='WARNING')
+
+    if trace['duration_ms'] >= self._slow_threshold * 1000:
+      slowest = sorted(self._flatten(trace['children']), key=lambda s: s['duration_ms'], reverse=True)[:5]
+      summary = ', '.join('{}={:.0f}ms'.format(s['name'], s['duration_ms']) for s in slowest)
+      self.logger.log('Slow trace "{}" ({}) took {:.0f}ms. Slowest spans: {}.'.format(trace['name'], trace['trace_id'], 
+                      trace['duration_ms'], summary or 'none'), level='WARNING')
+
+  def _flatten(self, spans):
+    """ Returns all the spans in the tree as a flat list """
+    res = []
+    for span in spans:
+      res.append(span)
+      res += self._flatten(span['children'])
+    return res
+
+  def _export(self, span):
+    """ Returns a copy of the span tree without the internal bookkeeping """
+    res = {k: v for k, v in span.items() if not k.startswith('_') and k != 'children'}
+    res['children'] = [self._export(c) for c in span['children']]
+    return res
+
+
+class TracedSpotify:
+  """ Wraps a spotipy.Spotify client and records a tracing span for every API call """
+
+  def __init__(self, client, tracer):
+    self._client = client
+    self._tracer = tracer
+
+  def __getattr__(self, name):
+    attr = getattr(self._client, name)
+    if name.startswith('_') or not callable(attr):
+      return attr
+
+    @functools.wraps(attr)
+    def traced(*args, **kwargs):
+      with self._tracer.span('spotipy.' + name):
+        return attr(*args, **kwargs)
+    return traced
+
+
+class CircuitBreaker:
+  """ Fails the calls to a group of Spotify Web API endpoints fast while the endpoints keep failing
+
+  The circuit opens after `threshold` consecutive failures (connection errors, timeouts, rate limiting
+  and server errors). Once the open time is over the circuit is half open and lets a single probe call
+  through: a success closes the circuit, a failure opens it again for twice as long.
+  """
+
+  CLOSED = 'closed'
+  OPEN = 'open'
+  HALF_OPEN = 'half_open'
+
+  def __init__(self, name, threshold, reset_timeout, on_change=None):
+    self.name = name
+    self._threshold = threshold
+    self._reset_timeout = reset_timeout
+    self._on_change = on_change
+    self._lock = threading.Lock()
+    self._failures = 0                  # Consecutive failures
+    self._opened_at = None              # time.monotonic() the circuit opened, None when closed
+    self._open_for = reset_timeout      # Seconds the circuit stays open
+    self._probing = False               # A probe call is in flight while half open
+    self._last_error = None
+
+  @property
+  def state(self):
+    if self._opened_at is None:
+      return self.CLOSED
+    if time.monotonic() - self._opened_at < self._open_for:
+      return self.OPEN
+    return self.HALF_OPEN
+
+  def retry_in(self):
+    """ Returns the seconds until an open circuit half opens """
+    if self._opened_at is None:
+      return 0
+    return max(0, self._open_for - (time.monotonic() - self._opened_at))
+
+  @staticmethod
+  def is_failure(error):
+    """ Returns True if the error means the endpoints are unavailable (errors like bad requests or unknown devices are not failures) """
+    if isinstance(error, spotipy.client.SpotifyException):
+      return error.http_status == 429 or error.http_status >= 500
+    # Connection errors and timeouts
+    return True
+
+  def before_call(self):
+    """ Raise a SpotifyException instead of making the call while the circuit is open """
+    with self._lock:
+      state = self.state
+      if state == self.CLOSED:
+        return
+      if state == self.HALF_OPEN and not self._probing:
+        self._probing = True
+        return
+    raise spotipy.client.SpotifyException(503, -1, 'The Spotify {} API is unavailable (circuit open for {}s more).'.format(
+                                          self.name, int(self.retry_in())))
+
+  def record(self, error=None):
+    """ 
+    Record the outcome of a call
+
+    param error: Exception raised by the call (None when it succeeded)
+    """
+    changed = False
+    with self._lock:
+      probe = self._probing
+      self._probing = False
+      if error is not None and self.is_failure(error):
+        self._failures += 1
+        self._last_error = str(error)
+        if probe:
+          self._open_for = min(self._open_for * 2, CIRCUIT_BREAKER_MAX_TIMEOUT)
+          self._opened_at = time.monotonic()
+          changed = True
+        elif self._opened_at is None and self._failures >= self._threshold:
+          self._open_for = self._reset_timeout
+          self._opened_at = time.monotonic()
+          changed = True
+      else:
+        self._failures = 0
+        if self._opened_at is not None:
+          self._opened_at = None
+          self._open_for = self._reset_timeout
+          changed = True
+    if changed and self._on_change is not None:
+      self._on_change(self)
+
+  def call(self, func, *args, **kwargs):
+    """ Make a call through the circuit breaker """
+    self.before_call()
+    try:
+      res = func(*args, **kwargs)
+    except Exception as e:
+      self.record(e)
+      raise
+    except BaseException:
+      self.abandon()
+      raise
+    self.record()
+    return res
+
+  def abandon(self):
+    """ Forget a call that was cancelled before it finished, the outcome is unknown so the next call can probe """
+    with self._lock:
+      self._probing = False
+
+  def info(self):
+    """ Returns the state of the circuit breaker for the circuit entity """
+    return {
+      'state' : self.state,
+      'failures' : self._failures,
+      'retry_in' : round(self.retry_in()),
+      'last_error' : self._last_error,
+    }
+
+
+class GuardedSpotify:
+  """ Wraps a spotipy.Spotify client and makes every API call through the circuit breaker of its endpoint group """
+
+  def __init__(self, client, breakers):
+    self._client = client
+    self._breakers = breakers
+
+  def __getattr__(self, name):
+    attr = getattr(self._client, name)
+    if name.startswith('_') or not callable(attr):
+      return attr
+    breaker = self._breakers.get(_api_group(name))
+    if breaker is None:
+      return attr
+
+    @functools.wraps(attr)
+    def guarded(*args, **kwargs):
+      return breaker.call(attr, *args, **kwargs)
+    return guarded
+
+
+class HTTPCacheEntry:
+  """ A cached Web API response """
+
+  __slots__ = ('etag', 'headers', 'content', 'expires')
+
+  def __init__(self, etag, headers, content, expires):
+    self.etag = etag
+    self.headers = headers              # Response headers (dict)
+    self.content = content              # Response body (bytes)
+    self.expires = expires              # Time (epoch seconds) the response must be revalidated after
+
+  def fresh(self):
+    """ Returns True while the response can be used without asking Spotify (Cache-Control max-age) """
+    return time.time() < self.expires
+
+
+class HTTPResponseCache:
+  """ Size bounded LRU cache of Web API responses, shared by the sync and async clients
+
+  Responses are kept while they have an ETag (or a max-age) to revalidate them with. Responses evicted
+  from memory are spilled to the cache folder when there is one and are read back on a miss. With a
+  SharedCache, new responses are also written to it so the other instances don't download them again.
+  Private responses (Cache-Control: private) are only kept for the account that requested them and
+  are never shared.
+  """
+
+  def __init__(self, max_bytes, spill_dir=None, shared=None):
+    self._max_bytes = max_bytes
+    self._spill_dir = spill_dir
+    self._shared = shared
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict() # Url -> HTTPCacheEntry, least recently used first
+    self._size = 0
+    self._spilled = 0
+    if spill_dir:
+      os.makedirs(spill_dir, exist_ok=True)
+      self._spilled = len(os.listdir(spill_dir))
+
+  @staticmethod
+  def cacheable(url):
+    """ Returns True if the responses of the url are cached """
+    return HTTP_CACHE_URLS.match(url) is not None
+
+  @staticmethod
+  def _directives(headers):
+    """ Returns the Cache-Control directives of response headers (a CaseInsensitiveDict or lowercase names) """
+    return [d.strip().lower() for d in headers.get('cache-control', '').split(',')]
+
+  @staticmethod
+  def _private_key(url, account):
+    """ Returns the cache key of a private response of the account """
+    return '{} {}'.format(account, url)
+
+  @classmethod
+  def _max_age(cls, headers):
+    """ Returns the max-age of the response (0 if it must be revalidated) or None if it must not be stored """
+    directives = cls._directives(headers)
+    if 'no-store' in directives:
+      return None
+    if 'no-cache' in directives:
+      return 0
+    for d in directives:
+      if d.startswith('max-age='):
+        try:
+          return max(0, int(d[8:]))
+        except ValueError:
+          pass
+    return 0
+
+  def get(self, url, account=None):
+    """ 
+    Returns the cached HTTPCacheEntry of the url (the private response of the account first) or None
+
+    param url: Request url
+    param account: Username of the account making the request
+    """
+    keys = [url] if account is None else [self._private_key(url, account), url]
+    for key in keys:
+      with self._lock:
+        entry = self._entries.get(key)
+        if entry is not None:
+          self._entries.move_to_end(key)
+          return entry
+      entry = self._load(key) or (self._load_shared(url) if key == url else None)
+      if entry is not None:
+        self._store(key, entry)
+        return entry
+    return None
+
+  def put(self, url, headers, content, account=None):
+    """ 
+    Cache a 200 response
+
+    param url: Request url
+    param headers: Response headers
+    param content: Response body (bytes)
+    param account: Username of the account that made the request (private responses are not kept without it)
+    """
+    # The header names are kept lowercase, the directives are found whatever their case was
+    headers = {name.lower(): value for name, value in headers.items()}
+    etag = headers.get('etag')
+    max_age = self._max_age(headers)
+    if max_age is None or (not etag and not max_age):
+      return
+    entry = HTTPCacheEntry(etag, headers, content, time.time() + max_age)
+    if 'private' in self._directives(headers):
+      if account is not None:
+        self._store(self._private_key(url, account), entry)
+      return
+    self._store(url, entry)
+    self._share(url, entry)
+
+  def revalidated(self, url, entry, headers):
+    """ Spotify answered 304 Not Modified, the cached response is good for another max-age """
+    max_age = self._max_age(headers)
+    entry.expires = time.time() + (max_age or 0)
+    entry.etag = headers.get('etag', entry.etag)
+
+  def _store(self, url, entry):
+    spill = []
+    with self._lock:
+      old = self._entries.pop(url, None)
+      if old is not None:
+        self._size -= len(old.content)
+      self._entries[url] = entry
+      self._size += len(entry.content)
+      while self._size > self._max_bytes and self._entries:
+        evicted_url, evicted = self._entries.popitem(last=False)
+        self._size -= len(evicted.content)
+        spill.append((evicted_url, evicted))
+    if self._spill_dir:
+      for evicted_url, evicted in spill:
+        self._spill(evicted_url, evicted)
+
+  def _path(self, url):
+    return os.path.join(self._spill_dir, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+  def _spill(self, url, entry):
+    """ Write an evicted response to the cache folder: a JSON header line followed by the body """
+    path = self._path(url)
+    try:
+      header = json.dumps({'url': url, 'etag': entry.etag, 'headers': entry.headers, 'expires': entry.expires})
+      tmp_file = path + '.tmp'
+      with open(tmp_file, 'wb') as f:
+        f.write(header.encode('utf-8') + b'\n' + entry.content)
+      os.replace(tmp_file, path)
+    except OSError:
+      return
+    self._spilled += 1
+    if self._spilled > HTTP_CACHE_DISK_ENTRIES:
+      self._prune()
+
+  def _load(self, url):
+    """ Returns the response spilled to the cache folder or None """
+    if not self._spill_dir:
+      return None
+    try:
+      with open(self._path(url), 'rb') as f:
+        header, content = f.read().split(b'\n', 1)
+      info = json.loads(header)
+    except (OSError, ValueError):
+      return None
+    if info.get('url') != url:
+      return None
+    return HTTPCacheEntry(info['etag'], info['headers'], content, info['expires'])
+
+  def _share(self, url, entry):
+    """ Write a new public response to the shared cache """
+    if self._shared is None:
+      return
+    try:
+      content = entry.content.decode('utf-8')
+    except UnicodeDecodeError:
+      return
+    self._shared.set('http', url, {'etag': entry.etag, 'headers': entry.headers, 'expires': entry.expires, 'content': content}, 
+                     SHARED_CACHE_HTTP_TTL)
+
+  def _load_shared(self, url):
+    """ Returns the response another instance wrote to the shared cache or None """
+    if self._shared is None:
+      return None
+    info = self._shared.get('http', url)
+    if info is None:
+      return None
+    return HTTPCacheEntry(info['etag'], info['headers'], info['content'].encode('utf-8'), info['expires'])
+
+  def _prune(self):
+    """ Remove the oldest tenth of the spilled responses """
+    try:
+      paths = [os.path.join(self._spill_dir, name) for name in os.listdir(self._spill_dir)]
+      paths.sort(key=os.path.getmtime)
+      remove = paths[:max(1, len(paths) - HTTP_CACHE_DISK_ENTRIES * 9 // 10)]
+      for path in remove:
+        os.remove(path)
+      self._spilled = len(paths) - len(remove)
+    except OSError:
+      pass
+
+
+class CachingHTTPAdapter(requests.adapters.HTTPAdapter):
+  """ requests transport adapter that serves the catalog and playlist responses from an HTTPResponseCache
+
+  Cached responses are revalidated with If-None-Match, a 304 Not Modified is answered with the cached body
+  so large playlists are only downloaded when they changed.
+  """
+
+  def __init__(self, cache, account=None, **kwargs):
+    super().__init__(**kwargs)
+    self._cache = cache
+    self._account = account # Username of the session's account, its private responses are kept for it only
+
+  def send(self, request, **kwargs):
+    if request.method != 'GET' or not self._cache.cacheable(request.url):
+      return super().send(request, **kwargs)
+
+    entry = self._cache.get(request.url, self._account)
+    if entry is not None:
+      if entry.fresh():
+        return self._cached_response(request, entry)
+      request.headers['If-None-Match'] = entry.etag
+
+    response = super().send(request, **kwargs)
+    if response.status_code == 304 and entry is not None:
+      self._cache.revalidated(request.url, entry, response.headers)
+      response.close()
+      return self._cached_response(request, entry)
+    if response.status_code == 200:
+      self._cache.put(request.url, response.headers, response.content, self._account)
+    return response
+
+  def _cached_response(self, request, entry):
+    """ Returns a 200 response built from the cache entry """
+    response = requests.models.Response()
+    response.status_code = 200
+    response.reason = 'OK'
+    response.headers = requests.structures.CaseInsensitiveDict(entry.headers)
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response._content = entry.content
+    response.url = request.url
+    response.request = request
+    response.connection = self
+    return response
+
+
+class SamplingProfiler(threading.Thread):
+  """ Wall clock sampling profiler of the threads running the app code
+
+  Every interval the stacks of all the threads are read and the ones that are inside this module are
+  counted, whether they compute or wait (ex: on the Spotify Web API). Nothing is hooked into the
+  profiled code: the only cost is this thread, and only while a profile runs. Coroutines waiting on
+  the event loop are not on a stack, their time is counted in the executors and Web API calls they wait on.
+  """
+
+  def __init__(self, interval):
+    super().__init__(name='spotify_client_profiler', daemon=True)
+    self._interval = interval
+    self._stopped = threading.Event()
+    self.stacks = collections.Counter()   # Tuple of (file, first line, function) from the thread root -> samples
+    self.samples = 0                      # Number of times the stacks were sampled
+    self.started_at = time.time()
+    self.stopped_at = None
+
+  def stop(self):
+    self._stopped.set()
+    self.join(timeout=5)
+    self.stopped_at = time.time()
+
+  def run(self):
+    own = threading.get_ident()
+    module_file = __file__
+    while not self._stopped.wait(self._interval):
+      self.samples += 1
+      for ident, frame in sys._current_frames().items():
+        if ident == own:
+          continue
+        stack = []
+        in_app = False
+        while frame is not None:
+          code = frame.f_code
+          in_app = in_app or code.co_filename == module_file
+          stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+          frame = frame.f_back
+        if in_app:
+          stack.reverse()
+          self.stacks[tuple(stack)] += 1
+
+  @staticmethod
+  def _frame_name(frame):
+    filename, line, name = frame
+    return '{} ({}:{})'.format(name, os.path.basename(filename), line)
+
+  def write(self, path):
+    """ 
+    Write the collapsed stacks (path.collapsed, for flamegraph.pl/speedscope) and a summary of the busiest functions (path.txt)
+
+    param path: Path of the files without extension
+    """
+    with open(path + '.collapsed', 'w') as f:
+      for stack, count in self.stacks.most_common():
+        f.write('{} {}\n'.format(';'.join(self._frame_name(frame).replace(';', ',') for frame in stack), count))
+
+    own = collections.Counter()           # Samples with the function on top of the stack
+    total = collections.Counter()         # Samples with the function anywhere in the stack
+    for stack, count in self.stacks.items():
+      own[stack[-1]] += count
+      for frame in set(stack):
+        total[frame] += count
+    app_samples = sum(self.stacks.values())
+    duration = (self.stopped_at or time.time()) - self.started_at
+
+    with open(path + '.txt', 'w') as f:
+      f.write('Sampled for {:.1f}s every {}ms: {} samples, {} thread stacks in the app code\n'.format(
+              duration, int(self._interval * 1000), self.samples, app_samples))
+      for title, counter in (('Own time (on top of the stack)', own), ('Total time (anywhere in the stack)', total)):
+        f.write('\n{}:\n   samples      %  function\n'.format(title))
+        for frame, count in counter.most_common(PROFILE_REPORT_LINES):
+          f.write('{:>10} {:>6.1f}  {}\n'.format(count, 100.0 * count / app_samples if app_samples else 0, self._frame_name(frame)))
+
+
+class MemorySnapshots:
+  """ tracemalloc snapshots of the app, each snapshot is compared with the previous one
+
+  Tracing starts with the first snapshot (allocations made before are not traced) and stops with stop().
+  Python allocations are slower and use more memory while tracing, it is meant to be turned on briefly.
+  """
+
+  def __init__(self, frames):
+    self._frames = frames
+    self._previous = None
+    self._started = False
+
+  def stop(self):
+    if self._started and tracemalloc.is_tracing():
+      tracemalloc.stop()
+    self._started = False
+    self._previous = None
+
+  @staticmethod
+  def _live_objects():
+    """ Returns the number of live instances of the app and pychromecast classes """
+    objects = collections.Counter()
+    for o in gc.get_objects():
+      module = type(o).__module__
+      # Not a string for some extension types
+      if isinstance(module, str) and (module == __name__ or module.startswith('pychromecast')):
+        objects[type(o).__qualname__] += 1
+    return objects
+
+  def take(self, path):
+    """ 
+    Take a snapshot and write it (compared with the previous one) to a file, returns (traced bytes, growth in bytes)
+
+    param path: File to write the report to
+    """
+    if not tracemalloc.is_tracing():
+      tracemalloc.start(self._frames)
+      self._started = True
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+      tracemalloc.Filter(False, tracemalloc.__file__),
+      tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ])
+    previous, self._previous = self._previous, snapshot
+    traced = sum(stat.size for stat in snapshot.statistics('filename'))
+    growth = 0
+    objects = self._live_objects()
+
+    with open(path, 'w') as f:
+      f.write('Traced memory: {:.1f} MB\n'.format(traced / 1048576))
+      f.write('\nLive objects:\n')
+      for name, count in sorted(objects.items()):
+        f.write('{:>10}  {}\n'.format(count, name))
+      if previous is None:
+        f.write('\nFirst snapshot, take another one to see what grew. Largest allocations:\n')
+        for stat in snapshot.statistics('lineno')[:PROFILE_REPORT_LINES]:
+          f.write('{}\n'.format(stat))
+        return traced, growth
+
+      diff = snapshot.compare_to(previous, 'lineno')
+      growth = sum(stat.size_diff for stat in diff)
+      f.write('\nGrowth since the previous snapshot: {:+.1f} KB\n'.format(growth / 1024))
+      for stat in diff[:PROFILE_REPORT_LINES]:
+        f.write('{}\n'.format(stat))
+      f.write('\nTracebacks of the largest growths:\n')
+      for stat in snapshot.compare_to(previous, 'traceback')[:5]:
+        if stat.size_diff <= 0:
+          break
+        f.write('\n{:+.1f} KB in {:+d} blocks\n'.format(stat.size_diff / 1024, stat.count_diff))
+        for line in stat.traceback.format():
+          f.write('{}\n'.format(line))
+    return traced, growth
+
+
+class CastHealthMonitor(threading.Thread):
+  """ Supervisor thread that reconnects unavailable cast devices in the background
+
+  Cast devices wake the monitor when they become unavailable. Casts that were disconnected are
+  reconnected with jittered exponential backoff so a flaky speaker never blocks a play request.
+  Casts that lost their connection are left to the pychromecast socket client, which reconnects
+  them itself. The health of every cast is reported whenever it changes.
+  """
+
+  def __init__(self, casts, logger, debug_level='DEBUG', on_health_change=None):
+    super().__init__(name='spotify_client_cast_monitor', daemon=True)
+    self._casts = casts                   # Cast UUID -> CastDevice (shared with the app)
+    self.logger = logger
+    self._debug_level = debug_level
+    self._on_health_change = on_health_change
+    self._wake = threading.Event()
+    self._stopped = False
+    self._failures = {}                   # Cast UUID -> number of failed reconnection attempts
+    self._next_attempt = {}               # Cast UUID -> time.monotonic() of the next reconnection attempt
+    self._last_error = {}                 # Cast UUID -> last reconnection error
+    self._last_health = None
+
+  def wake(self):
+    """ Check the casts now (ex: a cast became unavailable) """
+    self._wake.set()
+
+  def stop(self):
+    self._stopped = True
+    self._wake.set()
+    self.join(timeout=5)
+
+  def run(self):
+    while not self._stopped:
+      self._wake.wait(self._check_interval())
+      self._wake.clear()
+      if self._stopped:
+        break
+      try:
+        self._check_casts()
+      except Exception as e:
+        self.logger.log('Cast health monitor error: {}'.format(e), level='WARNING')
+
+  def _check_interval(self):
+    """ Seconds until the next scheduled reconnection attempt or the regular check """
+    now = time.monotonic()
+    waits = [t - now for t in self._next_attempt.values()]
+    return max(0.1, min(waits + [CAST_HEALTH_CHECK_INTERVAL]))
+
+  def _check_casts(self):
+    for cast in list(self._casts.values()):
+      uuid = cast.uuid
+      if cast.available:
+        if self._failures.pop(uuid, None):
+          self.logger.log('Chromecast "{}" reconnected.'.format(cast.name), level=self._debug_level)
+        self._next_attempt.pop(uuid, None)
+        self._last_error.pop(uuid, None)
+      elif cast.get_cast() is None and time.monotonic() >= self._next_attempt.get(uuid, 0):
+        self._reconnect(cast)
+    self._report()
+
+  def _reconnect(self, cast):
+    """ Make a single quick reconnection attempt and schedule the next one if it fails """
+    uuid = cast.uuid
+    try:
+      cast.reset_cast_connection(tries=1, retry_wait=0, timeout=10)
+    except Exception as e:
+      self._last_error[uuid] = str(e)
+
+    if cast.available:
+      self.logger.log('Chromecast "{}" reconnected in the background.'.format(cast.name), level=self._debug_level)
+      self._failures.pop(uuid, None)
+      self._next_attempt.pop(uuid, None)
+      self._last_error.pop(uuid, None)
+      return
+
+    failures = self._failures.get(uuid, 0) + 1
+    self._failures[uuid] = failures
+    delay = min(CAST_RECONNECT_MAX_DELAY, CAST_RECONNECT_BASE_DELAY * 2 ** (failures - 1))
+    # Jitter keeps several speakers that dropped together from retrying in lock step
+    delay = random.uniform(delay / 2, delay)
+    self._next_attempt[uuid] = time.monotonic() + delay
+    self.logger.log('Failed to reconnect Chromecast "{}" (attempt {}), retrying in {:.0f}s.'.format(cast.name, failures, delay), level=self._debug_level)
+
+  def health(self):
+    """ Returns the health of every cast as a dictionary (cast name -> health information) """
+    now = time.monotonic()
+    res = {}
+    for cast in list(self._casts.values()):
+      uuid = cast.uuid
+      if cast.available:
+        state = 'connected'
+      elif cast.get_cast() is not None:
+        state = 'reconnecting'
+      else:
+        state = 'unavailable'
+      res[cast.name] = {
+        'state' : state,
+        'available' : cast.available,
+        'failed_attempts' : self._failures.get(uuid, 0),
+        'last_error' : self._last_error.get(uuid),
+        'next_attempt_in' : round(self._next_attempt[uuid] - now) if uuid in self._next_attempt else None,
+      }
+    return res
+
+  def _report(self):
+    """ Report the health if the state of any cast changed """
+    health = self.health()
+    summary = {name: (h['state'], h['failed_attempts']) for name, h in health.items()}
+    if summary != self._last_health:
+      self._last_health = summary
+      if self._on_health_change is not None:
+        self._on_health_change(health)
+
+
+class CastDevice:
+  """Representation of a Cast device on the network.
+
+  Modified version of: https://github.com/home-assistant/home-assistant/blob/dev/homeassistant/components/cast/media_player.py
+
+  This class is the holder of the pychromecast.Chromecast object and its socket client.
+  """
+
+  def __init__(self, chromecast, logger, debug_level='DEBUG', on_reconnect=None, on_unavailable=None):
+    self._chromecast = None # pychromecast.Chromecast
+    self._on_reconnect = on_reconnect # Called with this CastDevice when the connection comes back
+    self._on_unavailable = on_unavailable # Called with this CastDevice when the connection is lost
+    self._spotify_controller = None # SpotifyController registered on the current chromecast
+    self._spotify_token = None # Access token Spotify was last launched with
+    self.spotify_launched_at = None
+    self._cast_info = {} 
+    self.cast_status = None
+    self.media_status = None
+    self.connection_status = None
+    self._available = False
+    self._status_listener = None
+    self.logger = logger
+    self._debug_level = debug_level
+    # The connection is set up from event threads, discovery and the health monitor
+    self._lock = threading.RLock()
+
+    self.set_cast(chromecast)
+
+  @property
+  def name(self):
+    return self._cast_info.get('friendly_name', None)
+
+  @property
+  def model_name(self):
+    return self._cast_info.get('model_name', None)
+
+  @property
+  def uuid(self):
+    return self._cast_info.get('uuid', None)
+
+  @property
+  def host(self):
+    return self._cast_info.get('host', None)
+
+  @property
+  def port(self):
+    return self._cast_info.get('port', None)
+
+  @property
+  def available(self):
+    """ Return True if the cast device is connected or connecting """
+    return self._available or self.connection_status == pychromecast.socket_client.CONNECTION_STATUS_CONNECTING
+
+  @property
+  def complete_info(self):
+    return all([self.name, self.host, self.port, self.model_name, self.uuid])
+
+  def get_cast(self):
+    return self._chromecast
+
+  def cast_info(self):
+    """ Returns the information needed to connect to the cast without discovery """
+    info = {key: self._cast_info[key] for key in ('host', 'port', 'model_name', 'friendly_name')}
+    info['uuid'] = str(self.uuid)
+    return info
+
+  def get_spotify_controller(self, access_token, expires):
+    """ 
+    Returns the SpotifyController for the current chromecast, handing it the token to launch with
+
+    A controller is only registered once per chromecast connection
+    """
+    if self._spotify_controller is None:
+      from pychromecast.controllers.spotify import SpotifyController
+      self._spotify_controller = SpotifyController(access_token, expires)
+      self._chromecast.register_handler(self._spotify_controller)
+    else:
+      self._spotify_controller.access_token = access_token
+      self._spotify_controller.expires = expires
+    return self._spotify_controller
+
+  def playback_info(self):
+    """ Returns the Spotify receiver's media status in the format of the Spotify playback info ({} if nothing is playing) """
+    status = self.media_status
+    if status is None or status.player_state in (None, 'IDLE', 'UNKNOWN'):
+      return {}
+    return {
+      'is_playing' : status.player_state in ('PLAYING', 'BUFFERING'),
+      'progress_ms' : int((status.adjusted_current_time or 0) * 1000),
+      'item' : {
+        'name' : status.title,
+        'artists' : [{'name' : status.artist}] if status.artist else [],
+        'album' : {'name' : status.album_name},
+        'uri' : status.content_id,
+        'duration_ms' : int(status.duration * 1000) if status.duration else None,
+      },
+      'device' : {
+        'name' : self.name,
+        'volume_percent' : int(round(self.cast_status.volume_level * 100)) if self.cast_status else None,
+      },
+    }
+
+  def spotify_launched(self, access_token):
+    """ Record that Spotify was launched with the access token """
+    self._spotify_token = access_token
+    self.spotify_launched_at = time.time()
+
+  def spotify_ready(self, access_token):
+    """ Return True if the Spotify receiver launched with the access token is still running """
+    sc = self._spotify_controller
+    if sc is None or not sc.is_launched or self._spotify_token != access_token or not self.available:
+      return False
+    # Another app may have replaced the Spotify receiver
+    app_id = getattr(self.cast_status, 'app_id', None)
+    return app_id is None or app_id == sc.supporting_app_id
+
+  def foreground_app(self):
+    """ Returns the name of the app running on the cast if it is not Spotify or the idle screen, else None """
+    status = self.cast_status
+    app_id = getattr(status, 'app_id', None)
+    if app_id in (None, CAST_BACKDROP_APP_ID, CAST_SPOTIFY_APP_ID):
+      return None
+    sc = self._spotify_controller
+    if sc is not None and app_id == sc.supporting_app_id:
+      return None
+    return getattr(status, 'display_name', None) or app_id
+
+  def reset_cast_connection(self, tries=5, retry_wait=1, timeout=30):
+    """
+    Attempt to initialize a new cast connection after disconnected/failed
+
+    param tries: Number of connection attempts
+    param retry_wait: Seconds between connection attempts
+    param timeout: Socket timeout in seconds
+    """
+    if not self.complete_info:
+      self.logger.log('Incomplete cast information ({}), skipping reconnection attempt.'.format(self.name), self._debug_level)
+      return
+
+    with self._lock:
+      if self._chromecast is not None:
+        # Another thread set up the connection while this one waited
+        return
+      info = (self.host, self.port, self.uuid, self.model_name, self.name)
+      chromecast = pychromecast._get_chromecast_from_host(info, tries=tries, retry_wait=retry_wait, timeout=timeout)
+      self.set_cast(chromecast)
+
+  def set_cast(self, chromecast):
+    """ 
+    Initially setup using the cast device
+
+    param chromecast: pychromecast.Chromecast device
+    """
+    with self._lock:
+      if self._chromecast is not None:
+        # The chromecast is already setup
+        self.logger.log('Chromecast is already setup: {}'.format(self.name), self._debug_level)
+        if chromecast is not self._chromecast:
+          self.discard(chromecast)
+        return
+
+      # A cast that was setup before and invalidated is reconnecting
+      reconnected = self.uuid is not None and self._on_reconnect is not None
+
+      self._cast_info['host'] = chromecast.host
+      self._cast_info['port'] = chromecast.port
+      self._cast_info['friendly_name'] = chromecast.device.friendly_name
+      self._cast_info['model_name'] = chromecast.device.model_name
+      self._cast_info['manufacturer'] = chromecast.device.manufacturer
+      self._cast_info['uuid'] = chromecast.device.uuid
+      self._cast_info['cast_type'] = chromecast.device.cast_type
+
+      self._chromecast = chromecast
+
+      self._status_listener = CastStatusListener(self, chromecast, self.logger, self._debug_level)
+
+      # Assume connection is successful until told otherwise
+      self._available = True
+
+    if reconnected:
+      self._on_reconnect(self)
+
+  @staticmethod
+  def discard(chromecast):
+    """ Close a chromecast connection that lost the race to be set up, so its socket and listeners don't leak """
+    try:
+      chromecast.disconnect(timeout=0)
+    except Exception:
+      pass
+
+  def new_cast_status(self, cast_status):
+    """ Handle updates of the cast status """
+    self.cast_status = cast_status
+    # self.logger.log('[{}] Received new cast device status on.'.format(self.name))
+
+  def new_media_status(self, media_status):
+    """ Handle updates of the media status """
+    self.media_status = media_status
+    # self.logger.log('[{}] Received new cast device media status on.'.format(self.name))
+
+  def new_connection_status(self, connection_status):
+    """ Handle updates of connection status """
+    self.connection_status = connection_status.status
+    # self.logger.log("[{}] Received new cast device connection status: {}".format(self.name, connection_status.status), self._debug_level)
+
+    if connection_status.status == pychromecast.socket_client.CONNECTION_STATUS_DISCONNECTED:
+      with self._lock:
+        self._available = False
+        self._invalidate()
+      if self._on_unavailable is not None:
+        self._on_unavailable(self)
+      return
+
+    new_available = connection_status.status == pychromecast.socket_client.CONNECTION_STATUS_CONNECTED
+    if new_available != self._available:
+      # Connection status callbacks happen often when disconnected.
+      # Only update state when availability changed
+      # self.logger.log("[{}] Cast device availability changed: {}".format(self.name, connection_status.status), self._debug_level)
+      self._available = new_available
+      if new_available and self._on_reconnect is not None:
+        self._on_reconnect(self)
+      elif not new_available and self._on_unavailable is not None:
+        self._on_unavailable(self)
 
   def stop(self):
     if self._chromecast is None:
@@ -1932,8 +6218,9 @@ class CastDevice:
       # self.logger.log('[{}] Failed to disconnect, error: {}'.format(self.name, e), level='WARNING')
       pass
 
-    self._available = False
-    self._invalidate()
+    with self._lock:
+      self._available = False
+      self._invalidate()
 
   def _invalidate(self):
     """ Invalidate some attributes """
@@ -1941,6 +6228,9 @@ class CastDevice:
     self._chromecast = None
     self.cast_status = None
     self.media_status = None
+    # The controller belongs to the old connection
+    self._spotify_controller = None
+    self._spotify_token = None
     if self._status_listener is not None:
       self._status_listener.invalidate()
       self._status_listener = None
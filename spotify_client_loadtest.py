@@ -0,0 +1,1201 @@
+"""
+Load test harness for the SpotifyClient app
+
+Replays a stream of play/controls events at a set rate and concurrency against the event callbacks of
+the app (_spotify_play_event_callback and _spotify_controls_event_callback). The Spotify Web API and
+the Chromecasts are replaced by in-process stubs with configurable latency and error injection, so no
+Spotify account, network or device is needed. Reports the throughput, the p50/p95/p99 latencies and
+the number of Spotify API calls per event.
+
+The Web API stub sits below spotipy and AsyncSpotifyWebAPI (at the HTTP transport), the app code runs
+unchanged: circuit breakers, HTTP cache, recommendation cache, speculative branches... are exercised
+as configured. spotipy's own retries of 429/5xx responses are done by urllib3 in the real transport,
+they are not simulated.
+
+Event stream (JSONL), one event per line:
+  {"event": "spotify.play", "data": {"device": "Speaker 1", "playlist": "spotify:playlist:..."}}
+  {"event": "spotify.controls", "data": {"action": "pause"}}
+A line with only the event data is a controls event when it has an 'action', else a play event.
+Without an event file, --events events are generated over the stub catalog (--save-events writes them).
+
+Devices of the stub: 'Speaker 1'...'Speaker N' are Spotify Connect devices, 'Cast 1'...'Cast N' are
+Chromecasts (media_player.cast_1...) that need the Spotify receiver launched before they are listed.
+
+Examples:
+  python spotify_client_loadtest.py --events 300 --rate 5 --concurrency 10 --latency 80
+  python spotify_client_loadtest.py events.jsonl --rate 0 --error-rate 0.05 --app async --config '{"http_cache": true}'
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import datetime
+import functools
+import heapq
+import http.client
+import importlib
+import io
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.parse
+import uuid
+import zlib
+
+import requests
+import requests.structures
+
+API_PREFIX = 'https://api.spotify.com/v1/'
+
+GENRES = ['rock', 'pop', 'jazz', 'classical', 'hip-hop', 'electronic', 'country', 'blues']
+CATEGORIES = ['party', 'rock', 'chill', 'focus', 'workout', 'mood', 'pop', 'jazz']
+
+PLAY_KINDS = [('playlist_uri', 3), ('track_uri', 2), ('album_uri', 1), ('artist_name', 2), ('genre', 1),
+              ('category', 1), ('featured', 1), ('new_releases', 1), ('multiple', 1)]
+CONTROLS_ACTIONS = [('pause', 2), ('resume', 2), ('next', 3), ('previous', 1), ('increase_volume', 1),
+                    ('decrease_volume', 1), ('volume_level', 1), ('snapshot', 1), ('restore', 1), ('transfer_playback', 1)]
+
+# Spotify API calls made by the event being handled (a one item list shared with the speculative branches)
+_event_calls = contextvars.ContextVar('spotify_loadtest_event_calls', default=None)
+
+
+def _weighted_choice(rng, choices):
+  """ Returns a random item of a list of (item, weight) """
+  total = sum(w for _, w in choices)
+  n = rng.uniform(0, total)
+  for item, w in choices:
+    n -= w
+    if n <= 0:
+      return item
+  return choices[-1][0]
+
+
+def percentile(values, p):
+  """
+  Returns the p-th percentile of the values (nearest rank), None when there are none
+
+  param values: Sorted list of numbers
+  param p: Percentile (0 - 100)
+  """
+  if not values:
+    return None
+  rank = max(1, int(round(p / 100.0 * len(values) + 0.5)))
+  return values[min(rank, len(values)) - 1]
+
+
+######################   STUB SPOTIFY   ########################
+
+class StubCatalog:
+  """ Deterministic synthetic Spotify catalog: artists with albums of tracks, playlists, genres and categories
+
+  Objects are built from their index when they are requested, ids are 22 characters like Spotify ids.
+  """
+
+  def __init__(self, artists=50, albums_per_artist=4, tracks_per_album=10, playlists=100, playlist_tracks=50):
+    self.artists = artists
+    self.albums_per_artist = albums_per_artist
+    self.tracks_per_album = tracks_per_album
+    self.albums = artists * albums_per_artist
+    self.tracks = self.albums * tracks_per_album
+    self.playlists = playlists
+    self.playlist_tracks = playlist_tracks
+
+  PREFIXES = {'artist': 'ar', 'album': 'al', 'track': 'tr', 'playlist': 'pl'}
+
+  def id(self, kind, n):
+    prefix = self.PREFIXES[kind]
+    return prefix + str(n).zfill(22 - len(prefix))
+
+  def index(self, kind, obj_id):
+    """ Returns the index of an object id or None if it is not in the catalog """
+    prefix = self.PREFIXES[kind]
+    if not obj_id.startswith(prefix) or not obj_id[len(prefix):].isdigit():
+      return None
+    n = int(obj_id[len(prefix):])
+    return n if n < getattr(self, kind + 's') else None
+
+  def uri(self, kind, n):
+    return 'spotify:{}:{}'.format(kind, self.id(kind, n))
+
+  def simple_artist(self, n):
+    return {'id': self.id('artist', n), 'uri': self.uri('artist', n), 'name': 'Artist {}'.format(n), 'type': 'artist'}
+
+  def artist(self, n):
+    artist = self.simple_artist(n)
+    artist.update({'genres': [GENRES[n % len(GENRES)]], 'popularity': 100 - n % 100, 'followers': {'total': 1000 * n}})
+    return artist
+
+  def album(self, n, full=False):
+    album = {'id': self.id('album', n), 'uri': self.uri('album', n), 'name': 'Album {}'.format(n), 'type': 'album',
+             'album_type': 'album', 'artists': [self.simple_artist(n // self.albums_per_artist)],
+             'total_tracks': self.tracks_per_album, 'release_date': '2020-01-01'}
+    if full:
+      first = n * self.tracks_per_album
+      items = [self.track(t, simple=True) for t in range(first, first + self.tracks_per_album)]
+      album['tracks'] = {'items': items, 'total': len(items), 'limit': 50, 'offset': 0, 'next': None}
+      album['genres'] = []
+    return album
+
+  def track(self, n, simple=False):
+    album = n // self.tracks_per_album
+    track = {'id': self.id('track', n), 'uri': self.uri('track', n), 'name': 'Track {}'.format(n), 'type': 'track',
+             'duration_ms': 180000 + (n % 60) * 1000, 'track_number': n % self.tracks_per_album + 1, 'is_playable': True,
+             'artists': [self.simple_artist(album // self.albums_per_artist)]}
+    if not simple:
+      track['album'] = self.album(album)
+      track['popularity'] = 100 - n % 100
+    return track
+
+  def playlist_track_indexes(self, n):
+    return [(n * 7919 + k * 104729) % self.tracks for k in range(self.playlist_tracks)]
+
+  def playlist(self, n, full=False):
+    playlist = {'id': self.id('playlist', n), 'uri': self.uri('playlist', n), 'name': 'Playlist {}'.format(n),
+                'type': 'playlist', 'description': 'Stub playlist {}'.format(n), 'owner': {'id': 'spotify', 'display_name': 'Spotify'},
+                'tracks': {'total': self.playlist_tracks}}
+    if full:
+      playlist['tracks'] = self.playlist_tracks_page(n, 0, 100)
+    return playlist
+
+  def playlist_tracks_page(self, n, offset, limit):
+    indexes = self.playlist_track_indexes(n)
+    items = [{'added_at': '2020-01-01T00:00:00Z', 'track': self.track(t)} for t in indexes[offset:offset + limit]]
+    return {'items': items, 'total': len(indexes), 'limit': limit, 'offset': offset, 'next': None}
+
+  def genre_playlists(self, name):
+    """ Returns the playlist indexes of a genre, category or the featured playlists """
+    start = zlib.crc32(name.encode('utf-8')) % self.playlists
+    return [(start + k * 11) % self.playlists for k in range(10)]
+
+
+class StubSpotify:
+  """ Web API stub shared by the sync (requests) and async (AsyncSpotifyWebAPI) transports
+
+  Answers the endpoints used by the app from a StubCatalog, keeps a simple player state and the list
+  of devices, adds latency and injects errors. Catalog responses have an ETag and are answered with
+  304 Not Modified when the client sends it back.
+  """
+
+  def __init__(self, catalog, speakers, casts, latency=0.05, jitter=0.02, error_rate=0.0, error_statuses=(429, 500, 502, 503), seed=None):
+    self.catalog = catalog
+    self.speakers = list(speakers)
+    self.casts = list(casts)
+    self._latency = latency
+    self._jitter = jitter
+    self._error_rate = error_rate
+    self._error_statuses = list(error_statuses)
+    self._rng = random.Random(seed)
+    self._lock = threading.Lock()
+    self._launched = set()              # Casts running the Spotify receiver, Spotify lists them as devices
+    self._playback = None
+    self.calls = collections.Counter()  # 'METHOD endpoint' -> number of calls
+    self.errors = collections.Counter() # Injected error status -> number of errors
+    self.not_modified = 0
+    self._routes = [
+      ('GET', r'me/player', self._current_playback),
+      ('GET', r'me/player/devices', self._devices),
+      ('GET', r'me/player/recently-played', self._recently_played),
+      ('PUT', r'me/player/play', self._start_playback),
+      ('PUT', r'me/player', self._transfer_playback),
+      ('PUT', r'me/player/pause', self._pause_playback),
+      ('POST', r'me/player/(next|previous)', self._skip),
+      ('PUT', r'me/player/(volume|seek|shuffle|repeat)', self._player_setting),
+      ('POST', r'me/player/queue', self._no_content),
+      ('GET', r'search', self._search),
+      ('GET', r'tracks/([^/]+)', self._track),
+      ('GET', r'albums/([^/]+)', self._album),
+      ('GET', r'albums/([^/]+)/tracks', self._album_tracks),
+      ('GET', r'artists/([^/]+)', self._artist),
+      ('GET', r'artists/([^/]+)/top-tracks', self._artist_top_tracks),
+      ('GET', r'artists/([^/]+)/albums', self._artist_albums),
+      ('GET', r'artists/([^/]+)/related-artists', self._related_artists),
+      ('GET', r'recommendations', self._recommendations),
+      ('GET', r'recommendations/available-genre-seeds', self._genre_seeds),
+      ('GET', r'browse/categories', self._categories),
+      ('GET', r'browse/categories/([^/]+)/playlists', self._category_playlists),
+      ('GET', r'browse/featured-playlists', self._featured_playlists),
+      ('GET', r'browse/new-releases', self._new_releases),
+      ('GET', r'(?:me|users/[^/]+)/playlists', self._user_playlists),
+      ('GET', r'playlists/([^/]+)', self._playlist),
+      ('GET', r'playlists/([^/]+)/tracks', self._playlist_tracks),
+      ('GET', r'me/tracks', self._saved_tracks),
+    ]
+    self._routes = [(method, re.compile(pattern + '$'), handler) for method, pattern, handler in self._routes]
+
+  ######## Transport ########
+
+  def delay(self):
+    """ Returns the latency of the next API call (seconds) """
+    with self._lock:
+      return max(0.0, self._rng.gauss(self._latency, self._jitter)) if self._jitter else self._latency
+
+  def handle(self, method, url, body=None, headers=None):
+    """
+    Returns (status, headers, body text) of a Web API request
+
+    param method: HTTP method
+    param url: Full request url with the query string
+    param body: Decoded JSON body or None
+    param headers: Request headers
+    """
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path.split('/v1/', 1)[-1].strip('/')
+    query = {k: v[0] for k, v in urllib.parse.parse_qs(parts.query).items()}
+    route, handler, match = None, None, None
+    for route_method, pattern, route_handler in self._routes:
+      m = pattern.match(path)
+      if route_method == method and m:
+        route, handler, match = self._route_name(pattern.pattern[:-1]), route_handler, m
+        break
+    name = '{} {}'.format(method, route or path)
+
+    counter = _event_calls.get()
+    with self._lock:
+      self.calls[name] += 1
+      if counter is not None:
+        counter[0] += 1
+      error = self._error_statuses and self._rng.random() < self._error_rate
+      status = self._rng.choice(self._error_statuses) if error else None
+    if error:
+      with self._lock:
+        self.errors[status] += 1
+      return self._error(status, 'Injected error', {'Retry-After': '1'} if status == 429 else {})
+    if handler is None:
+      return self._error(404, 'Service not found')
+
+    try:
+      status, result = handler(query, body or {}, *match.groups())
+    except (KeyError, ValueError, TypeError) as e:
+      return self._error(400, 'Bad request: {}'.format(e))
+    if status >= 400:
+      return self._error(status, result)
+    if result is None:
+      return status, {}, ''
+
+    text = json.dumps(result)
+    response_headers = {'Content-Type': 'application/json; charset=utf-8'}
+    if method == 'GET' and not path.startswith('me/'):
+      etag = '"{:08x}"'.format(zlib.crc32(text.encode('utf-8')))
+      response_headers.update({'ETag': etag, 'Cache-Control': 'private, max-age=0'})
+      if (headers or {}).get('If-None-Match') == etag:
+        with self._lock:
+          self.not_modified += 1
+        return 304, response_headers, ''
+    return status, response_headers, text
+
+  @staticmethod
+  def _route_name(pattern):
+    """ 'artists/([^/]+)/albums' -> 'artists/{id}/albums' """
+    return pattern.replace('([^/]+)', '{id}').replace('(?:me|users/[^/]+)', '{user}')
+
+  @staticmethod
+  def _error(status, message, headers=None):
+    body = json.dumps({'error': {'status': status, 'message': message}})
+    return status, dict(headers or {}, **{'Content-Type': 'application/json; charset=utf-8'}), body
+
+  ######## Devices & player ########
+
+  def launch(self, cast_name):
+    """ The Spotify receiver was launched on a cast, Spotify lists it as a device """
+    with self._lock:
+      self._launched.add(cast_name)
+
+  @staticmethod
+  def device_id(name):
+    return 'stubdevice{:08x}'.format(zlib.crc32(name.encode('utf-8')))
+
+  def _device_list(self):
+    with self._lock:
+      names = self.speakers + [name for name in self.casts if name in self._launched]
+      active = self._playback['device']['name'] if self._playback else None
+    return [{'id': self.device_id(name), 'name': name, 'type': 'CastVideo' if name in self.casts else 'Speaker',
+             'is_active': name == active, 'is_restricted': False, 'volume_percent': 50} for name in names]
+
+  def _device(self, device_id):
+    return next((d for d in self._device_list() if device_id in (None, d['id'])), None)
+
+  def _devices(self, query, body):
+    return 200, {'devices': self._device_list()}
+
+  def _current_playback(self, query, body):
+    with self._lock:
+      if self._playback is None:
+        return 204, None
+      playback = dict(self._playback)
+      if playback['is_playing']:
+        playback['progress_ms'] += int((time.time() - playback['timestamp'] / 1000.0) * 1000)
+      return 200, playback
+
+  def _start_playback(self, query, body):
+    device = self._device(query.get('device_id'))
+    if device is None:
+      return 404, 'Device not found'
+    uris = body.get('uris')
+    context_uri = body.get('context_uri')
+    if uris:
+      uri = uris[0]
+    elif context_uri and context_uri.startswith('spotify:playlist:'):
+      uri = self.catalog.uri('track', self.catalog.playlist_track_indexes(self.catalog.index('playlist', context_uri.split(':')[-1]) or 0)[0])
+    elif context_uri and context_uri.startswith('spotify:album:'):
+      uri = self.catalog.uri('track', (self.catalog.index('album', context_uri.split(':')[-1]) or 0) * self.catalog.tracks_per_album)
+    else:
+      uri = self.catalog.uri('track', 0)
+    track = self.catalog.track(self.catalog.index('track', uri.split(':')[-1]) or 0)
+    with self._lock:
+      self._playback = {'is_playing': True, 'progress_ms': body.get('position_ms') or 0, 'timestamp': int(time.time() * 1000),
+                        'item': track, 'currently_playing_type': 'track', 'shuffle_state': False, 'repeat_state': 'off',
+                        'context': {'uri': context_uri, 'type': context_uri.split(':')[1]} if context_uri else None,
+                        'device': device}
+    return 204, None
+
+  def _transfer_playback(self, query, body):
+    device = self._device(body['device_ids'][0])
+    if device is None:
+      return 404, 'Device not found'
+    with self._lock:
+      if self._playback is not None:
+        self._playback['device'] = device
+    return 204, None
+
+  def _pause_playback(self, query, body):
+    with self._lock:
+      if self._playback is None:
+        return 404, 'Player command failed: No active device found'
+      self._playback['is_playing'] = False
+    return 204, None
+
+  def _skip(self, query, body, direction):
+    with self._lock:
+      if self._playback is None:
+        return 404, 'Player command failed: No active device found'
+      n = self.catalog.index('track', self._playback['item']['id']) or 0
+      n = (n + (1 if direction == 'next' else -1)) % self.catalog.tracks
+      self._playback.update({'item': self.catalog.track(n), 'progress_ms': 0, 'timestamp': int(time.time() * 1000)})
+    return 204, None
+
+  def _player_setting(self, query, body, setting):
+    with self._lock:
+      if self._playback is None:
+        return 404, 'Player command failed: No active device found'
+      if setting == 'volume':
+        self._playback['device'] = dict(self._playback['device'], volume_percent=int(query['volume_percent']))
+      elif setting == 'shuffle':
+        self._playback['shuffle_state'] = query['state'] == 'true'
+      elif setting == 'repeat':
+        self._playback['repeat_state'] = query['state']
+    return 204, None
+
+  def _no_content(self, query, body):
+    return 204, None
+
+  def _recently_played(self, query, body):
+    limit = int(query.get('limit', 20))
+    return 200, {'items': [{'track': self.catalog.track(n), 'played_at': '2020-01-01T00:00:00Z'} for n in range(limit)], 'next': None}
+
+  ######## Catalog ########
+
+  def _page(self, items, query, total=None):
+    offset = int(query.get('offset', 0))
+    limit = int(query.get('limit', 20))
+    total = len(items) if total is None else total
+    return {'items': items[offset:offset + limit], 'total': total, 'limit': limit, 'offset': offset, 'next': None}
+
+  def _search(self, query, body):
+    q = query['q']
+    limit = int(query.get('limit', 10))
+    offset = int(query.get('offset', 0))
+    result = {}
+    for kind in query.get('type', 'track').split(','):
+      count = getattr(self.catalog, kind + 's', 0)
+      if not count:
+        result[kind + 's'] = {'items': [], 'total': 0, 'limit': limit, 'offset': offset, 'next': None}
+        continue
+      # A name from the catalog ('Artist 3') is the first result, other queries get results picked by their hash
+      m = re.search(r'{} (\d+)'.format(kind), q, re.IGNORECASE)
+      start = int(m.group(1)) if m and int(m.group(1)) < count else zlib.crc32(q.encode('utf-8')) % count
+      indexes = [(start + k * 37) % count for k in range(offset, offset + limit)]
+      build = {'artist': self.catalog.artist, 'album': self.catalog.album, 'track': self.catalog.track, 'playlist': self.catalog.playlist}[kind]
+      result[kind + 's'] = {'items': [build(n) for n in indexes], 'total': min(count, 1000), 'limit': limit, 'offset': offset, 'next': None}
+    return 200, result
+
+  def _lookup(self, kind, obj_id):
+    n = self.catalog.index(kind, obj_id)
+    if n is None:
+      raise ValueError('invalid {} id: {}'.format(kind, obj_id))
+    return n
+
+  def _track(self, query, body, track_id):
+    return 200, self.catalog.track(self._lookup('track', track_id))
+
+  def _album(self, query, body, album_id):
+    return 200, self.catalog.album(self._lookup('album', album_id), full=True)
+
+  def _album_tracks(self, query, body, album_id):
+    return 200, self._page(self.catalog.album(self._lookup('album', album_id), full=True)['tracks']['items'], query)
+
+  def _artist(self, query, body, artist_id):
+    return 200, self.catalog.artist(self._lookup('artist', artist_id))
+
+  def _artist_albums(self, query, body, artist_id):
+    first = self._lookup('artist', artist_id) * self.catalog.albums_per_artist
+    return 200, self._page([self.catalog.album(n) for n in range(first, first + self.catalog.albums_per_artist)], query)
+
+  def _artist_top_tracks(self, query, body, artist_id):
+    first = self._lookup('artist', artist_id) * self.catalog.albums_per_artist * self.catalog.tracks_per_album
+    return 200, {'tracks': [self.catalog.track(first + k * 3) for k in range(10)]}
+
+  def _related_artists(self, query, body, artist_id):
+    n = self._lookup('artist', artist_id)
+    return 200, {'artists': [self.catalog.artist((n + k) % self.catalog.artists) for k in range(1, 11)]}
+
+  def _recommendations(self, query, body):
+    seed = ','.join(query.get(k, '') for k in ('seed_artists', 'seed_genres', 'seed_tracks'))
+    start = zlib.crc32(seed.encode('utf-8'))
+    limit = int(query.get('limit', 20))
+    return 200, {'tracks': [self.catalog.track((start + k * 53) % self.catalog.tracks) for k in range(limit)], 'seeds': []}
+
+  def _genre_seeds(self, query, body):
+    return 200, {'genres': GENRES}
+
+  def _categories(self, query, body):
+    items = [{'id': c, 'name': c.capitalize(), 'href': API_PREFIX + 'browse/categories/' + c} for c in CATEGORIES]
+    return 200, {'categories': self._page(items, query)}
+
+  def _category_playlists(self, query, body, category_id):
+    if category_id not in CATEGORIES:
+      return 404, 'Specified id doesn\'t exist'
+    return 200, {'playlists': self._page([self.catalog.playlist(n) for n in self.catalog.genre_playlists(category_id)], query)}
+
+  def _featured_playlists(self, query, body):
+    playlists = [self.catalog.playlist(n) for n in self.catalog.genre_playlists('featured')]
+    return 200, {'message': 'Featured', 'playlists': self._page(playlists, query)}
+
+  def _new_releases(self, query, body):
+    albums = [self.catalog.album((self.catalog.albums - 1 - k * 3) % self.catalog.albums) for k in range(20)]
+    return 200, {'albums': self._page(albums, query)}
+
+  def _user_playlists(self, query, body):
+    return 200, self._page([self.catalog.playlist(n) for n in range(min(50, self.catalog.playlists))], query)
+
+  def _playlist(self, query, body, playlist_id):
+    return 200, self.catalog.playlist(self._lookup('playlist', playlist_id), full=True)
+
+  def _playlist_tracks(self, query, body, playlist_id):
+    n = self._lookup('playlist', playlist_id)
+    return 200, self.catalog.playlist_tracks_page(n, int(query.get('offset', 0)), int(query.get('limit', 100)))
+
+  def _saved_tracks(self, query, body):
+    items = [{'added_at': '2020-01-{:02d}T00:00:00Z'.format(28 - n % 28), 'track': self.catalog.track(n)} for n in range(200)]
+    return 200, self._page(items, query)
+
+
+def _stub_http_send(stub, adapter, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+  """ requests.adapters.HTTPAdapter.send replacement answering the Web API requests from the stub """
+  if not request.url.startswith(API_PREFIX):
+    raise requests.exceptions.ConnectionError('The load test has no network access ({}).'.format(request.url), request=request)
+  body = request.body
+  if isinstance(body, bytes):
+    body = body.decode('utf-8')
+  time.sleep(stub.delay())
+  status, headers, text = stub.handle(request.method, request.url, json.loads(body) if body else None, request.headers)
+
+  response = requests.Response()
+  response.status_code = status
+  response.reason = http.client.responses.get(status, '')
+  response.headers = requests.structures.CaseInsensitiveDict(headers)
+  response._content = text.encode('utf-8')
+  response.raw = io.BytesIO(response._content)
+  response.encoding = 'utf-8'
+  response.url = request.url
+  response.request = request
+  response.connection = adapter
+  return response
+
+
+class StubAsyncSession:
+  """ aiohttp.ClientSession stand-in for AsyncSpotifyWebAPI answering from the stub """
+
+  closed = False
+
+  def __init__(self, stub):
+    self._stub = stub
+
+  def request(self, method, url, params=None, json=None, headers=None):
+    if params:
+      url += '?' + urllib.parse.urlencode({k: str(v) for k, v in params.items()})
+    return StubAsyncResponse(self._stub, method, url, json, headers)
+
+  async def close(self):
+    self.closed = True
+
+
+class StubAsyncResponse:
+  """ aiohttp response stand-in (used as 'async with session.request(...) as resp') """
+
+  def __init__(self, stub, method, url, payload, headers):
+    self._stub = stub
+    self._request = (method, url, payload, headers)
+    self.url = url
+
+  async def __aenter__(self):
+    await asyncio.sleep(self._stub.delay())
+    self.status, self.headers, self._text = self._stub.handle(*self._request)
+    return self
+
+  async def __aexit__(self, *exc_info):
+    return False
+
+  async def text(self):
+    return self._text
+
+
+######################   STUB PYCHROMECAST   ########################
+
+def build_stub_pychromecast(stub, latency=0.3, discovery_latency=5.0, error_rate=0.0, seed=None):
+  """
+  Returns the stub pychromecast module (with its error, socket_client and controllers.spotify submodules)
+
+  param stub: StubSpotify told when the Spotify receiver is launched on a cast
+  param latency: Seconds to connect to a cast and to launch the Spotify receiver
+  param discovery_latency: Seconds get_chromecasts() blocks for (pychromecast waits for the discovery timeout)
+  param error_rate: Probability that launching the Spotify receiver fails
+  """
+  rng = random.Random(seed)
+  rng_lock = threading.Lock()
+  stats = collections.Counter()
+
+  pychromecast = types.ModuleType('pychromecast')
+  error = types.ModuleType('pychromecast.error')
+  socket_client = types.ModuleType('pychromecast.socket_client')
+  controllers = types.ModuleType('pychromecast.controllers')
+  spotify = types.ModuleType('pychromecast.controllers.spotify')
+
+  class PyChromecastError(Exception):
+    pass
+  for name in ('ChromecastConnectionError', 'LaunchError', 'NotConnected', 'PyChromecastStopped'):
+    setattr(error, name, type(name, (PyChromecastError,), {}))
+  error.PyChromecastError = PyChromecastError
+
+  socket_client.CONNECTION_STATUS_CONNECTING = 'CONNECTING'
+  socket_client.CONNECTION_STATUS_CONNECTED = 'CONNECTED'
+  socket_client.CONNECTION_STATUS_DISCONNECTED = 'DISCONNECTED'
+
+  class Listeners:
+    def register_status_listener(self, listener):
+      pass
+
+  class Chromecast:
+    def __init__(self, host, port, cast_uuid, model_name, friendly_name):
+      self.host = host
+      self.port = port
+      self.uuid = cast_uuid
+      self.name = friendly_name
+      self.device = types.SimpleNamespace(friendly_name=friendly_name, model_name=model_name, manufacturer='Google Inc.',
+                                         uuid=cast_uuid, cast_type='cast')
+      self.socket_client = types.SimpleNamespace(media_controller=Listeners())
+      self.status = None
+
+    def register_status_listener(self, listener):
+      pass
+
+    def register_connection_listener(self, listener):
+      pass
+
+    def register_handler(self, handler):
+      handler.cast = self
+
+    def wait(self, timeout=None):
+      pass
+
+    def disconnect(self, timeout=None):
+      pass
+
+  def _chromecast(name):
+    n = stub.casts.index(name)
+    return Chromecast('192.0.2.{}'.format(n + 10), 8009, uuid_of(name), 'Chromecast', name)
+
+  def uuid_of(name):
+    return uuid.uuid5(uuid.NAMESPACE_DNS, name + '.loadtest')
+
+  def get_chromecasts(tries=None, retry_wait=None, timeout=30, **kwargs):
+    stats['discoveries'] += 1
+    time.sleep(discovery_latency)
+    return [_chromecast(name) for name in stub.casts]
+
+  def _get_chromecast_from_host(host, tries=None, retry_wait=None, timeout=30, **kwargs):
+    stats['connections'] += 1
+    time.sleep(latency)
+    if host[4] not in stub.casts:
+      raise error.ChromecastConnectionError('Failed to connect to {}'.format(host[0]))
+    return _chromecast(host[4])
+
+  class SpotifyController:
+    supporting_app_id = 'CC32E753'
+
+    def __init__(self, access_token=None, expires=None):
+      self.access_token = access_token
+      self.expires = expires
+      self.is_launched = False
+      self.credential_error = False
+      self.cast = None
+
+    def launch_app(self, timeout=10):
+      stats['launches'] += 1
+      time.sleep(latency)
+      with rng_lock:
+        failed = rng.random() < error_rate
+      if failed:
+        stats['launch_errors'] += 1
+        raise error.LaunchError('Injected launch error')
+      self.is_launched = True
+      stub.launch(self.cast.name)
+
+  pychromecast.error = error
+  pychromecast.socket_client = socket_client
+  pychromecast.controllers = controllers
+  pychromecast.Chromecast = Chromecast
+  pychromecast.get_chromecasts = get_chromecasts
+  pychromecast._get_chromecast_from_host = _get_chromecast_from_host
+  pychromecast.stats = stats
+  controllers.spotify = spotify
+  spotify.SpotifyController = SpotifyController
+  return pychromecast
+
+
+def install_stub_modules(pychromecast):
+  """ Put the stub pychromecast in sys.modules, and a bare Appdaemon Hass base class if Appdaemon is not installed """
+  for name, module in [('pychromecast', pychromecast), ('pychromecast.error', pychromecast.error),
+                       ('pychromecast.socket_client', pychromecast.socket_client), ('pychromecast.controllers', pychromecast.controllers),
+                       ('pychromecast.controllers.spotify', pychromecast.controllers.spotify)]:
+    sys.modules[name] = module
+  try:
+    importlib.import_module('appdaemon.plugins.hass.hassapi')
+  except ImportError:
+    # The harness provides the Appdaemon API the app uses (LoadTestAppAPI)
+    names = ['appdaemon', 'appdaemon.plugins', 'appdaemon.plugins.hass', 'appdaemon.plugins.hass.hassapi']
+    for name in names:
+      sys.modules[name] = types.ModuleType(name)
+    sys.modules['appdaemon.plugins.hass.hassapi'].Hass = type('Hass', (object,), {})
+
+
+######################   APPDAEMON STAND-IN   ########################
+
+class StubScheduler(threading.Thread):
+  """ Runs the app timers (run_in/run_every) on the worker pool like the Appdaemon scheduler """
+
+  def __init__(self, submit):
+    super().__init__(name='spotify_loadtest_scheduler', daemon=True)
+    self._submit = submit
+    self._cond = threading.Condition()
+    self._timers = []                   # Heap of (due time.monotonic(), handle)
+    self._callbacks = {}                # Handle -> (callback, kwargs, interval)
+    self._next_handle = 0
+    self._stopped = False
+
+  def schedule(self, callback, delay, kwargs, interval=None):
+    with self._cond:
+      self._next_handle += 1
+      handle = self._next_handle
+      self._callbacks[handle] = (callback, kwargs, interval)
+      heapq.heappush(self._timers, (time.monotonic() + max(0, delay), handle))
+      self._cond.notify()
+    return handle
+
+  def cancel(self, handle):
+    with self._cond:
+      self._callbacks.pop(handle, None)
+
+  def stop(self):
+    with self._cond:
+      self._stopped = True
+      self._cond.notify()
+
+  def run(self):
+    while True:
+      with self._cond:
+        while not self._stopped and (not self._timers or self._timers[0][0] > time.monotonic()):
+          self._cond.wait(self._timers[0][0] - time.monotonic() if self._timers else None)
+        if self._stopped:
+          return
+        _, handle = heapq.heappop(self._timers)
+        timer = self._callbacks.get(handle)
+        if timer is None:
+          continue
+        callback, kwargs, interval = timer
+        if interval:
+          heapq.heappush(self._timers, (time.monotonic() + interval, handle))
+        else:
+          del self._callbacks[handle]
+      self._submit(callback, dict(kwargs))
+
+
+class LoadTestAppAPI:
+  """ The Appdaemon API used by SpotifyClient, mixed in before the app class so the app runs without Appdaemon """
+
+  def __init__(self, harness, args, app_dir):
+    self._harness = harness
+    self._args = args
+    self._app_dir = app_dir
+
+  args = property(lambda self: self._args)
+  app_dir = property(lambda self: self._app_dir)
+  name = property(lambda self: 'spotify_client_loadtest')
+
+  def log(self, msg, level='INFO', **kwargs):
+    self._harness.app_log(msg, level)
+
+  def listen_event(self, callback, event=None, **kwargs):
+    self._harness.listeners[event] = callback
+
+  def run_in(self, callback, delay, **kwargs):
+    return self._harness.scheduler.schedule(callback, delay, kwargs)
+
+  def run_every(self, callback, start, interval, **kwargs):
+    delay = (start - self.datetime()).total_seconds() if start != 'now' else 0
+    return self._harness.scheduler.schedule(callback, delay, kwargs, interval)
+
+  def cancel_timer(self, handle):
+    self._harness.scheduler.cancel(handle)
+
+  def datetime(self):
+    return datetime.datetime.now()
+
+  def get_state(self, entity=None, attribute=None, **kwargs):
+    return self._harness.states(entity)
+
+  def set_state(self, entity, **kwargs):
+    self._harness.published[entity] = kwargs
+
+  async def run_in_executor(self, func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(self._harness.executor, functools.partial(func, *args, **kwargs))
+
+  def _get_spotify_token(self, username, password):
+    """ The login scraping is replaced by a fixed delay and a new fake token """
+    time.sleep(self._harness.login_latency)
+    self._harness.logins += 1
+    return 'stub-token-{}'.format(self._harness.logins), 3600
+
+  def _create_account(self, username, password, token_file, devices=()):
+    account = super()._create_account(username, password, token_file, devices)
+    if getattr(account, 'web_api', None) is not None:
+      # AsyncSpotifyWebAPI sends its requests through the stub
+      session = StubAsyncSession(self._harness.stub)
+      async def get_session():
+        return session
+      account.web_api._get_session = get_session
+    return account
+
+
+class LoadTestAsyncAppAPI(LoadTestAppAPI):
+  """ Appdaemon API of an async app: get_state is a coroutine """
+
+  async def get_state(self, entity=None, attribute=None, **kwargs):
+    return self._harness.states(entity)
+
+
+######################   LOAD TEST   ########################
+
+class LoadTest:
+  """ Runs an app on the stubs, replays the events and collects the measurements """
+
+  def __init__(self, options):
+    self.options = options
+    self.stub = StubSpotify(StubCatalog(), ['Speaker {}'.format(n) for n in range(1, options.devices + 1)],
+                            ['Cast {}'.format(n) for n in range(1, options.casts + 1)],
+                            options.latency / 1000.0, options.jitter / 1000.0, options.error_rate, options.error_statuses, options.seed)
+    self.pychromecast = build_stub_pychromecast(self.stub, options.cast_latency / 1000.0, options.discovery_latency / 1000.0,
+                                                options.cast_error_rate, options.seed)
+    self.login_latency = options.login_latency / 1000.0
+    self.logins = 0
+    self.listeners = {}                 # Event name -> app callback
+    self.published = {}                 # Entity -> last state set by the app
+    self.log_levels = collections.Counter()
+    self.log_messages = collections.Counter()
+    self._log_lock = threading.Lock()
+    self.executor = None
+    self.scheduler = None
+    self.loop = None
+    self.results = []                   # (kind, latency, service time, API calls, error) per event
+
+  def states(self, entity):
+    """ media_player entities of the casts (get_state('media_player')) """
+    players = {}
+    for name in self.stub.casts:
+      entity_id = 'media_player.' + name.lower().replace(' ', '_')
+      players[entity_id] = {'entity_id': entity_id, 'state': 'idle', 'attributes': {'friendly_name': name}}
+    if entity is None or entity == 'media_player':
+      return players
+    return players.get(entity)
+
+  def app_log(self, msg, level):
+    with self._log_lock:
+      self.log_levels[level] += 1
+      if level in ('WARNING', 'ERROR'):
+        # Group the messages that only differ by names and numbers
+        self.log_messages['{}: {}'.format(level, re.sub(r'"[^"]*"|\d+', '#', msg.splitlines()[0])[:120])] += 1
+    if self.options.verbose or (level == 'ERROR' and not self.options.quiet):
+      print('[{}] {}'.format(level, msg), file=sys.stderr)
+
+  ######## Setup ########
+
+  def start_app(self):
+    """ Create and initialize the app, returns it once its first token is ready """
+    install_stub_modules(self.pychromecast)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    spotify_client = importlib.import_module('spotify_client')
+    requests.adapters.HTTPAdapter.send = lambda adapter, request, **kwargs: _stub_http_send(self.stub, adapter, request, **kwargs)
+
+    base = spotify_client.AsyncSpotifyClient if self.options.app == 'async' else spotify_client.SpotifyClient
+    api = LoadTestAsyncAppAPI if self.options.app == 'async' else LoadTestAppAPI
+    app_class = type('LoadTest' + base.__name__, (api, base), {})
+
+    args = {'username': 'loadtest', 'password': 'loadtest', 'cast_health_monitor': False}
+    args.update(self.options.config)
+    self.app_dir = tempfile.mkdtemp(prefix='spotify_loadtest_')
+    self.app = app_class(self, args, self.app_dir)
+
+    # The worker threads running the events and timers, like the Appdaemon thread pool
+    self.executor = concurrent.futures.ThreadPoolExecutor(self.options.concurrency, thread_name_prefix='spotify_loadtest_worker')
+    self.scheduler = StubScheduler(self._run_timer)
+    self.scheduler.start()
+    if self.options.app == 'async':
+      self.loop = asyncio.new_event_loop()
+      threading.Thread(target=self.loop.run_forever, name='spotify_loadtest_loop', daemon=True).start()
+
+    started = time.monotonic()
+    self.app.initialize()
+    if not self.app._ready.wait(60):
+      raise RuntimeError('The app did not get its first token in 60s.')
+    self.startup_time = time.monotonic() - started
+    self.play_event = self.app._event_play
+    self.controls_event = self.app._event_controls
+
+  def _run_timer(self, callback, kwargs):
+    """ Run an app timer callback on the workers (or the event loop for a coroutine) """
+    if asyncio.iscoroutinefunction(callback):
+      asyncio.run_coroutine_threadsafe(callback(kwargs), self.loop)
+    else:
+      self.executor.submit(self._guarded, callback, kwargs)
+
+  def _guarded(self, callback, kwargs):
+    try:
+      callback(kwargs)
+    except Exception as e:
+      self.app_log('Timer callback {} failed: {!r}'.format(getattr(callback, '__name__', callback), e), 'ERROR')
+
+  def stop(self):
+    if self.scheduler is not None:
+      self.scheduler.stop()
+    try:
+      terminate = self.app.terminate()
+      if asyncio.iscoroutine(terminate):
+        asyncio.run_coroutine_threadsafe(terminate, self.loop).result(30)
+    except Exception as e:
+      self.app_log('terminate failed: {!r}'.format(e), 'WARNING')
+    if self.loop is not None:
+      self.loop.call_soon_threadsafe(self.loop.stop)
+    if self.executor is not None:
+      self.executor.shutdown(wait=False)
+    shutil.rmtree(self.app_dir, ignore_errors=True)
+
+  ######## Replay ########
+
+  def event_callback(self, event):
+    """ Returns the app callback of an event ('spotify.play' -> _spotify_play_event_callback) """
+    if event['event'].endswith('.controls'):
+      return 'controls', self.app._spotify_controls_event_callback, self.controls_event
+    return 'play', self.app._spotify_play_event_callback, self.play_event
+
+  def replay(self, events):
+    """ Fire the events at the configured rate and wait for them and the work they scheduled to finish """
+    interval = 1.0 / self.options.rate if self.options.rate else 0
+    self.started = time.monotonic()
+    if self.options.app == 'async':
+      asyncio.run_coroutine_threadsafe(self._async_replay(events, interval), self.loop).result()
+    else:
+      self._replay(events, interval)
+    self.elapsed = time.monotonic() - self.started
+    # Retries, queued tracks... scheduled by the events
+    time.sleep(self.options.drain)
+
+  def _replay(self, events, interval):
+    futures = []
+    slots = threading.BoundedSemaphore(self.options.concurrency)
+    for i, event in enumerate(events):
+      due = self.started + i * interval
+      if interval:
+        time.sleep(max(0, due - time.monotonic()))
+      elif not self.options.rate:
+        # As fast as possible: a new event as soon as a worker is free
+        slots.acquire()
+        due = time.monotonic()
+      future = self.executor.submit(self._run_event, event, due)
+      if not self.options.rate:
+        future.add_done_callback(lambda f: slots.release())
+      futures.append(future)
+    for future in futures:
+      future.result()
+
+  def _run_event(self, event, due):
+    kind, callback, event_name = self.event_callback(event)
+    counter = [0]
+    def run():
+      _event_calls.set(counter)
+      callback(event_name, dict(event['data']), {})
+    start = time.monotonic()
+    error = None
+    try:
+      contextvars.copy_context().run(run)
+    except Exception as e:
+      error = repr(e)
+    end = time.monotonic()
+    self.results.append((kind, end - due, end - start, counter[0], error))
+
+  async def _async_replay(self, events, interval):
+    slots = asyncio.Semaphore(self.options.concurrency)
+    tasks = []
+    for i, event in enumerate(events):
+      # As fast as possible: the latency is counted from when the event gets a slot
+      due = self.started + i * interval if self.options.rate else None
+      if interval:
+        await asyncio.sleep(max(0, due - time.monotonic()))
+      tasks.append(asyncio.ensure_future(self._async_run_event(event, due, slots)))
+    await asyncio.gather(*tasks)
+
+  async def _async_run_event(self, event, due, slots):
+    kind, callback, event_name = self.event_callback(event)
+    counter = [0]
+    _event_calls.set(counter)
+    async with slots:
+      start = time.monotonic()
+      due = start if due is None else due
+      error = None
+      try:
+        await callback(event_name, dict(event['data']), {})
+      except Exception as e:
+        error = repr(e)
+      end = time.monotonic()
+    self.results.append((kind, end - due, end - start, counter[0], error))
+
+  ######## Report ########
+
+  def report(self):
+    """ Returns the measurements as a dictionary """
+    def stats(rows):
+      latencies = sorted(r[1] for r in rows)
+      services = sorted(r[2] for r in rows)
+      return {
+        'events': len(rows),
+        'failed': sum(1 for r in rows if r[4]),
+        'latency': {'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95), 'p99': percentile(latencies, 99),
+                    'max': latencies[-1] if latencies else None},
+        'service_time': {'p50': percentile(services, 50), 'p95': percentile(services, 95), 'p99': percentile(services, 99)},
+        'api_calls_per_event': sum(r[3] for r in rows) / len(rows) if rows else 0,
+      }
+
+    total_calls = sum(self.stub.calls.values())
+    errors = collections.Counter(r[4] for r in self.results if r[4])
+    calls = sorted(r[3] for r in self.results)
+    return {
+      'app': self.options.app,
+      'rate': self.options.rate,
+      'concurrency': self.options.concurrency,
+      'config': self.options.config,
+      'startup_time': self.startup_time,
+      'duration': self.elapsed,
+      'throughput_per_minute': len(self.results) / self.elapsed * 60 if self.elapsed else None,
+      'all': stats(self.results),
+      'play': stats([r for r in self.results if r[0] == 'play']),
+      'controls': stats([r for r in self.results if r[0] == 'controls']),
+      'api_calls': {
+        'total': total_calls,
+        'per_event': total_calls / len(self.results) if self.results else 0,
+        'event_p50': percentile(calls, 50),
+        'event_p95': percentile(calls, 95),
+        'event_max': calls[-1] if calls else None,
+        'by_endpoint': dict(self.stub.calls.most_common()),
+        'injected_errors': dict(self.stub.errors),
+        'not_modified': self.stub.not_modified,
+      },
+      'casts': dict(self.pychromecast.stats),
+      'logins': self.logins,
+      'event_errors': dict(errors.most_common(10)),
+      'app_log': {'levels': dict(self.log_levels), 'top_warnings': dict(self.log_messages.most_common(10))},
+    }
+
+
+def format_report(report):
+  """ Returns the report as text """
+  def seconds(value):
+    return '{:8.3f}'.format(value) if value is not None else '       -'
+
+  lines = [
+    'App: {} (startup {:.2f}s), rate: {}, concurrency: {}, config: {}'.format(
+      report['app'], report['startup_time'], '{}/s'.format(report['rate']) if report['rate'] else 'max', report['concurrency'],
+      json.dumps(report['config'])),
+    'Events: {} ({} play, {} controls), {} failed, in {:.1f}s'.format(
+      report['all']['events'], report['play']['events'], report['controls']['events'], report['all']['failed'], report['duration']),
+    'Throughput: {:.1f} events/min'.format(report['throughput_per_minute'] or 0),
+    '',
+    'Latency (s)         p50      p95      p99      max   service p50/p95   API calls/event',
+  ]
+  for kind in ('all', 'play', 'controls'):
+    s = report[kind]
+    if not s['events']:
+      continue
+    lines.append('  {:<10}{}{}{}{}   {}/{}   {:.1f}'.format(
+      kind, seconds(s['latency']['p50']), seconds(s['latency']['p95']), seconds(s['latency']['p99']), seconds(s['latency']['max']),
+      seconds(s['service_time']['p50']).strip(), seconds(s['service_time']['p95']).strip(), s['api_calls_per_event']))
+
+  api = report['api_calls']
+  lines += [
+    '',
+    'Spotify API calls: {} ({:.1f} per event including background work; per event p50 {}, p95 {}, max {})'.format(
+      api['total'], api['per_event'], api['event_p50'], api['event_p95'], api['event_max']),
+  ]
+  lines += ['  {:>6}  {}'.format(count, name) for name, count in list(api['by_endpoint'].items())[:12]]
+  lines.append('Injected API errors: {}, 304 Not Modified: {}, logins: {}'.format(
+    ', '.join('{}: {}'.format(k, v) for k, v in sorted(api['injected_errors'].items())) or 'none', api['not_modified'], report['logins']))
+  lines.append('Chromecast: {}'.format(', '.join('{} {}'.format(v, k) for k, v in sorted(report['casts'].items())) or 'not used'))
+  if report['event_errors']:
+    lines += ['', 'Event exceptions:'] + ['  {:>6}  {}'.format(v, k) for k, v in report['event_errors'].items()]
+  if report['app_log']['top_warnings']:
+    lines += ['', 'App warnings/errors:'] + ['  {:>6}  {}'.format(v, k) for k, v in report['app_log']['top_warnings'].items()]
+  return '\n'.join(lines)
+
+
+######################   EVENTS   ########################
+
+def load_events(path):
+  """ Returns the events of a JSONL file as {'event': name, 'data': dict} """
+  events = []
+  with open(path) as f:
+    for n, line in enumerate(f, 1):
+      line = line.strip()
+      if not line or line.startswith('#'):
+        continue
+      try:
+        record = json.loads(line)
+      except ValueError as e:
+        raise SystemExit('{}:{}: invalid JSON: {}'.format(path, n, e))
+      if 'data' in record and 'event' in record:
+        events.append({'event': record['event'], 'data': record['data']})
+      else:
+        events.append({'event': 'spotify.controls' if 'action' in record else 'spotify.play', 'data': record})
+  return events
+
+
+def generate_events(count, controls_ratio, devices, catalog, seed=None):
+  """
+  Returns a random mix of play and controls events over the stub catalog
+
+  param count: Number of events
+  param controls_ratio: Fraction of controls events
+  param devices: Device names to play on
+  """
+  rng = random.Random(seed)
+  events = []
+  for _ in range(count):
+    if rng.random() < controls_ratio:
+      action = _weighted_choice(rng, CONTROLS_ACTIONS)
+      if action == 'volume_level':
+        data = {'volume_level': rng.randint(10, 90)}
+      elif action == 'transfer_playback':
+        data = {'transfer_playback': rng.choice(devices)}
+      else:
+        data = {'action': action}
+      events.append({'event': 'spotify.controls', 'data': data})
+      continue
+
+    kind = _weighted_choice(rng, PLAY_KINDS)
+    data = {'device': rng.choice(devices)}
+    if kind == 'playlist_uri':
+      data['playlist'] = catalog.uri('playlist', rng.randrange(catalog.playlists))
+    elif kind == 'track_uri':
+      data['track'] = catalog.uri('track', rng.randrange(catalog.tracks))
+    elif kind == 'album_uri':
+      data['album'] = catalog.uri('album', rng.randrange(catalog.albums))
+    elif kind == 'artist_name':
+      data['artist'] = 'Artist {}'.format(rng.randrange(catalog.artists))
+    elif kind == 'genre':
+      data['genre'] = rng.choice(GENRES)
+    elif kind == 'category':
+      data['category'] = rng.choice(CATEGORIES)
+    elif kind == 'multiple':
+      data.update({'track': catalog.uri('track', rng.randrange(catalog.tracks)), 'multiple': True})
+    else:
+      data[kind] = True
+    if rng.random() < 0.3:
+      data['random_start'] = True
+    if rng.random() < 0.2:
+      data['shuffle'] = True
+    events.append({'event': 'spotify.play', 'data': data})
+  return events
+
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description='Replay play/controls events against SpotifyClient on stubbed Spotify and Chromecast backends.')
+  parser.add_argument('events_file', nargs='?', help='JSONL file of events to replay (generated when omitted)')
+  parser.add_argument('--events', type=int, default=200, help='Number of events to generate (default: 200)')
+  parser.add_argument('--controls-ratio', type=float, default=0.3, help='Fraction of generated controls events (default: 0.3)')
+  parser.add_argument('--save-events', help='Write the replayed events to this JSONL file')
+  parser.add_argument('--rate', type=float, default=5.0, help='Events per second, 0 = as fast as the concurrency allows (default: 5)')
+  parser.add_argument('--concurrency', type=int, default=10, help='Worker threads/events in flight, the Appdaemon default is 10 (default: 10)')
+  parser.add_argument('--app', choices=['sync', 'async'], default='sync', help='SpotifyClient or AsyncSpotifyClient (default: sync)')
+  parser.add_argument('--config', type=json.loads, default={}, help='JSON object of app config options (ex: \'{"http_cache": true}\')')
+  parser.add_argument('--devices', type=int, default=3, help='Spotify Connect speakers (default: 3)')
+  parser.add_argument('--casts', type=int, default=2, help='Chromecasts (default: 2)')
+  parser.add_argument('--latency', type=float, default=50, help='Mean Web API latency in ms (default: 50)')
+  parser.add_argument('--jitter', type=float, default=20, help='Standard deviation of the Web API latency in ms (default: 20)')
+  parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of Web API calls that fail (default: 0)')
+  parser.add_argument('--error-statuses', type=lambda s: [int(x) for x in s.split(',')], default=[429, 500, 502, 503],
+                      help='HTTP statuses of the injected errors (default: 429,500,502,503)')
+  parser.add_argument('--cast-latency', type=float, default=300, help='Chromecast connect and Spotify launch time in ms (default: 300)')
+  parser.add_argument('--discovery-latency', type=float, default=5000, help='Chromecast discovery time in ms (default: 5000)')
+  parser.add_argument('--cast-error-rate', type=float, default=0.0, help='Fraction of Spotify launches on a cast that fail (default: 0)')
+  parser.add_argument('--login-latency', type=float, default=1000, help='Time to get a Spotify token in ms (default: 1000)')
+  parser.add_argument('--drain', type=float, default=3.0, help='Seconds to let the scheduled work finish after the last event (default: 3)')
+  parser.add_argument('--seed', type=int, help='Random seed for the generated events, latencies and errors')
+  parser.add_argument('--report', help='Write the report as JSON to this file')
+  parser.add_argument('--verbose', action='store_true', help='Print all the app logs')
+  parser.add_argument('--quiet', action='store_true', help='Don\'t print the app errors as they happen')
+  return parser.parse_args(argv)
+
+
+def main(argv=None):
+  options = parse_args(argv)
+  test = LoadTest(options)
+  devices = test.stub.speakers + test.stub.casts
+  if options.events_file:
+    events = load_events(options.events_file)
+  else:
+    events = generate_events(options.events, options.controls_ratio, devices, test.stub.catalog, options.seed)
+  if options.save_events:
+    with open(options.save_events, 'w') as f:
+      for event in events:
+        f.write(json.dumps(event) + '\n')
+
+  test.start_app()
+  try:
+    test.replay(events)
+  finally:
+    test.stop()
+
+  report = test.report()
+  print(format_report(report))
+  if options.report:
+    with open(options.report, 'w') as f:
+      json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+  main()
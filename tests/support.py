@@ -0,0 +1,163 @@
+"""
+Helpers shared by the tests of the SpotifyClient app
+
+The app is run without Appdaemon: AppdaemonAPI provides the few Appdaemon methods the app uses and
+keeps the timers for the tests to fire. The Spotify login is replaced, the Web API calls are made
+on a FakeSpotify given to the app by the test.
+"""
+
+import asyncio
+import datetime
+import functools
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import spotify_client
+
+
+def track_uri(i):
+  return 'spotify:track:{:022d}'.format(i)
+
+
+def playlist_uri(i):
+  return 'spotify:playlist:{:022d}'.format(i)
+
+
+class Clock:
+  """ Replaces time.monotonic in the app module """
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+  def advance(self, seconds):
+    self.now += seconds
+
+
+class ClockTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = Clock()
+    patcher = mock.patch.object(spotify_client.time, 'monotonic', self.clock)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+
+class AppdaemonAPI:
+  """ The Appdaemon API used by the app, the timers only run when the test fires them """
+
+  def __init__(self, args, app_dir):
+    self.args = args
+    self._test_app_dir = app_dir
+    self.logs = []                      # (level, message)
+    self.timers = {}                    # Handle -> (callback, kwargs)
+    self.states = {}                    # Entity id -> set_state keyword arguments
+    self._handles = itertools.count(1)
+
+  @property
+  def app_dir(self):
+    return self._test_app_dir
+
+  def log(self, msg, level='INFO', **kwargs):
+    self.logs.append((level, msg))
+
+  def run_in(self, callback, delay, **kwargs):
+    handle = next(self._handles)
+    self.timers[handle] = (callback, kwargs)
+    return handle
+
+  def run_every(self, callback, start, interval, **kwargs):
+    return self.run_in(callback, interval, **kwargs)
+
+  def cancel_timer(self, handle):
+    self.timers.pop(handle, None)
+
+  def listen_event(self, callback, event=None, **kwargs):
+    pass
+
+  def datetime(self):
+    return datetime.datetime.now()
+
+  def get_state(self, entity_id=None, **kwargs):
+    if entity_id is not None and '.' not in entity_id:
+      # A domain: entity id -> state of the entities of the domain
+      return {e: state for e, state in self.states.items() if e.startswith(entity_id + '.')}
+    return self.states.get(entity_id)
+
+  def set_state(self, entity_id, **kwargs):
+    self.states[entity_id] = kwargs
+
+  async def run_in_executor(self, func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+  def fire_timers(self, callback_name):
+    """ Run the pending timers of a callback, returns how many ran """
+    ran = 0
+    for handle, (callback, kwargs) in list(self.timers.items()):
+      if callback.__name__ == callback_name and self.timers.pop(handle, None):
+        callback(kwargs)
+        ran += 1
+    return ran
+
+
+class FakeSpotify:
+  """ Stands in for spotipy.Spotify, the responses are set by the tests and the calls are recorded """
+
+  def __init__(self, **responses):
+    self.responses = responses          # Method name -> response or callable(*args, **kwargs)
+    self.calls = []                     # (method name, args, kwargs)
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+
+    def call(*args, **kwargs):
+      self.calls.append((name, args, kwargs))
+      response = self.responses.get(name)
+      if callable(response):
+        return response(*args, **kwargs)
+      return response
+    return call
+
+  def called(self, name):
+    return [(args, kwargs) for method, args, kwargs in self.calls if method == name]
+
+
+class AppTestCase(unittest.TestCase):
+  """ Runs a SpotifyClient (app_class) logged in with a fake token """
+
+  app_class = spotify_client.SpotifyClient
+
+  def make_app(self, app_dir=None, **config):
+    if app_dir is None:
+      app_dir = self.make_app_dir()
+    patcher = mock.patch.object(spotify_client.SpotifyClient, '_get_spotify_token', return_value=('token', 3600))
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    args = dict({'username': 'user', 'password': 'password', 'cast_health_monitor': False}, **config)
+    app = type('TestApp', (AppdaemonAPI, self.app_class), {})(args, app_dir)
+    app.initialize()
+    self.addCleanup(self._terminate, app)
+    self.assertTrue(app._ready.wait(5))
+    return app
+
+  def make_app_dir(self):
+    app_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, app_dir, True)
+    return app_dir
+
+  @staticmethod
+  def _terminate(app):
+    # The terminate method of AsyncSpotifyClient is a coroutine
+    result = app.terminate()
+    if asyncio.iscoroutine(result):
+      asyncio.run(result)
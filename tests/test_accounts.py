@@ -0,0 +1,46 @@
+"""
+Tests of the additional Spotify accounts
+"""
+
+import os
+import time
+import unittest
+
+from support import AppTestCase
+
+
+class AccountRoutingTest(AppTestCase):
+
+  def setUp(self):
+    self.app = self.make_app(accounts=[{'username': 'guest', 'password': 'password', 'devices': ['Guest Room']}],
+                             user_aliases={'visitor': 'guest'}, device_aliases={'guest_tv': 'Guest Room'})
+
+  def test_account_parameter(self):
+    self.assertIs(self.app._event_account({'account': 'guest'}), self.app._accounts['guest'])
+    self.assertIs(self.app._event_account({'account': 'visitor'}), self.app._accounts['guest'])
+
+  def test_username_is_whose_playlists_are_searched(self):
+    self.assertIs(self.app._event_account({'username': 'guest'}), self.app._main_account)
+
+  def test_device_of_the_account(self):
+    self.assertIs(self.app._event_account({'device': 'Guest Room'}), self.app._accounts['guest'])
+    self.assertIs(self.app._event_account({'device': 'guest_tv'}), self.app._accounts['guest'])
+    self.assertIs(self.app._event_account({'transfer_playback': 'Guest Room'}), self.app._accounts['guest'])
+    self.assertIs(self.app._event_account({'device': 'Kitchen'}), self.app._main_account)
+
+  def test_each_account_has_its_token(self):
+    guest = self.app._accounts['guest']
+    self.assertEqual(os.path.basename(guest.token_file), 'spotify_client_token.guest.json')
+    # The additional accounts get their token in the background
+    for _ in range(50):
+      if guest.access_token:
+        break
+      time.sleep(0.1)
+    with self.app._use_account('guest'):
+      self.assertEqual(self.app._username, 'guest')
+      self.assertEqual(self.app._access_token, 'token')
+    self.assertEqual(self.app._username, 'user')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,55 @@
+"""
+Tests of the async client
+"""
+
+import asyncio
+import importlib.util
+import unittest
+from unittest import mock
+
+import spotipy
+
+from support import AppTestCase
+import spotify_client
+from spotify_client import AsyncSpotifyWebAPI
+
+
+class AsyncAccountsTest(AppTestCase):
+
+  app_class = spotify_client.AsyncSpotifyClient
+
+  def test_chunks_task_per_account(self):
+    app = self.make_app(accounts=[{'username': 'guest', 'password': 'password'}])
+    main_task, guest_task = mock.Mock(), mock.Mock()
+    app._chunks_task = main_task
+    with app._use_account('guest'):
+      self.assertIsNone(app._chunks_task)
+      app._chunks_task = guest_task
+    self.assertIs(app._chunks_task, main_task)
+    self.assertIs(app._accounts['guest'].chunks_task, guest_task)
+
+
+@unittest.skipUnless(importlib.util.find_spec('aiohttp'), 'aiohttp is not installed')
+class AsyncSpotifyWebAPITest(unittest.TestCase):
+
+  def test_network_errors_are_spotify_exceptions(self):
+    import aiohttp
+    api = AsyncSpotifyWebAPI('token')
+    for error in (asyncio.TimeoutError(), aiohttp.ClientConnectionError('reset')):
+      with self.subTest(error=error), mock.patch.object(api, '_send_request', side_effect=error):
+        with self.assertRaises(spotipy.client.SpotifyException) as raised:
+          asyncio.run(api.devices())
+        self.assertEqual(raised.exception.http_status, 599)
+
+  def test_network_errors_open_the_circuit(self):
+    api = AsyncSpotifyWebAPI('token')
+    breaker = spotify_client.CircuitBreaker('player', 1, 60)
+    api.set_breakers({'player': breaker})
+    with mock.patch.object(api, '_send_request', side_effect=asyncio.TimeoutError()):
+      with self.assertRaises(spotipy.client.SpotifyException):
+        asyncio.run(api.devices())
+    self.assertEqual(breaker.state, spotify_client.CircuitBreaker.OPEN)
+
+
+if __name__ == '__main__':
+  unittest.main()
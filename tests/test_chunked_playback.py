@@ -0,0 +1,105 @@
+"""
+Tests of the chunked playback of long track lists
+"""
+
+import unittest
+from unittest import mock
+
+from support import AppTestCase, FakeSpotify, track_uri
+import spotify_client
+from spotify_client import ChunkedTrackList
+
+class ChunkedTrackListTest(unittest.TestCase):
+
+  def setUp(self):
+    self.uris = [track_uri(i) for i in range(8)]
+    self.chunks = ChunkedTrackList(self.uris, 3, start=4)
+
+  def playback(self, uri, progress_ms=0, is_playing=True, shuffle=False, repeat='off'):
+    return {'item': {'uri': uri, 'duration_ms': 100000}, 'progress_ms': progress_ms, 'is_playing': is_playing,
+            'shuffle_state': shuffle, 'repeat_state': repeat}
+
+  def test_chunks_in_list_order(self):
+    self.assertEqual(self.chunks.chunk(), self.uris[3:6])
+    self.assertEqual(self.chunks.offset, 1)
+    self.assertTrue(self.chunks.has_next())
+    self.assertEqual(self.chunks.remaining(), 2)
+    self.assertEqual(self.chunks.next_chunk(), self.uris[6:8])
+    self.assertFalse(self.chunks.has_next())
+    # Repeating the list
+    self.assertEqual(self.chunks.next_chunk(), self.uris[0:3])
+
+  def test_next_chunk_when_the_last_track_ends(self):
+    self.assertEqual(self.chunks.check(self.playback(self.uris[4], 40000)), 61)
+    self.assertEqual(self.chunks.check(self.playback(self.uris[5], 40000)), 60 - spotify_client.CHUNK_SWITCH_LEAD)
+    self.assertEqual(self.chunks.check(self.playback(self.uris[5], 99500)), 0)
+
+  def test_end_of_the_list(self):
+    self.chunks.next_chunk()
+    self.assertIsNone(self.chunks.check(self.playback(self.uris[7], 99500)))
+    self.assertEqual(self.chunks.check(self.playback(self.uris[7], 99500, repeat='context')), 0)
+
+  def test_repeat_track_and_paused(self):
+    self.assertEqual(self.chunks.check(self.playback(self.uris[5], 99500, repeat='track')), 1.5)
+    self.assertEqual(self.chunks.check(self.playback(self.uris[5], 40000, is_playing=False)), spotify_client.CHUNK_PAUSED_INTERVAL)
+
+  def test_stopped_at_the_end_of_the_chunk(self):
+    # The switch was missed and Spotify stopped on the last track or went back to the first one
+    self.assertEqual(self.chunks.check(self.playback(self.uris[5], 100000, is_playing=False)), 0)
+    self.assertEqual(self.chunks.check(self.playback(self.uris[3], is_playing=False)), 0)
+
+  def test_shuffle_waits_for_every_track_of_the_chunk(self):
+    self.assertEqual(self.chunks.check(self.playback(self.uris[5], 99500, shuffle=True)), 1.5)
+    self.chunks.check(self.playback(self.uris[3], shuffle=True))
+    self.assertEqual(self.chunks.check(self.playback(self.uris[4], 99500, shuffle=True)), 0)
+
+  def test_stops_when_something_else_plays(self):
+    self.assertIsNone(self.chunks.check(self.playback(self.uris[6])))
+    self.assertIsNone(self.chunks.check(None))
+
+
+class ChunkedPlaybackTest(AppTestCase):
+
+  def setUp(self):
+    self.uris = [track_uri(i) for i in range(8)]
+
+  def make_app(self, **config):
+    app = super().make_app(**config)
+    # Logging the play looks the track up
+    patcher = mock.patch.object(app, '_log_playback_action')
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    return app
+
+  def test_play_from_an_offset(self):
+    app = self.make_app(play_chunk_size=3)
+    app.sp = FakeSpotify()
+    self.assertTrue(app._play('device', self.uris, offset=self.uris[4]))
+    (_, kwargs), = app.sp.called('start_playback')
+    self.assertEqual(kwargs['uris'], self.uris[3:6])
+    self.assertEqual(kwargs['offset'], {'position': 1})
+
+  def test_follow_chunks_per_account(self):
+    app = self.make_app(play_chunk_size=3, accounts=[{'username': 'guest', 'password': 'password'}])
+    app.sp = FakeSpotify(current_playback={'item': {'uri': self.uris[2], 'duration_ms': 100000}, 'progress_ms': 99500,
+                                           'is_playing': True, 'repeat_state': 'off'})
+    app._play('device', self.uris)
+    with app._use_account('guest'):
+      app.sp = FakeSpotify()
+      app._play('device', track_uri(100))
+    # The play with the other account doesn't stop following the chunks
+    self.assertEqual(app.fire_timers('_next_chunk_callback'), 1)
+    self.assertEqual(app.sp.called('start_playback')[-1][1]['uris'], self.uris[3:6])
+
+  def test_snapshot_saves_the_chunk(self):
+    app = self.make_app(play_chunk_size=3)
+    app.sp = FakeSpotify()
+    app._play('device', self.uris, offset=4)
+    app._store_snapshot('default', {'device': {'id': 'device', 'name': 'Speaker'}, 'shuffle_state': False, 'repeat_state': 'off',
+                                    'currently_playing_type': 'track', 'item': {'uri': self.uris[7]}, 'context': None,
+                                    'progress_ms': 1000})
+    self.assertEqual(app._snapshots['default']['uris'], self.uris[6:8])
+
+
+if __name__ == '__main__':
+  unittest.main()
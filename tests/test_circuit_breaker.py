@@ -0,0 +1,116 @@
+"""
+Tests of the circuit breakers around the Spotify Web API
+"""
+
+import asyncio
+import unittest
+from unittest import mock
+
+import requests
+import spotipy
+
+from support import ClockTestCase
+from spotify_client import AsyncSpotifyWebAPI, CircuitBreaker
+
+class CircuitBreakerTest(ClockTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.changes = []
+    self.breaker = CircuitBreaker('player', threshold=3, reset_timeout=10, on_change=lambda b: self.changes.append(b.state))
+
+  def fail(self, status=503):
+    self.breaker.record(spotipy.client.SpotifyException(status, -1, 'error'))
+
+  def test_opens_after_threshold_failures(self):
+    self.fail()
+    self.fail()
+    self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+    self.fail()
+    self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+    self.assertEqual(self.changes, [CircuitBreaker.OPEN])
+    with self.assertRaises(spotipy.client.SpotifyException) as ctx:
+      self.breaker.before_call()
+    self.assertEqual(ctx.exception.http_status, 503)
+
+  def test_success_resets_the_failure_count(self):
+    self.fail()
+    self.fail()
+    self.breaker.record()
+    self.fail()
+    self.fail()
+    self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+  def test_client_errors_are_not_failures(self):
+    for _ in range(5):
+      self.fail(404)
+    self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+    self.assertTrue(CircuitBreaker.is_failure(spotipy.client.SpotifyException(429, -1, 'rate limited')))
+    self.assertTrue(CircuitBreaker.is_failure(requests.exceptions.ConnectionError()))
+
+  def test_half_open_lets_a_single_probe_through(self):
+    for _ in range(3):
+      self.fail()
+    self.clock.advance(10)
+    self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+    self.breaker.before_call()
+    with self.assertRaises(spotipy.client.SpotifyException):
+      self.breaker.before_call()
+
+  def test_successful_probe_closes(self):
+    for _ in range(3):
+      self.fail()
+    self.clock.advance(10)
+    self.assertEqual(self.breaker.call(lambda: 'ok'), 'ok')
+    self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+    self.assertEqual(self.changes, [CircuitBreaker.OPEN, CircuitBreaker.CLOSED])
+
+  def test_failed_probe_opens_twice_as_long(self):
+    for _ in range(3):
+      self.fail()
+    self.clock.advance(10)
+    self.breaker.before_call()
+    self.fail()
+    self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+    self.assertEqual(self.breaker.retry_in(), 20)
+    self.clock.advance(19)
+    self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+    self.clock.advance(1)
+    self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+
+  def open_and_wait(self):
+    for _ in range(3):
+      self.fail()
+    self.clock.advance(10)
+
+  def test_cancelled_probe_lets_the_next_call_probe(self):
+    self.open_and_wait()
+
+    def cancelled():
+      raise KeyboardInterrupt()
+    with self.assertRaises(KeyboardInterrupt):
+      self.breaker.call(cancelled)
+    self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+    self.breaker.before_call()
+
+  def test_cancelled_async_probe_lets_the_next_call_probe(self):
+    self.open_and_wait()
+    api = AsyncSpotifyWebAPI('token')
+    api.set_breakers({'player': self.breaker})
+
+    async def hang(*args):
+      await asyncio.sleep(60)
+
+    async def cancel_probe():
+      with mock.patch.object(api, '_send', hang):
+        task = asyncio.ensure_future(api.devices())
+        await asyncio.sleep(0)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+          await task
+    asyncio.run(cancel_probe())
+    self.breaker.before_call()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,45 @@
+"""
+Tests of the Spotify Connect device detection
+"""
+
+import unittest
+from unittest import mock
+
+from support import AppTestCase, Clock
+import spotify_client
+
+
+class ConnectDeviceTest(AppTestCase):
+
+  def setUp(self):
+    self.clock = Clock()
+    patcher = mock.patch.object(spotify_client.time, 'monotonic', self.clock)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def test_saved_device_guess_is_not_saved_and_expires(self):
+    app = self.make_app()
+    app._spotify_devices['Speaker'] = 'id'
+    with mock.patch.object(app, '_save_device_registry') as save:
+      self.assertTrue(app._is_connect_device('Speaker'))
+      save.assert_not_called()
+    self.assertNotIn('Speaker', app._connect_devices)
+    self.clock.advance(spotify_client.CONNECT_DEVICE_GUESS_TTL - 1)
+    self.assertTrue(app._is_connect_device('Speaker'))
+    self.clock.advance(2)
+    # Discovery checks the device
+    self.assertFalse(app._is_connect_device('Speaker'))
+
+  def test_discovered_connect_device(self):
+    app = self.make_app()
+    app._spotify_devices['Speaker'] = 'id'
+    with mock.patch.object(spotify_client.pychromecast, 'get_chromecasts', return_value=[], create=True), \
+         mock.patch.object(app, '_search_spotify_for_device', return_value='id'):
+      self.assertIsNone(app._get_chromcast_device('Speaker', force_discovery=True))
+    self.assertIn('Speaker', app._connect_devices)
+    self.clock.advance(spotify_client.CONNECT_DEVICE_GUESS_TTL + 1)
+    self.assertTrue(app._is_connect_device('Speaker'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,51 @@
+"""
+Tests of the play deadline
+"""
+
+import unittest
+from unittest import mock
+
+from support import AppTestCase, ClockTestCase, playlist_uri
+from spotify_client import Deadline
+
+class DeadlineTest(ClockTestCase):
+
+  def test_passes(self):
+    deadline = Deadline(2)
+    self.clock.advance(1.5)
+    self.assertEqual(deadline.remaining(), 0.5)
+    self.assertFalse(deadline.passed())
+    self.clock.advance(0.5)
+    self.assertTrue(deadline.passed())
+    self.assertTrue(deadline.expired)
+    self.assertEqual(deadline.remaining(), 0)
+
+
+class DeadlineFallbackTest(ClockTestCase, AppTestCase):
+
+  def setUp(self):
+    super().setUp()
+    # play_deadline is not set, the events set their own deadline
+    self.app = self.make_app()
+    with mock.patch.object(self.app, 'get_playlists', return_value=[playlist_uri(1)]):
+      self.assertEqual(self.app.fire_timers('_refresh_fallback_pool'), 1)
+
+  def slow_genre(self, data, random_search):
+    self.clock.advance(5)
+    return None
+
+  def test_out_of_time_plays_the_fallback_pool(self):
+    with mock.patch.object(self.app, '_recommend_genre', side_effect=self.slow_genre), \
+         mock.patch.object(self.app, '_recommend_fallback') as fallback:
+      self.assertEqual(self.app.get_recommendation({'genre': 'rock', 'deadline': 2}), playlist_uri(1))
+    # The fallback calls Spotify, it is not used once the deadline passed
+    fallback.assert_not_called()
+
+  def test_in_time_uses_the_fallback(self):
+    with mock.patch.object(self.app, '_recommend_genre', return_value=None), \
+         mock.patch.object(self.app, '_recommend_fallback', return_value=playlist_uri(2)):
+      self.assertEqual(self.app.get_recommendation({'genre': 'rock', 'deadline': 2}), playlist_uri(2))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,40 @@
+"""
+Tests of the saved device registry
+"""
+
+import json
+import unittest
+from unittest import mock
+
+from support import AppTestCase
+import spotify_client
+
+
+def cast_info(name):
+  return {'host': '10.0.0.{}'.format(len(name)), 'port': 8009, 'model_name': 'Chromecast', 'friendly_name': name, 'uuid': name}
+
+
+class DeviceRegistryTest(AppTestCase):
+
+  def test_save_copies_the_devices(self):
+    app = self.make_app()
+    app._known_casts['kitchen'] = cast_info('kitchen')
+    app._spotify_devices['Speaker'] = 'id'
+    dump = json.dump
+
+    def changing_dump(registry, f):
+      # Discovery adds a cast while the registry is written
+      for _ in registry['casts']:
+        app._known_casts['bedroom'] = cast_info('bedroom')
+      dump(registry, f)
+
+    with mock.patch.object(spotify_client.json, 'dump', changing_dump):
+      app._save_device_registry()
+    with open(app._device_registry_file) as f:
+      registry = json.load(f)
+    self.assertEqual(list(registry['casts']), ['kitchen'])
+    self.assertEqual(registry['spotify_devices'], {'Speaker': 'id'})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,70 @@
+"""
+Tests of the fuzzy name index
+"""
+
+import unittest
+
+from support import AppTestCase, FakeSpotify, track_uri
+from spotify_client import FuzzyNameIndex
+
+class FuzzyNameIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.index = FuzzyNameIndex()
+    self.index.add('track', 'Bohemian Rhapsody', 'spotify:track:1', 'Queen', 'spotify:artist:queen')
+    self.index.add('track', 'Hello Goodbye', 'spotify:track:2', 'The Beatles', 'spotify:artist:beatles')
+    self.index.add('track', 'Hello', 'spotify:track:3', 'Adele', 'spotify:artist:adele')
+
+  def score(self, query, name):
+    return FuzzyNameIndex._score(FuzzyNameIndex.trigrams(query), FuzzyNameIndex.trigrams(name))
+
+  def test_exact_and_normalized_names_score_1(self):
+    self.assertEqual(self.score('Bohemian Rhapsody', 'Bohemian Rhapsody'), 1.0)
+    self.assertEqual(self.score('bohémian  rhapsody!', 'Bohemian Rhapsody'), 1.0)
+
+  def test_misspelling_scores_high(self):
+    self.assertGreater(self.score('bohemian rapsody', 'Bohemian Rhapsody'), 0.8)
+
+  def test_short_contained_query_scores_low(self):
+    self.assertLess(self.score('Hello', 'Hello Goodbye'), 0.7)
+    self.assertLessEqual(self.score('the', 'The Beatles'), 0.5)
+
+  def test_unrelated_names_score_low(self):
+    self.assertLess(self.score('Bohemian Rhapsody', 'Hello Goodbye'), 0.2)
+    self.assertEqual(self.score('', 'Hello'), 0.0)
+
+  def test_lookup_best_match(self):
+    self.assertEqual(self.index.lookup('track', 'bohemian rapsody')[:2], ('spotify:track:1', 'Bohemian Rhapsody'))
+    self.assertEqual(self.index.lookup('track', 'Hello')[0], 'spotify:track:3')
+    self.assertEqual(self.index.lookup('album', 'Hello'), (None, None, 0.0))
+
+  def test_lookup_requires_the_artist(self):
+    self.assertEqual(self.index.lookup('track', 'Bohemian Rhapsody', 'spotify:artist:queen')[2], 1.0)
+    self.assertEqual(self.index.lookup('track', 'Bohemian Rhapsody', 'Queen')[2], 1.0)
+    self.assertEqual(self.index.lookup('track', 'Bohemian Rhapsody', 'spotify:artist:adele'), (None, None, 0.0))
+    self.assertEqual(self.index.lookup('track', 'Bohemian Rhapsody', 'Adele'), (None, None, 0.0))
+    # Only the track of the artist can match, even with a worse name
+    self.assertEqual(self.index.lookup('track', 'Hello', 'spotify:artist:beatles')[0], 'spotify:track:2')
+    self.index.add('playlist', 'Hello', 'spotify:playlist:1')
+    self.assertEqual(self.index.lookup('playlist', 'Hello', 'Adele'), (None, None, 0.0))
+
+
+class FuzzyLookupTest(AppTestCase):
+
+  def setUp(self):
+    self.app = self.make_app(fuzzy_index=True)
+    self.app._fuzzy_index.add('track', 'Hello', track_uri(1), 'Adele', 'spotify:artist:adele')
+    self.app.sp = FakeSpotify(search={'tracks': {'items': [{'uri': track_uri(2)}]}},
+                              track=lambda uri: {'name': 'Hello', 'album': {'name': 'A', 'uri': 'spotify:album:a',
+                                                                            'artists': [{'name': 'Someone', 'uri': 'spotify:artist:x'}]}})
+
+  def test_confident_match_skips_the_search(self):
+    self.assertEqual(self.app.get_track_info('hello', 'adele')['uri'], track_uri(1))
+    self.assertEqual(self.app.sp.called('search'), [])
+
+  def test_same_name_by_another_artist_is_searched(self):
+    self.assertEqual(self.app.get_track_info('Hello', 'Lionel Richie')['uri'], track_uri(2))
+    self.assertEqual(len(self.app.sp.called('search')), 1)
+
+if __name__ == '__main__':
+  unittest.main()
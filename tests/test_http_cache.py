@@ -0,0 +1,133 @@
+"""
+Tests of the HTTP response cache of the Web API responses
+"""
+
+import unittest
+from unittest import mock
+
+import requests
+
+import support  # Puts the app folder on sys.path
+from spotify_client import CachingHTTPAdapter, HTTPResponseCache
+
+class FakeTransport:
+  """ Replaces HTTPAdapter.send below CachingHTTPAdapter, answers with the queued responses """
+
+  def __init__(self):
+    self.responses = []
+    self.requests = []
+
+  def queue(self, status, content=b'', headers=None):
+    response = requests.models.Response()
+    response.status_code = status
+    response._content = content
+    response._content_consumed = True
+    response.headers = requests.structures.CaseInsensitiveDict(headers or {})
+    self.responses.append(response)
+
+  def __call__(self, request, **kwargs):
+    self.requests.append(dict(request.headers))
+    response = self.responses.pop(0)
+    response.request = request
+    return response
+
+
+class HTTPResponseCacheTest(unittest.TestCase):
+
+  URL = 'https://api.spotify.com/v1/playlists/37i9dQZF1DXcBWIGoYBM5M'
+
+  def setUp(self):
+    self.cache = HTTPResponseCache(1024 * 1024)
+    self.transport = FakeTransport()
+    patcher = mock.patch.object(requests.adapters.HTTPAdapter, 'send', lambda adapter, request, **kwargs: self.transport(request))
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.session = requests.Session()
+    self.session.mount('https://', CachingHTTPAdapter(self.cache))
+
+  def test_cacheable_urls(self):
+    self.assertTrue(HTTPResponseCache.cacheable(self.URL))
+    self.assertTrue(HTTPResponseCache.cacheable('https://api.spotify.com/v1/albums/1?market=US'))
+    self.assertFalse(HTTPResponseCache.cacheable('https://api.spotify.com/v1/me/player'))
+    self.assertFalse(HTTPResponseCache.cacheable('https://api.spotify.com/v1/search?q=x'))
+    self.assertTrue(HTTPResponseCache.cacheable('https://api.spotify.com/v1/users/someone/playlists?limit=50'))
+    self.assertFalse(HTTPResponseCache.cacheable('https://api.spotify.com/v1/users/me/playlists?limit=50'))
+
+  def test_revalidation_with_etag(self):
+    self.transport.queue(200, b'{"name": "v1"}', {'ETag': '"1"', 'Cache-Control': 'no-cache'})
+    self.transport.queue(304, headers={'ETag': '"1"'})
+    self.assertEqual(self.session.get(self.URL).json(), {'name': 'v1'})
+    response = self.session.get(self.URL)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response.json(), {'name': 'v1'})
+    self.assertNotIn('If-None-Match', self.transport.requests[0])
+    self.assertEqual(self.transport.requests[1]['If-None-Match'], '"1"')
+
+  def test_changed_response_replaces_the_entry(self):
+    self.transport.queue(200, b'{"name": "v1"}', {'ETag': '"1"'})
+    self.transport.queue(200, b'{"name": "v2"}', {'ETag': '"2"'})
+    self.transport.queue(304)
+    self.session.get(self.URL)
+    self.assertEqual(self.session.get(self.URL).json(), {'name': 'v2'})
+    self.assertEqual(self.session.get(self.URL).json(), {'name': 'v2'})
+    self.assertEqual(self.transport.requests[2]['If-None-Match'], '"2"')
+
+  def test_fresh_response_is_not_revalidated(self):
+    self.transport.queue(200, b'{}', {'ETag': '"1"', 'Cache-Control': 'public, max-age=60'})
+    self.session.get(self.URL)
+    self.assertEqual(self.session.get(self.URL).json(), {})
+    self.assertEqual(len(self.transport.requests), 1)
+
+  def test_revalidated_response_gets_the_new_max_age(self):
+    self.transport.queue(200, b'{}', {'ETag': '"1"'})
+    self.transport.queue(304, headers={'ETag': '"1"', 'Cache-Control': 'max-age=60'})
+    self.session.get(self.URL)
+    self.session.get(self.URL)
+    self.assertTrue(self.cache.get(self.URL).fresh())
+    self.session.get(self.URL)
+    self.assertEqual(len(self.transport.requests), 2)
+
+  def test_no_store_and_no_validator_are_not_cached(self):
+    self.cache.put(self.URL, {'ETag': '"1"', 'Cache-Control': 'no-store'}, b'{}')
+    self.assertIsNone(self.cache.get(self.URL))
+    self.cache.put(self.URL, {}, b'{}')
+    self.assertIsNone(self.cache.get(self.URL))
+
+  def test_private_responses_are_not_shared(self):
+    shared = mock.Mock()
+    shared.get.return_value = None
+    cache = HTTPResponseCache(1024, shared=shared)
+    for headers in ({'ETag': '"1"', 'Cache-Control': 'private, max-age=0'}, {'etag': '"1"', 'cache-control': 'Private'}):
+      with self.subTest(headers=headers):
+        cache.put(self.URL, headers, b'{}', 'alice')
+        shared.set.assert_not_called()
+        self.assertIsNotNone(cache.get(self.URL, 'alice'))
+        self.assertIsNone(cache.get(self.URL, 'bob'))
+        self.assertIsNone(cache.get(self.URL))
+    cache.put(self.URL, {'ETag': '"2"', 'Cache-Control': 'public, max-age=0'}, b'{}')
+    shared.set.assert_called_once()
+    self.assertEqual(cache.get(self.URL, 'bob').etag, '"2"')
+
+  def test_private_responses_are_kept_per_account(self):
+    bob = requests.Session()
+    bob.mount('https://', CachingHTTPAdapter(self.cache, 'bob'))
+    self.session.mount('https://', CachingHTTPAdapter(self.cache, 'alice'))
+    self.transport.queue(200, b'{"name": "alice"}', {'etag': '"a"', 'cache-control': 'private, max-age=60'})
+    self.transport.queue(200, b'{"name": "bob"}', {'etag': '"b"', 'cache-control': 'private, max-age=60'})
+    self.assertEqual(self.session.get(self.URL).json(), {'name': 'alice'})
+    self.assertEqual(bob.get(self.URL).json(), {'name': 'bob'})
+    self.assertEqual(self.session.get(self.URL).json(), {'name': 'alice'})
+    self.assertEqual(len(self.transport.requests), 2)
+
+  def test_least_recently_used_are_evicted(self):
+    cache = HTTPResponseCache(10)
+    cache.put('a', {'ETag': '"a"'}, b'12345')
+    cache.put('b', {'ETag': '"b"'}, b'12345')
+    cache.get('a')
+    cache.put('c', {'ETag': '"c"'}, b'12345')
+    self.assertIsNone(cache.get('b'))
+    self.assertIsNotNone(cache.get('a'))
+
+
+if __name__ == '__main__':
+  unittest.main()
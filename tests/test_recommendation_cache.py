@@ -0,0 +1,77 @@
+"""
+Tests of the recommendation cache
+"""
+
+import unittest
+from unittest import mock
+
+from support import AppTestCase, ClockTestCase, playlist_uri
+from spotify_client import TTLCache
+
+class TTLCacheTest(ClockTestCase):
+
+  def test_entries_expire(self):
+    cache = TTLCache(ttl=5)
+    cache.set('a', 1)
+    self.clock.advance(4.9)
+    self.assertEqual(cache.get('a'), 1)
+    self.clock.advance(0.1)
+    self.assertIsNone(cache.get('a'))
+    self.assertEqual(cache.get('a', 'missing'), 'missing')
+    self.assertEqual(len(cache), 0)
+
+  def test_set_again_restarts_the_ttl(self):
+    cache = TTLCache(ttl=5)
+    cache.set('a', 1)
+    self.clock.advance(4)
+    cache.set('a', 2)
+    self.clock.advance(4)
+    self.assertEqual(cache.get('a'), 2)
+
+  def test_oldest_entries_are_evicted(self):
+    cache = TTLCache(ttl=5, max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.set('a', 3)
+    cache.set('c', 4)
+    self.assertIsNone(cache.get('b'))
+    self.assertEqual((cache.get('a'), cache.get('c')), (3, 4))
+
+  def test_clear(self):
+    cache = TTLCache(ttl=5)
+    cache.set('a', 1)
+    cache.clear()
+    self.assertIsNone(cache.get('a'))
+
+
+class RecommendationCacheTest(ClockTestCase, AppTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.app = self.make_app(recommendation_cache_ttl=60, accounts=[{'username': 'guest', 'password': 'password'}])
+    patcher = mock.patch.object(self.app, '_get_recommendation', side_effect=lambda data: playlist_uri(len(self.resolved())))
+    self.resolve = patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def resolved(self):
+    return self.resolve.call_args_list
+
+  def test_identical_events_are_resolved_once(self):
+    self.assertEqual(self.app.get_recommendation({'genre': 'Rock'}), playlist_uri(1))
+    self.assertEqual(self.app.get_recommendation({'genre': ' rock '}), playlist_uri(1))
+    self.assertEqual(len(self.resolved()), 1)
+    self.assertEqual(self.app.get_recommendation({'genre': 'rock', 'featured': True}), playlist_uri(2))
+
+  def test_candidates_expire(self):
+    self.app.get_recommendation({'genre': 'rock'})
+    self.clock.advance(60)
+    self.assertEqual(self.app.get_recommendation({'genre': 'rock'}), playlist_uri(2))
+
+  def test_accounts_have_their_own_candidates(self):
+    self.app.get_recommendation({'genre': 'rock'})
+    with self.app._use_account('guest'):
+      self.assertEqual(self.app.get_recommendation({'genre': 'rock'}), playlist_uri(2))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,76 @@
+"""
+Tests of the cache shared by the instances of a host
+"""
+
+import json
+import os
+import sqlite3
+import stat
+import unittest
+from unittest import mock
+
+from support import AppTestCase
+from spotify_client import SharedCache
+
+
+class Logger:
+
+  def __init__(self):
+    self.logs = []
+
+  def log(self, msg, level='INFO'):
+    self.logs.append((level, msg))
+
+
+class SharedCacheTest(AppTestCase):
+
+  def setUp(self):
+    self.path = os.path.join(self.make_app_dir(), 'shared.db')
+    self.logger = Logger()
+    self.cache = SharedCache(self.path, self.logger)
+    self.addCleanup(self.cache.close)
+
+  def test_values_are_shared(self):
+    other = SharedCache(self.path, self.logger)
+    self.addCleanup(other.close)
+    self.cache.set('token', 'user', {'access_token': 'a'})
+    self.assertEqual(other.get('token', 'user'), {'access_token': 'a'})
+    self.assertIsNone(other.get('token', 'other'))
+
+  def test_update(self):
+    self.assertEqual(self.cache.update('n', 'k', lambda value: (value or 0) + 1), 1)
+    self.assertEqual(self.cache.update('n', 'k', lambda value: (value or 0) + 1), 2)
+    self.assertEqual(self.cache.get('n', 'k'), 2)
+
+  def test_files_are_only_readable_by_the_owner(self):
+    self.cache.set('token', 'user', {'access_token': 'a'})
+    for file in (self.path, self.path + '-wal', self.path + '-shm'):
+      with self.subTest(file=file):
+        self.assertEqual(stat.S_IMODE(os.stat(file).st_mode), 0o600)
+
+  def test_existing_files_are_restricted(self):
+    self.cache.close()
+    os.chmod(self.path, 0o644)
+    SharedCache(self.path, self.logger).close()
+    self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+  def test_failed_update_returns_the_value(self):
+    with mock.patch.object(SharedCache, '_write', side_effect=sqlite3.OperationalError('disk I/O error')):
+      self.assertEqual(self.cache.update('n', 'k', lambda value: 'new'), 'new')
+    self.assertIsNone(self.cache.get('n', 'k'))
+    self.assertEqual(self.logger.logs[-1][0], 'WARNING')
+
+
+class SharedTokenTest(AppTestCase):
+
+  def test_token_is_saved_when_the_shared_cache_fails(self):
+    app = self.make_app(shared_cache_file='shared.db')
+    app._access_token = 'renewed'
+    with mock.patch.object(SharedCache, '_write', side_effect=sqlite3.OperationalError('database is locked')):
+      app._save_token()
+    with open(app._token_file) as f:
+      self.assertEqual(json.load(f)['access_token'], 'renewed')
+
+
+if __name__ == '__main__':
+  unittest.main()
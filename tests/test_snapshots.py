@@ -0,0 +1,59 @@
+"""
+Tests of the playback snapshots
+"""
+
+import unittest
+from unittest import mock
+
+from support import AppTestCase, track_uri
+
+
+def playback(uri, device='Kitchen', progress_ms=5000):
+  return {'device': {'id': 'id', 'name': device}, 'shuffle_state': False, 'repeat_state': 'off', 'currently_playing_type': 'track',
+          'is_playing': True, 'progress_ms': progress_ms, 'item': {'uri': uri}, 'context': None}
+
+
+class SnapshotTest(AppTestCase):
+
+  def test_slots(self):
+    app = self.make_app()
+    with mock.patch.object(app, 'get_playback_info', return_value=playback(track_uri(1))):
+      app.take_playback_snapshot()
+    with mock.patch.object(app, 'get_playback_info', return_value=playback(track_uri(2), 'Office', 7000)):
+      app.take_playback_snapshot('doorbell')
+    # The slots survive a restart
+    app._snapshots = {}
+    app._load_snapshots()
+    with mock.patch.object(app, 'get_playback_info', return_value=None), mock.patch.object(app, 'play') as play:
+      app.restore_playback_from_snapshot(name='doorbell')
+      app.restore_playback_from_snapshot()
+    self.assertEqual(play.call_args_list, [
+      mock.call('Office', track_uri(2), None, position_ms=7000, shuffle=None, repeat=None),
+      mock.call('Kitchen', track_uri(1), None, position_ms=5000, shuffle=None, repeat=None),
+    ])
+
+  def test_nothing_playing_clears_the_slot(self):
+    app = self.make_app()
+    with mock.patch.object(app, 'get_playback_info', return_value=playback(track_uri(1))):
+      app.take_playback_snapshot('doorbell')
+    with mock.patch.object(app, 'get_playback_info', return_value={}):
+      app.take_playback_snapshot('doorbell')
+    self.assertNotIn('doorbell', app._snapshots)
+
+  def test_cast_playback_info_while_the_player_api_is_unavailable(self):
+    app = self.make_app()
+    # The playback info reported by the cast (CastDevice.playback_info)
+    playback_info = {'is_playing': True, 'progress_ms': 5000, 'item': {'uri': track_uri(1), 'duration_ms': 100000},
+                     'device': {'name': 'Kitchen', 'volume_percent': 40}}
+    with mock.patch.object(app, '_circuit_open', return_value=True), \
+         mock.patch.object(app, '_cast_playback_info', return_value=playback_info):
+      app._store_snapshot('default', app.get_playback_info())
+    snapshot = app._snapshots['default']
+    self.assertEqual(snapshot['device_name'], 'Kitchen')
+    self.assertEqual(snapshot['currently_playing_uri'], track_uri(1))
+    self.assertEqual(snapshot['progress_ms'], 5000)
+    self.assertIsNone(snapshot['shuffle_state'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,77 @@
+"""
+Tests of the speculative recommendation branches
+"""
+
+import threading
+import unittest
+from unittest import mock
+
+import spotipy
+
+from support import AppTestCase, playlist_uri
+
+
+class SpeculativeRecommendationTest(AppTestCase):
+
+  def setUp(self):
+    self.app = self.make_app(speculative_recommendation=True)
+    self.data = {'genre': 'rock', 'featured': True}
+
+  def patch(self, name, result=None):
+    """ Replace a branch, result is returned or raised """
+    calls = []
+
+    def branch(data, random_search):
+      calls.append(data)
+      if isinstance(result, Exception):
+        raise result
+      return result(data, random_search) if callable(result) else result
+    branch.__name__ = name
+    patcher = mock.patch.object(self.app, name, branch)
+    self.addCleanup(patcher.stop)
+    patcher.start()
+    return calls
+
+  def test_highest_priority_branch_wins(self):
+    self.patch('_recommend_genre', playlist_uri(1))
+    self.patch('_recommend_featured', playlist_uri(2))
+    fallback = self.patch('_recommend_fallback')
+    self.assertEqual(self.app._get_recommendation(self.data), playlist_uri(1))
+    self.assertEqual(fallback, [])
+
+  def test_fallback_only_when_the_branches_fail(self):
+    self.patch('_recommend_genre', spotipy.client.SpotifyException(500, -1, 'error'))
+    self.patch('_recommend_featured')
+    self.patch('_recommend_fallback', playlist_uri(3))
+    self.assertEqual(self.app._get_recommendation(self.data), playlist_uri(3))
+
+  def test_unexpected_errors_are_not_raised(self):
+    self.patch('_recommend_genre', KeyError('items'))
+    self.patch('_recommend_featured', playlist_uri(2))
+    self.assertEqual(self.app._get_recommendation(self.data), playlist_uri(2))
+    self.assertTrue(any(level == 'ERROR' and '_recommend_genre' in msg for level, msg in self.app.logs))
+
+  def test_losing_branch_stops_before_its_next_call(self):
+    started, winner = threading.Event(), threading.Event()
+    calls = []
+
+    def slow_featured(data, random_search):
+      started.set()
+      winner.wait(5)
+      # The genre won meanwhile
+      calls.append(self.app._deadline_passed())
+
+    def genre(data, random_search):
+      started.wait(5)
+      return playlist_uri(1)
+
+    self.patch('_recommend_genre', genre)
+    self.patch('_recommend_featured', slow_featured)
+    self.assertEqual(self.app._get_recommendation(self.data), playlist_uri(1))
+    winner.set()
+    self.app._branch_executor.shutdown(wait=True)
+    self.assertEqual(calls, [True])
+
+
+if __name__ == '__main__':
+  unittest.main()
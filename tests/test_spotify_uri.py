@@ -0,0 +1,49 @@
+"""
+Tests of the Spotify uri parser
+"""
+
+import unittest
+
+import support  # Puts the app folder on sys.path
+from spotify_client import SpotifyURI
+
+class SpotifyURITest(unittest.TestCase):
+
+  ID = '4uLU6hMCjMI75M1A2tKUQC'
+
+  def test_parse_uri(self):
+    parsed = SpotifyURI.parse('spotify:track:' + self.ID)
+    self.assertEqual((parsed.type, parsed.id), ('track', self.ID))
+    self.assertEqual(str(parsed), 'spotify:track:' + self.ID)
+
+  def test_parse_url(self):
+    for url in ('https://open.spotify.com/playlist/{}'.format(self.ID),
+                'https://open.spotify.com/playlist/{}?si=abc123'.format(self.ID),
+                'https://open.spotify.com/intl-fr/playlist/{}'.format(self.ID),
+                'https://open.spotify.com/user/someone/playlist/{}'.format(self.ID)):
+      self.assertEqual(SpotifyURI.parse(url), ('playlist', self.ID), url)
+
+  def test_parse_invalid(self):
+    for value in (None, '', 42, 'spotify:track:short', 'spotify:show:' + self.ID, 'spotify:track:' + self.ID + 'x',
+                  'https://example.com/track/' + self.ID):
+      self.assertIsNone(SpotifyURI.parse(value), value)
+
+  def test_parse_media_type(self):
+    uri = 'spotify:album:' + self.ID
+    self.assertIsNotNone(SpotifyURI.parse(uri, 'album'))
+    self.assertIsNone(SpotifyURI.parse(uri, 'track'))
+    self.assertIsNotNone(SpotifyURI.parse(uri, ('track', 'album')))
+
+  def test_parse_many(self):
+    values = ['spotify:track:' + self.ID, 'https://open.spotify.com/track/' + self.ID]
+    self.assertEqual(SpotifyURI.parse_many(values, 'track'), [('track', self.ID)] * 2)
+    self.assertEqual(SpotifyURI.parse_many([]), [])
+
+  def test_parse_many_fails_on_any_invalid(self):
+    self.assertIsNone(SpotifyURI.parse_many(['spotify:track:' + self.ID, 'spotify:track:nope']))
+    self.assertIsNone(SpotifyURI.parse_many(['spotify:track:' + self.ID, None]))
+    self.assertIsNone(SpotifyURI.parse_many(['spotify:track:' + self.ID, 'spotify:artist:' + self.ID], 'track'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,41 @@
+"""
+Tests of the Spotify token saved across restarts
+"""
+
+import json
+import os
+import stat
+import time
+import unittest
+
+from support import AppTestCase
+
+
+class SavedTokenTest(AppTestCase):
+
+  def save_token(self, app_dir, username='user', access_token='saved', expires_in=3600):
+    with open(os.path.join(app_dir, 'spotify_client_token.json'), 'w') as f:
+      json.dump({'username': username, 'access_token': access_token, 'expires_at': time.time() + expires_in}, f)
+
+  def test_token_is_saved_for_the_owner_only(self):
+    app = self.make_app()
+    with open(app._token_file) as f:
+      saved = json.load(f)
+    self.assertEqual((saved['username'], saved['access_token']), ('user', 'token'))
+    self.assertEqual(stat.S_IMODE(os.stat(app._token_file).st_mode), 0o600)
+
+  def test_saved_token_is_reused(self):
+    app_dir = self.make_app_dir()
+    self.save_token(app_dir)
+    self.assertEqual(self.make_app(app_dir)._access_token, 'saved')
+
+  def test_token_of_another_user_or_expiring_is_not_reused(self):
+    for saved in ({'username': 'other'}, {'expires_in': 30}):
+      with self.subTest(**saved):
+        app_dir = self.make_app_dir()
+        self.save_token(app_dir, **saved)
+        self.assertEqual(self.make_app(app_dir)._access_token, 'token')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,68 @@
+"""
+Tests of the compact track collection
+"""
+
+import random
+import unittest
+
+from support import track_uri
+from spotify_client import TrackCollection
+
+class TrackCollectionTest(unittest.TestCase):
+
+  def test_encode_decode_round_trip(self):
+    for track_id in ('0' * 22, '6' + 'Z' * 21, '4uLU6hMCjMI75M1A2tKUQC'):
+      raw = TrackCollection.encode('spotify:track:' + track_id)
+      self.assertEqual(len(raw), TrackCollection.ID_SIZE)
+      self.assertEqual(TrackCollection.decode(raw), 'spotify:track:' + track_id)
+
+  def test_encode_url_and_id(self):
+    raw = TrackCollection.encode('spotify:track:4uLU6hMCjMI75M1A2tKUQC')
+    self.assertEqual(TrackCollection.encode('https://open.spotify.com/track/4uLU6hMCjMI75M1A2tKUQC?si=x'), raw)
+    self.assertEqual(TrackCollection.encode('4uLU6hMCjMI75M1A2tKUQC'), raw)
+
+  def test_encode_invalid(self):
+    # The largest 22 digit base62 numbers don't fit in 128 bits
+    for uri in ('spotify:track:short', 'spotify:local:a:b:c:1', 'spotify:track:' + '!' * 22, 'spotify:track:' + 'Z' * 22):
+      with self.assertRaises(ValueError):
+        TrackCollection.encode(uri)
+
+  def test_sequence_keeps_insertion_order_without_duplicates(self):
+    uris = [track_uri(i) for i in range(5)]
+    tracks = TrackCollection(uris + uris[:2])
+    self.assertEqual(len(tracks), 5)
+    self.assertEqual(list(tracks), uris)
+    self.assertEqual(tracks[1], uris[1])
+    self.assertEqual(tracks[-1], uris[-1])
+    self.assertEqual(tracks.index(uris[3]), 3)
+    self.assertIsInstance(tracks[1:3], TrackCollection)
+    self.assertEqual(list(tracks[1:3]), uris[1:3])
+    with self.assertRaises(IndexError):
+      tracks[5]
+
+  def test_hash_table_membership(self):
+    # Enough tracks for the hash table to be rebuilt several times
+    uris = [track_uri(i * 7919) for i in range(1000)]
+    tracks = TrackCollection()
+    for uri in uris:
+      self.assertTrue(tracks.add(uri))
+    self.assertFalse(tracks.add(uris[500]))
+    self.assertEqual(len(tracks), 1000)
+    self.assertGreaterEqual(len(tracks._slots), 2 * len(tracks))
+    self.assertTrue(all(uri in tracks for uri in uris))
+    self.assertNotIn(track_uri(1), tracks)
+    self.assertNotIn('spotify:local:a:b:c:1', tracks)
+    self.assertEqual([tracks.index(uri) for uri in uris[::100]], list(range(0, 1000, 100)))
+    with self.assertRaises(ValueError):
+      tracks.index(track_uri(1))
+
+  def test_random_sampling(self):
+    tracks = TrackCollection(track_uri(i) for i in range(50))
+    sample = random.sample(tracks, 10)
+    self.assertEqual(len(set(sample)), 10)
+    self.assertTrue(all(uri in tracks for uri in sample))
+    self.assertIn(random.choice(tracks), tracks)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,50 @@
+"""
+Tests of the warm-up of the Spotify app on casts
+"""
+
+import types
+import unittest
+from unittest import mock
+
+from support import AppTestCase
+import spotify_client
+from spotify_client import CastDevice
+
+
+def cast_device(app_id, display_name=None):
+  device = CastDevice.__new__(CastDevice)
+  device._spotify_controller = None
+  device.cast_status = types.SimpleNamespace(app_id=app_id, display_name=display_name)
+  return device
+
+
+class ForegroundAppTest(unittest.TestCase):
+
+  def test_idle_screen_and_spotify(self):
+    for app_id in (None, spotify_client.CAST_BACKDROP_APP_ID, spotify_client.CAST_SPOTIFY_APP_ID):
+      with self.subTest(app_id=app_id):
+        self.assertIsNone(cast_device(app_id).foreground_app())
+
+  def test_other_app(self):
+    self.assertEqual(cast_device('CA5E8412', 'Netflix').foreground_app(), 'Netflix')
+    self.assertEqual(cast_device('233637DE').foreground_app(), '233637DE')
+
+
+class WarmUpTest(AppTestCase):
+
+  def test_other_app_is_not_interrupted(self):
+    app = self.make_app()
+    device = cast_device('CA5E8412', 'Netflix')
+    with mock.patch.object(app, '_get_cast_device', return_value=device), \
+         mock.patch.object(app, '_register_spotify_on_cast_device') as register:
+      app._warm_up_casts(['TV'])
+      register.assert_not_called()
+      # Launched on the next warm up once the cast is idle again
+      device.cast_status.app_id = spotify_client.CAST_BACKDROP_APP_ID
+      with mock.patch.object(app, '_search_spotify_for_device', return_value='id'):
+        app._warm_up_casts(['TV'])
+      register.assert_called_once_with('TV')
+
+
+if __name__ == '__main__':
+  unittest.main()